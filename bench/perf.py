@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Throughput regression check for the hot paths
+
+Runs each benchmark on synthetic fixtures (random key + firmware image, no key.dat needed),
+reports MB/s and items/s (blocks, records or chunks) and compares against a stored baseline
+Fails if any benchmark got slower than the baseline by more than the tolerance
+
+Baselines are per machine: record one with --save before making changes
+"""
+
+import contextlib
+import io
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from libxgecu.t48 import t48crypto
+from libxgecu.t48.xgecu import simdev, t48, util
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# Allowed slowdown vs baseline, fraction
+DEFAULT_TOLERANCE = 0.25
+# Firmware fixture size, blocks. Roughly a real T48 image
+NUM_BLOCKS = 2000
+
+
+class Fixtures:
+    def __init__(self, tmpdir, num_blocks=NUM_BLOCKS, seed=0):
+        rng = random.Random(seed)
+        self.tmpdir = tmpdir
+        self.key = bytes(rng.getrandbits(8) for _ in range(516))
+        self.key_fn = os.path.join(tmpdir, "key.dat")
+        with open(self.key_fn, "wb") as f:
+            f.write(self.key)
+        self.ks = t48crypto.KeySchedule(self.key)
+        # Reference paths use the default key
+        t48crypto.set_key_provider(t48crypto.KeyProvider(self.key_fn))
+
+        self.plain = []
+        for i in range(num_blocks):
+            payload = bytes(rng.getrandbits(8) for _ in range(256))
+            self.plain.append(struct.pack("<I", 0x08000000 + 256 * i) + payload)
+        self.blocks = [t48crypto.encr_blk(data, rng.getrandbits(16), 0, 0, ks=self.ks)
+                       for data in self.plain]
+        self.hdr = t48crypto.FileHeader(7, 1, 0, 0, 0, num_blocks)
+        self.dat_fn = os.path.join(tmpdir, "fw.dat")
+        t48crypto.write_file(self.dat_fn, self.hdr, self.blocks)
+        with open(self.dat_fn, "rb") as f:
+            self.dat = f.read()
+        self.version = bytes(simdev.VERSION_T48)
+
+
+def best_of(runs, fn):
+    """Return the fastest of runs calls to fn, seconds"""
+    best = None
+    for _ in range(runs):
+        tstart = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - tstart
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def bench_decr_blk(fx):
+    ks = fx.ks
+    blocks = fx.blocks
+
+    def run():
+        for blk in blocks:
+            t48crypto.decr_blk(blk, ks=ks)
+    return run, len(blocks) * t48crypto.BLOCK_DATA_SIZE, len(blocks)
+
+def bench_encr_blk(fx):
+    ks = fx.ks
+    plain = fx.plain
+    blocks = fx.blocks
+
+    def run():
+        for data, blk in zip(plain, blocks):
+            t48crypto.encr_blk(data, blk.index, blk.unknown, blk.pad, ks=ks)
+    return run, len(plain) * t48crypto.BLOCK_DATA_SIZE, len(plain)
+
+def bench_decr_blk_ref(fx):
+    # Per byte reference path: small sample, it's slow
+    blocks = fx.blocks[:50]
+
+    def run():
+        for blk in blocks:
+            t48crypto.decr_blk_ref(blk)
+    return run, len(blocks) * t48crypto.BLOCK_DATA_SIZE, len(blocks)
+
+def bench_decr_image_np(fx):
+    try:
+        from libxgecu.t48 import t48crypto_np
+    except ImportError:
+        return None
+
+    def run():
+        with t48crypto.FirmwareImage(fx.dat_fn) as image:
+            t48crypto_np.decr_image(image, ks=fx.ks)
+    return run, len(fx.dat), len(fx.blocks)
+
+def bench_read_file(fx):
+    def run():
+        t48crypto.read_file(fx.dat_fn)
+    return run, len(fx.dat), len(fx.blocks)
+
+def bench_write_file(fx):
+    fn = os.path.join(fx.tmpdir, "out.dat")
+
+    def run():
+        t48crypto.write_file(fn, fx.hdr, fx.blocks)
+    return run, len(fx.dat), len(fx.blocks)
+
+def bench_parse_version(fx):
+    n = 10000
+    raw = fx.version
+
+    def run():
+        for _ in range(n):
+            t48.parse_version(raw)
+    return run, n * len(raw), n
+
+def bench_hexdump(fx):
+    data = fx.dat
+
+    def run():
+        util.hexdump(data, f=io.StringIO())
+    return run, len(data), len(data) // 16
+
+def replay_bench(fx, window):
+    from libxgecu.t48 import update
+
+    records = list(update.dat_records(fx.dat))
+
+    def run():
+        # No modeled latency: this measures host side overhead per chunk
+        device = simdev.SimDevice(reset_time=0.0)
+        # replay() starts in the updater
+        device.bootloader = True
+        with simdev.SimSession(device) as session, contextlib.redirect_stdout(io.StringIO()):
+            update.replay(session.open(), records, window=window)
+        assert device.flashed == records
+    return run, len(records) * t48crypto.BLOCK.size, len(records)
+
+def bench_replay(fx):
+    return replay_bench(fx, 0)
+
+def bench_replay_window8(fx):
+    return replay_bench(fx, 8)
+
+
+BENCHMARKS = [
+    ("decr_blk", bench_decr_blk),
+    ("encr_blk", bench_encr_blk),
+    ("decr_blk_ref", bench_decr_blk_ref),
+    ("decr_image_np", bench_decr_image_np),
+    ("read_file", bench_read_file),
+    ("write_file", bench_write_file),
+    ("parse_version", bench_parse_version),
+    ("hexdump", bench_hexdump),
+    ("replay", bench_replay),
+    ("replay_window8", bench_replay_window8),
+]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="Best of N runs")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="Store results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown vs baseline, ex: 0.25 for 25%%")
+    parser.add_argument("--json", help="Also write results here")
+    parser.add_argument("only", nargs="*", help="Only run these benchmarks")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fx = Fixtures(tmpdir)
+        for name, bench in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            setup = bench(fx)
+            if setup is None:
+                print("skip %-16s not available" % name)
+                continue
+            run, nbytes, items = setup
+            dt = best_of(args.runs, run)
+            result = {"mb_s": nbytes / dt / 1e6, "items_s": items / dt}
+            results[name] = result
+
+            status = "ok"
+            note = "no baseline"
+            ref = baseline.get(name)
+            if ref:
+                ratio = result["mb_s"] / ref["mb_s"]
+                note = "%+.0f%% vs baseline" % ((ratio - 1) * 100)
+                if ratio < 1 - args.tolerance:
+                    status = "FAIL"
+                    failed += 1
+            print("%-4s %-16s %9.2f MB/s %11.0f items/s  %s" % (
+                status, name, result["mb_s"], result["items_s"], note))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+On disk cache of encrypted blocks for incremental re-encryption
+
+Re-encrypting a patched image only has to crypt the runs of blocks whose plaintext changed
+A block crypts with a single XOR, cheaper than any per block lookup,
+so entries cover runs of RUN_BLOCKS consecutive blocks: one digest + one lookup per run
+Runs are aligned on the manifest, every RUN_BLOCKS blocks from the first:
+inserting or removing a block shifts every later run, so they all miss
+"""
+
+import hashlib
+import os
+import sqlite3
+import struct
+import time
+from libxgecu.t48 import t48crypto as t48
+from libxgecu.t48.xgecu.util import cache_path
+
+# Manifest fields hashed along with a block's plaintext: seed, unknown, pad
+BLOCK_KEY_FIELDS = struct.Struct("<III")
+DIGEST_SIZE = 16
+# Blocks per cache entry
+RUN_BLOCKS = 128
+
+def default_path():
+    return cache_path("blocks.sqlite")
+
+def run_key(run, key_id):
+    """run: [(data, index, unknown, pad), ...]"""
+    pack = BLOCK_KEY_FIELDS.pack
+    h = hashlib.blake2b(key_id, digest_size=DIGEST_SIZE)
+    h.update(b"".join([pack(index, unknown, pad) + data for data, index, unknown, pad in run]))
+    return h.digest()
+
+class BlockCache:
+    """
+    Encrypted runs of Blocks keyed by (plaintext + block fields digest, key id)
+    Least recently used entries are evicted once the cache grows past max_bytes
+    """
+    def __init__(self, path=None, max_bytes=64 << 20):
+        self.path = default_path() if path is None else path
+        self.max_bytes = max_bytes
+        # In blocks
+        self.hits = 0
+        self.misses = 0
+        # atime updates for hits, applied on flush()
+        self._touched = []
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs "
+                        "(k BLOB PRIMARY KEY, blocks BLOB NOT NULL, atime REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS runs_atime ON runs (atime)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def get(self, k):
+        """Cached Blocks of a run, or None"""
+        row = self.db.execute("SELECT blocks FROM runs WHERE k = ?", (k,)).fetchone()
+        if row is None:
+            return None
+        self._touched.append(k)
+        return list(map(t48.Block._make, t48.BLOCK.iter_unpack(row[0])))
+
+    def put(self, k, blocks):
+        self.db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?)",
+                        (k, b"".join(t48.BLOCK.pack(*blk) for blk in blocks), time.time()))
+
+    def encr_blks(self, items, ks=None):
+        """
+        t48crypto.encr_blk() over items [(data, index, unknown, pad), ...]
+        Yield Blocks, runs with unchanged plaintext served from the cache
+        """
+        if ks is None:
+            ks = t48.default_schedule()
+        items = list(items)
+        for start in range(0, len(items), RUN_BLOCKS):
+            run = items[start:start + RUN_BLOCKS]
+            k = run_key(run, ks.key_id)
+            blocks = self.get(k)
+            if blocks is None:
+                blocks = [t48.encr_blk(data, index, unknown, pad, ks=ks)
+                          for data, index, unknown, pad in run]
+                self.put(k, blocks)
+                self.misses += len(run)
+            else:
+                self.hits += len(run)
+            yield from blocks
+
+    def flush(self):
+        now = time.time()
+        self.db.executemany("UPDATE runs SET atime = ? WHERE k = ?",
+                            [(now, k) for k in self._touched])
+        self._touched = []
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        size, = self.db.execute("SELECT TOTAL(LENGTH(blocks)) FROM runs").fetchone()
+        while size > self.max_bytes:
+            row = self.db.execute("SELECT k, LENGTH(blocks) FROM runs ORDER BY atime LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.db.execute("DELETE FROM runs WHERE k = ?", (row[0],))
+            size -= row[1]
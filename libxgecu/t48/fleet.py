@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+from libxgecu.t48.xgecu.pool import DevicePool, JobResult, fmt_port, version_job
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="List / query / update every attached programmer")
+    subparsers = parser.add_subparsers(dest="cmd")
+    subparsers.required = True
+    subparsers.add_parser("list", help="Attached programmers")
+    parser_version = subparsers.add_parser("version", help="Version info of every programmer")
+    parser_version.add_argument("--cached", action="store_true",
+                                help="Only query programmers without a fresh inventory record")
+    parser_update = subparsers.add_parser("update", help="Flash every programmer")
+    parser_update.add_argument("--force", action="store_true",
+                               help="Flash even programmers already running this firmware version")
+    parser_update.add_argument("firmware_file", help=".dat firmware image")
+    args = parser.parse_args()
+
+    from libxgecu.t48.xgecu.inventory import Inventory
+
+    inventory = Inventory()
+    with DevicePool(inventory=inventory) as pool:
+        devices = pool.enumerate()
+        if args.cmd == "list":
+            for device in devices:
+                print("%-8s Bus %03u Device %03u" % (fmt_port(device.port), device.bus, device.address))
+            return
+
+        cached = {}
+        if args.cmd == "version":
+            job = version_job
+            if args.cached:
+                for device in devices:
+                    record = inventory.lookup(port=device.port)
+                    if record is not None:
+                        cached[device.port] = JobResult(device, True, record, None, 0.0)
+                devices = [device for device in devices if device.port not in cached]
+        else:
+            from libxgecu.t48 import update
+
+            with open(args.firmware_file, "rb") as f:
+                firmware = f.read()
+            try:
+                hdr = update.preflight(firmware)
+            except update.PreflightError as e:
+                print("Preflight failed: %s" % e)
+                sys.exit(1)
+
+            def job(t):
+                flashed = update.update_device(t, update.dat_records(firmware),
+                                               hdr=None if args.force else hdr)
+                return dict(version_job(t), flashed=flashed)
+
+        try:
+            results = pool.run(job, devices)
+        finally:
+            inventory.save()
+        results.update(cached)
+        failed = 0
+        for port, result in sorted(results.items()):
+            if result.ok:
+                version = result.value
+                print("ok   %-8s %0.1f sec model %s serial %s FW %u.%02u%s" % (
+                    fmt_port(port), result.dt, version["model"], version["serial"],
+                    version["ver_major"], version["ver_minor"],
+                    " (already current)" if version.get("flashed") is False else ""))
+            else:
+                failed += 1
+                print("FAIL %-8s %0.1f sec %s" % (fmt_port(port), result.dt, result.error))
+        print("%u devices, %u failed" % (len(results), failed))
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Block level diff of firmware releases
+
+Images are decrypted in parallel into a flash offset => (block number, digest) map
+Maps are compared by digest, and only blocks whose digests differ are decrypted again
+for byte level detail, so diffing two full images costs about one decryption of each
+"""
+
+import os
+from collections import namedtuple
+from libxgecu.t48 import t48crypto as t48
+from libxgecu.t48.t48decrypt import BLOCK_OFFSET, PAYLOAD_SIZE, payload_digest
+
+# Digest map of one image. blocks: flash offset => (block number, digest)
+ImageMap = namedtuple('ImageMap', ['filename', 'header', 'blocks'])
+# Contiguous run of blocks with the same kind of change, flash offsets [start, end)
+# kind: "added", "removed" or "modified". offsets: block offsets in the run
+Change = namedtuple('Change', ['kind', 'start', 'end', 'offsets'])
+# Byte level difference in a modified block, flash offsets [start, end)
+ByteRun = namedtuple('ByteRun', ['start', 'end'])
+
+def _map_job(filename):
+    return image_map(filename, ks=t48.worker_schedule())
+
+def image_map(filename, ks=None):
+    """Decrypt filename into an ImageMap"""
+    blocks = {}
+    with t48.FirmwareImage(filename) as image:
+        for i, blk in enumerate(image):
+            data = t48.decr_blk(blk, ks=ks)
+            offset, = BLOCK_OFFSET.unpack_from(data)
+            if offset in blocks:
+                raise ValueError("%s: blocks %u and %u both at 0x%08X" % (
+                    filename, blocks[offset][0], i, offset))
+            blocks[offset] = (i, payload_digest(data))
+        return ImageMap(filename, image.header, blocks)
+
+def image_maps(filenames, ks=None, workers=None):
+    """
+    ImageMap per file, in order. Decrypted across a process pool unless workers == 1
+    ks: KeySchedule (default: default_schedule())
+    """
+    if ks is None:
+        ks = t48.default_schedule()
+    if workers == 1 or len(filenames) < 2:
+        return [image_map(fn, ks=ks) for fn in filenames]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers or min(len(filenames), os.cpu_count() or 1),
+                             initializer=t48.init_worker, initargs=(ks.key,)) as executor:
+        return list(executor.map(_map_job, filenames))
+
+def change_map(old, new):
+    """
+    Compare two ImageMaps by digest
+    Return [Change, ...] sorted by offset. Adjacent blocks of the same kind are merged
+    """
+    kinds = {}
+    for offset, (_i, digest) in old.blocks.items():
+        other = new.blocks.get(offset)
+        if other is None:
+            kinds[offset] = "removed"
+        elif other[1] != digest:
+            kinds[offset] = "modified"
+    for offset in new.blocks:
+        if offset not in old.blocks:
+            kinds[offset] = "added"
+
+    ret = []
+    for offset in sorted(kinds):
+        kind = kinds[offset]
+        last = ret[-1] if ret else None
+        if last is not None and last.kind == kind and last.end == offset:
+            last.offsets.append(offset)
+            ret[-1] = last._replace(end=offset + PAYLOAD_SIZE)
+        else:
+            ret.append(Change(kind, offset, offset + PAYLOAD_SIZE, [offset]))
+    return ret
+
+def byte_runs(a, b, base=0):
+    """[ByteRun, ...] where equal length buffers a and b differ. base: address of a[0]"""
+    ret = []
+    start = None
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            if start is None:
+                start = i
+        elif start is not None:
+            ret.append(ByteRun(base + start, base + i))
+            start = None
+    if start is not None:
+        ret.append(ByteRun(base + start, base + len(a)))
+    return ret
+
+class ImageDiff:
+    """
+    Difference between two ImageMaps
+    Payloads of modified blocks are decrypted on demand from the .dat files
+    Both files stay open until close()
+    """
+    def __init__(self, old, new, ks=None):
+        self.old = old
+        self.new = new
+        self.ks = ks
+        self.changes = change_map(old, new)
+        # FirmwareImage per side, opened on first use
+        self._images = [None, None]
+        # flash offset => (old payload, new payload)
+        self._payloads = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for i, image in enumerate(self._images):
+            if image is not None:
+                image.close()
+                self._images[i] = None
+
+    def counts(self):
+        ret = {"added": 0, "removed": 0, "modified": 0}
+        for change in self.changes:
+            ret[change.kind] += len(change.offsets)
+        return ret
+
+    def payloads(self, offset):
+        """(old payload, new payload) at a flash offset, None for a missing side"""
+        ret = self._payloads.get(offset)
+        if ret is not None:
+            return ret
+        ret = []
+        for side, m in enumerate((self.old, self.new)):
+            entry = m.blocks.get(offset)
+            if entry is None:
+                ret.append(None)
+                continue
+            if self._images[side] is None:
+                self._images[side] = t48.FirmwareImage(m.filename, verify=False)
+            data = t48.decr_blk(self._images[side].block(entry[0]), ks=self.ks)
+            ret.append(data[BLOCK_OFFSET.size:])
+        ret = self._payloads[offset] = tuple(ret)
+        return ret
+
+    def byte_detail(self, change):
+        """{offset: [ByteRun, ...]} for the blocks of a modified Change"""
+        assert change.kind == "modified"
+        ret = {}
+        for offset in change.offsets:
+            a, b = self.payloads(offset)
+            ret[offset] = byte_runs(a, b, base=offset)
+        return ret
+
+    def to_dict(self, detail=True):
+        changes = []
+        for change in self.changes:
+            d = {"kind": change.kind, "start": change.start, "end": change.end,
+                 "blocks": len(change.offsets)}
+            if detail and change.kind == "modified":
+                d["bytes"] = [[run.start, run.end]
+                              for runs in self.byte_detail(change).values() for run in runs]
+            changes.append(d)
+        return {
+            "old": {"file": self.old.filename, "header": self.old.header._asdict()},
+            "new": {"file": self.new.filename, "header": self.new.header._asdict()},
+            "counts": self.counts(),
+            "changes": changes,
+        }
+
+def diff_files(filenames, key_fn=None, workers=None):
+    """ImageDiff for each consecutive pair of .dat files"""
+    ks = t48.load_key(key_fn)
+    maps = image_maps(filenames, ks=ks, workers=workers)
+    return [ImageDiff(old, new, ks=ks) for old, new in zip(maps, maps[1:])]
+
+def fmt_version(hdr):
+    return "%u.%02u" % (hdr.major_version, hdr.minor_version)
+
+def print_diff(diff, detail=False, hexdump=False, context=0):
+    from libxgecu.t48.xgecu.util import hexdump_diff
+
+    counts = diff.counts()
+    print("%s (%s) => %s (%s): %u modified, %u added, %u removed blocks" % (
+        diff.old.filename, fmt_version(diff.old.header), diff.new.filename, fmt_version(diff.new.header),
+        counts["modified"], counts["added"], counts["removed"]))
+    for change in diff.changes:
+        print("  %-8s 0x%08X-0x%08X %5u blocks" % (change.kind, change.start, change.end,
+                                                   len(change.offsets)))
+        if change.kind != "modified" or not (detail or hexdump):
+            continue
+        for offset, runs in diff.byte_detail(change).items():
+            if detail:
+                for run in runs:
+                    print("    0x%08X-0x%08X %4u bytes" % (run.start, run.end, run.end - run.start))
+            if hexdump:
+                a, b = diff.payloads(offset)
+                hexdump_diff(a, b, indent="    ", context=context, base=offset)
+
+def main():
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(description="Block level diff of .dat firmware images")
+    parser.add_argument("--key", help="Key file (default: $T48_KEY or key.dat)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes")
+    parser.add_argument("--bytes", action="store_true", help="List changed byte ranges in modified blocks")
+    parser.add_argument("--hexdump", action="store_true", help="Side by side hexdump of modified blocks")
+    parser.add_argument("--context", type=int, default=0, help="Unchanged hexdump rows around changes")
+    parser.add_argument("--json", action="store_true", help="Print the change maps as JSON")
+    parser.add_argument("files", nargs="+", help=".dat files, oldest first. Each is diffed against the previous")
+    args = parser.parse_args()
+    if len(args.files) < 2:
+        parser.error("Need at least two images")
+
+    try:
+        diffs = diff_files(args.files, key_fn=args.key, workers=args.jobs)
+    except (OSError, ValueError) as e:
+        sys.exit("Failed: %s" % e)
+    try:
+        if args.json:
+            print(json.dumps([diff.to_dict(detail=args.bytes) for diff in diffs], indent=4))
+        else:
+            for diff in diffs:
+                print_diff(diff, detail=args.bytes, hexdump=args.hexdump, context=args.context)
+    finally:
+        for diff in diffs:
+            diff.close()
+    sys.exit(1 if any(diff.changes for diff in diffs) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Content addressed store of .dat firmware releases with an SQLite index
+
+Files are kept as objects/<sha256>, indexed in index.sqlite
+The index holds each image's header, its block records (seed, CRC, flash address) and
+the decrypted block payloads, deduplicated across releases by digest,
+so questions like "which releases contain this block" don't decrypt anything
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from collections import namedtuple
+from libxgecu.t48 import t48crypto as t48
+from libxgecu.t48.t48decrypt import BLOCK_OFFSET, PAYLOAD_SIZE, flash_base, payload_digest
+from libxgecu.t48.xgecu.util import data_path
+
+ImageInfo = namedtuple('ImageInfo', ['sha256', 'name', 'model', 'major_version', 'minor_version',
+                                     'magic', 'crc32', 'num_blocks', 'added'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    sha256 TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    model TEXT,
+    major_version INTEGER NOT NULL,
+    minor_version INTEGER NOT NULL,
+    magic INTEGER NOT NULL,
+    crc32 INTEGER NOT NULL,
+    num_blocks INTEGER NOT NULL,
+    added REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_model ON images (model, major_version, minor_version);
+CREATE TABLE IF NOT EXISTS payloads (
+    digest BLOB PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    image TEXT NOT NULL,
+    i INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    unknown INTEGER NOT NULL,
+    pad INTEGER NOT NULL,
+    crc32 INTEGER NOT NULL,
+    address INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (image, i)
+);
+CREATE INDEX IF NOT EXISTS blocks_digest ON blocks (digest);
+CREATE INDEX IF NOT EXISTS blocks_address ON blocks (address);
+"""
+
+def default_path():
+    return data_path("firmware")
+
+def guess_model(filename):
+    """Model from a release file name, ex: T56_V1.07.dat => t56. None if unknown"""
+    name = os.path.basename(filename).lower()
+    for model in ("t48", "t56"):
+        if model in name:
+            return model
+    return None
+
+class FirmwareStore:
+    """
+    Store rooted at path (default: $XDG_DATA_HOME/libxgecu/firmware)
+    ks: KeySchedule used to decrypt blocks on ingest (default: default_schedule())
+    """
+    def __init__(self, path=None, ks=None):
+        self.path = default_path() if path is None else path
+        self.ks = ks
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, "index.sqlite"))
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def object_path(self, sha256):
+        return os.path.join(self.path, "objects", sha256)
+
+    def add(self, filename, model=None, name=None):
+        """
+        Ingest a .dat file. Raises ValueError on a corrupt image
+        Return (ImageInfo, True if new / False if already stored)
+        """
+        with open(filename, "rb") as f:
+            buf = f.read()
+        sha256 = hashlib.sha256(buf).hexdigest()
+        info = self.image(sha256)
+        if info is not None:
+            return info, False
+        if model is None:
+            model = guess_model(filename)
+        if name is None:
+            name = os.path.basename(filename)
+        ks = t48.default_schedule() if self.ks is None else self.ks
+
+        # Decrypt everything before touching the index: a bad block rejects the whole file
+        with t48.FirmwareImage(buf=buf) as image:
+            hdr = image.header
+            rows = []
+            payloads = {}
+            for i, blk in enumerate(image):
+                data = t48.decr_blk(blk, ks=ks)
+                digest = payload_digest(data)
+                payloads[digest] = data
+                rows.append((sha256, i, blk.index, blk.unknown, blk.pad, blk.crc32,
+                             BLOCK_OFFSET.unpack_from(data)[0], digest))
+
+        info = ImageInfo(sha256, name, model, hdr.major_version, hdr.minor_version,
+                         hdr.magic, hdr.crc32, hdr.num_blocks, time.time())
+        # Object and index row land together: the object is only renamed into place
+        # inside the index transaction, and a failure on either side removes it
+        fn = self.object_path(sha256)
+        tmp = "%s.%u.tmp" % (fn, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(buf)
+        try:
+            with self.db:
+                self.db.execute("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", info)
+                self.db.executemany("INSERT OR IGNORE INTO payloads VALUES (?, ?)", payloads.items())
+                self.db.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                os.replace(tmp, fn)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return info, True
+
+    def remove(self, sha256):
+        """Drop an image. Payloads no other image uses go with it"""
+        with self.db:
+            self.db.execute("DELETE FROM blocks WHERE image = ?", (sha256,))
+            self.db.execute("DELETE FROM images WHERE sha256 = ?", (sha256,))
+            self.db.execute("DELETE FROM payloads WHERE digest NOT IN (SELECT digest FROM blocks)")
+        try:
+            os.remove(self.object_path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def _images(self, where="", args=()):
+        return [ImageInfo(*row) for row in self.db.execute(
+            "SELECT * FROM images %s ORDER BY model, major_version, minor_version, name" % where, args)]
+
+    def image(self, sha256):
+        """ImageInfo, or None if not stored"""
+        ret = self._images("WHERE sha256 = ?", (sha256,))
+        return ret[0] if ret else None
+
+    def resolve(self, ref):
+        """ImageInfo for a sha256, unique sha256 prefix or file name. Raises KeyError"""
+        prefix = ref.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        ret = self._images("WHERE sha256 LIKE ? ESCAPE '\\' OR name = ?", (prefix + "%", ref))
+        if len(ret) != 1:
+            raise KeyError("%s matches %u images" % (ref, len(ret)))
+        return ret[0]
+
+    def images(self, model=None):
+        if model is None:
+            return self._images()
+        return self._images("WHERE model = ?", (model,))
+
+    def latest(self, model=None):
+        """Highest firmware version image, optionally of one model. None if there are none"""
+        where, args = ("", ()) if model is None else ("WHERE model = ?", (model,))
+        row = self.db.execute("SELECT * FROM images %s "
+                              "ORDER BY major_version DESC, minor_version DESC, added DESC LIMIT 1" % where,
+                              args).fetchone()
+        return None if row is None else ImageInfo(*row)
+
+    def containing(self, digest=None, data=None):
+        """
+        Images with a block whose decrypted payload is data, or has digest
+        Return [(ImageInfo, block number), ...]
+        """
+        if digest is None:
+            digest = payload_digest(data)
+        rows = self.db.execute("SELECT images.*, blocks.i FROM blocks "
+                               "JOIN images ON images.sha256 = blocks.image "
+                               "WHERE blocks.digest = ? ORDER BY images.major_version, images.minor_version",
+                               (digest,))
+        return [(ImageInfo(*row[:-1]), row[-1]) for row in rows]
+
+    def at_address(self, address):
+        """[(ImageInfo, block number, payload digest), ...] of the blocks flashed at address"""
+        rows = self.db.execute("SELECT images.*, blocks.i, blocks.digest FROM blocks "
+                               "JOIN images ON images.sha256 = blocks.image "
+                               "WHERE blocks.address = ? ORDER BY images.major_version, images.minor_version",
+                               (address,))
+        return [(ImageInfo(*row[:-2]), row[-2], row[-1]) for row in rows]
+
+    def blocks(self, sha256):
+        """(Block fields, address, digest) rows of an image, in file order"""
+        return self.db.execute("SELECT i, seed, unknown, pad, crc32, address, digest FROM blocks "
+                               "WHERE image = ? ORDER BY i", (sha256,)).fetchall()
+
+    def payload(self, digest):
+        """Decrypted payload for a digest, or None"""
+        row = self.db.execute("SELECT data FROM payloads WHERE digest = ?", (digest,)).fetchone()
+        return None if row is None else row[0]
+
+    def stats(self):
+        images, = self.db.execute("SELECT COUNT(*) FROM images").fetchone()
+        blocks, = self.db.execute("SELECT COUNT(*) FROM blocks").fetchone()
+        payloads, = self.db.execute("SELECT COUNT(*) FROM payloads").fetchone()
+        return {"images": images, "blocks": blocks, "payloads": payloads}
+
+    def export(self, sha256, filename):
+        """Copy an image's .dat file out of the store"""
+        shutil.copyfile(self.object_path(sha256), filename)
+
+def fmt_image(info):
+    return "%s %-4s %u.%02u %5u blocks %s" % (info.sha256[:12], info.model or "?",
+                                               info.major_version, info.minor_version,
+                                               info.num_blocks, info.name)
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Content addressed .dat firmware store")
+    parser.add_argument("--store", help="Store directory (default: %s)" % default_path())
+    parser.add_argument("--key", help="Key file (default: $T48_KEY or key.dat)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("add", help="Ingest .dat files or directories of them")
+    p.add_argument("--model", help="Model of these images (default: guess from file name)")
+    p.add_argument("paths", nargs="+")
+    p = sub.add_parser("list", help="List stored images")
+    p.add_argument("--model")
+    p = sub.add_parser("latest", help="Highest firmware version image")
+    p.add_argument("--model")
+    p = sub.add_parser("find", help="Images containing a decrypted block")
+    p.add_argument("--digest", help="Payload digest, hex")
+    p.add_argument("--bin", help="Flash image (t48decrypt .bin) to take the block at --address from")
+    p.add_argument("--address", type=lambda x: int(x, 0),
+                   help="Flash offset. Alone: every block flashed there")
+    p = sub.add_parser("export", help="Copy an image out of the store")
+    p.add_argument("ref", help="sha256, sha256 prefix or file name")
+    p.add_argument("fn_out")
+    p = sub.add_parser("remove", help="Drop an image from the store")
+    p.add_argument("ref", help="sha256, sha256 prefix or file name")
+    sub.add_parser("stats", help="Index size")
+    args = parser.parse_args()
+
+    ks = t48.load_key(args.key) if args.key else None
+    with FirmwareStore(args.store, ks=ks) as store:
+        if args.cmd == "add":
+            from libxgecu.t48.t48batch import find_inputs
+
+            failed = 0
+            for fn in find_inputs("decrypt", args.paths):
+                try:
+                    info, new = store.add(fn, model=args.model)
+                except ValueError as e:
+                    failed += 1
+                    print("FAIL %s: %s" % (fn, e))
+                    continue
+                print("%s %s" % ("add " if new else "have", fmt_image(info)))
+            sys.exit(1 if failed else 0)
+        elif args.cmd == "list":
+            for info in store.images(args.model):
+                print(fmt_image(info))
+        elif args.cmd == "latest":
+            info = store.latest(args.model)
+            if info is None:
+                sys.exit("No images")
+            print(fmt_image(info))
+        elif args.cmd == "find":
+            if args.digest:
+                digest = bytes.fromhex(args.digest)
+            elif args.bin and args.address is not None:
+                with open(args.bin, "rb") as f:
+                    f.seek(args.address - flash_base)
+                    payl = f.read(PAYLOAD_SIZE)
+                digest = payload_digest(BLOCK_OFFSET.pack(args.address) + payl)
+            elif args.address is not None:
+                for info, i, digest in store.at_address(args.address):
+                    print("%s block %5u %s" % (digest.hex(), i, fmt_image(info)))
+                return
+            else:
+                parser.error("find needs --digest, --bin + --address or --address")
+            for info, i in store.containing(digest):
+                print("block %5u %s" % (i, fmt_image(info)))
+        elif args.cmd in ("export", "remove"):
+            try:
+                sha256 = store.resolve(args.ref).sha256
+            except KeyError as e:
+                sys.exit(e.args[0])
+            if args.cmd == "export":
+                store.export(sha256, args.fn_out)
+            else:
+                store.remove(sha256)
+        elif args.cmd == "stats":
+            for k, v in store.stats().items():
+                print("%s: %u" % (k, v))
+        else:
+            assert 0, args.cmd
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,22 @@
 #!/usr/bin/env python3
 
-from xgecu import t48
+from libxgecu.t48.xgecu import t48
 import time
-import usb1
 
 def main():
     import argparse 
 
     parser = argparse.ArgumentParser(description="Reset programmer")
+    parser.add_argument("--mode", type=int, default=0, choices=(0, 2), help="Reset command variant")
+    parser.add_argument("--poll", action="store_true", help="Poll for the device instead of waiting on hotplug events")
     args = parser.parse_args()
 
-    t = t48.get()
-    t.reset_raw()
-
-    # 1.4 sec
-    tstart = time.time()
-    while True:
-        try:
-            t = t48.get()
-            break
-        except t48.DeviceNotFound:
-            pass
-        except usb1.USBErrorBusy:
-            pass
-        time.sleep(0.05)
-    dt = time.time() - tstart
-    print("Found after %0.1f sec" % dt)
+    with t48.Session() as session:
+        t = session.open()
+        tstart = time.time()
+        t.reset(mode=args.mode, hotplug=not args.poll)
+        dt = time.time() - tstart
+        print("Found after %0.1f sec" % dt)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Decrypt / encrypt many firmware files across a process pool
+"""
+
+import os
+import time
+from collections import namedtuple
+from libxgecu.t48 import t48crypto as t48
+from libxgecu.t48.t48decrypt import decrypt_file
+from libxgecu.t48.t48encrypt import encrypt_file
+
+BatchResult = namedtuple('BatchResult', ['fn_in', 'fn_out', 'ok', 'dt', 'blocks', 'error'])
+
+def _run_job(op, fn_in, fn_out):
+    tstart = time.time()
+    ks = t48.worker_schedule()
+    try:
+        if op == "decrypt":
+            blocks = decrypt_file(fn_in, fn_out, ks=ks)
+        elif op == "encrypt":
+            blocks = encrypt_file(fn_in, fn_out, ks=ks)
+        else:
+            assert 0, op
+        return BatchResult(fn_in, fn_out, True, time.time() - tstart, blocks, None)
+    except Exception as e:
+        return BatchResult(fn_in, fn_out, False, time.time() - tstart, 0,
+                           "%s: %s" % (type(e).__name__, e))
+
+def out_name(op, fn_in, out_dir=None):
+    """
+    decrypt: foo.dat => foo (writes foo.bin + foo.txt)
+    encrypt: foo => foo.dat
+    """
+    if op == "decrypt":
+        base = fn_in[:-4] if fn_in.lower().endswith(".dat") else fn_in
+        ret = base
+    else:
+        ret = fn_in + ".dat"
+    if out_dir:
+        ret = os.path.join(out_dir, os.path.basename(ret))
+    return ret
+
+def find_inputs(op, paths):
+    """Expand directories into .dat files (decrypt) or .txt/.bin base names (encrypt)"""
+    ret = []
+    for path in paths:
+        if not os.path.isdir(path):
+            ret.append(path)
+            continue
+        for fn in sorted(os.listdir(path)):
+            fn = os.path.join(path, fn)
+            if op == "decrypt" and fn.lower().endswith(".dat"):
+                ret.append(fn)
+            elif op == "encrypt" and fn.endswith(".txt") and os.path.exists(fn[:-4] + ".bin"):
+                ret.append(fn[:-4])
+    return ret
+
+def duplicate_outputs(jobs):
+    """{fn_out: [fn_in, ...]} for outputs more than one job would write"""
+    ret = {}
+    for fn_in, fn_out in jobs:
+        ret.setdefault(os.path.normpath(fn_out), []).append(fn_in)
+    return {fn_out: fn_ins for fn_out, fn_ins in ret.items() if len(fn_ins) > 1}
+
+def run_batch(op, jobs, ks=None, workers=None):
+    """
+    Run (fn_in, fn_out) jobs
+    ks: KeySchedule (default: default_schedule()). Loaded here so a bad key fails before any work
+    Yields a BatchResult per file as they complete. A failed file does not stop the batch
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    if ks is None:
+        ks = t48.default_schedule()
+    with ProcessPoolExecutor(max_workers=workers, initializer=t48.init_worker,
+                             initargs=(ks.key,)) as executor:
+        futures = [executor.submit(_run_job, op, fn_in, fn_out) for fn_in, fn_out in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+def main():
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Decrypt / encrypt many firmware files")
+    parser.add_argument("--key", help="Key file (default: $T48_KEY or key.dat)")
+    parser.add_argument("--out-dir", help="Write outputs here instead of next to inputs")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes")
+    parser.add_argument("op", choices=["decrypt", "encrypt"])
+    parser.add_argument("paths", nargs="+", help="Files or directories")
+    args = parser.parse_args()
+
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    inputs = find_inputs(args.op, args.paths)
+    jobs = [(fn_in, out_name(args.op, fn_in, args.out_dir)) for fn_in in inputs]
+    duplicates = duplicate_outputs(jobs)
+    if duplicates:
+        for fn_out, fn_ins in sorted(duplicates.items()):
+            print("%s: written by %s" % (fn_out, ", ".join(fn_ins)))
+        sys.exit("Failed: %u outputs would be written more than once" % len(duplicates))
+    try:
+        ks = t48.load_key(args.key)
+    except (OSError, ValueError) as e:
+        sys.exit("Failed to load key: %s" % e)
+
+    tstart = time.time()
+    failed = 0
+    for result in run_batch(args.op, jobs, ks=ks, workers=args.jobs):
+        if result.ok:
+            print("ok   %0.3f sec %5u blocks %s" % (result.dt, result.blocks, result.fn_in))
+        else:
+            failed += 1
+            print("FAIL %0.3f sec %s: %s" % (result.dt, result.fn_in, result.error))
+    print("%u files, %u failed in %0.1f sec" % (len(jobs), failed, time.time() - tstart))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
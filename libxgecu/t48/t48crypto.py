@@ -1,7 +1,9 @@
 import binascii
+import functools
+import hashlib
+import mmap
+import os
 import struct
-import hexdump
-import glob
 from collections import namedtuple, OrderedDict
 
 
@@ -10,6 +12,11 @@ FileHeader = namedtuple('FileHeader', ['minor_version', 'major_version', 'magic'
                                        'pad','num_blocks'])
 BLOCK = struct.Struct("<IIII 260s")
 Block = namedtuple('Block', ['crc32', 'index', 'unknown', 'pad', 'data'])
+# BLOCK without the data field
+BLOCK_FIELDS = struct.Struct("<IIII")
+BLOCK_DATA_SIZE = BLOCK.size - BLOCK_FIELDS.size
+# key.dat size
+KEY_SIZE = 516
 
 def xorbytes(a, b):
     c = bytearray()
@@ -30,31 +37,114 @@ def swiz(addr):
 def unswiz(addr):
     return ((addr& 0xE0E0E0E0) >> 5) | ((addr & 0x1f1f1f1f) <<  3)
 
+# swiz / unswiz never carry bits between bytes: as bytes.translate() tables
+SWIZ_TABLE = bytes(swiz(b) for b in range(256))
+UNSWIZ_TABLE = bytes(unswiz(b) for b in range(256))
+
 def xor_arrays(a,b):
     return bytes([ a[i] ^ b[i] for i in range(len(a))])
     
 def blk_addr(i):
     return i * 0x100 + 0x08005000
 
-def read_file(filename):
-    with open(filename, "rb") as fil:
-        filedata = fil.read()
+class FirmwareImage:
+    """
+    Memory mapped .dat file
+    Header and block fields are decoded on demand straight from the mapping
+    Blocks returned reference the mapping: copy anything needed after close()
+    """
+    def __init__(self, filename=None, buf=None, verify=True):
+        self.filename = filename
+        self._mm = None
+        if filename is not None:
+            with open(filename, "rb") as fil:
+                self._mm = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+            buf = self._mm
+        self._mv = memoryview(buf).cast("B")
+        self._header = None
 
-        file_header = FileHeader(*FILE_HEADER.unpack(filedata[:FILE_HEADER.size]))
+        try:
+            if len(self._mv) < FILE_HEADER.size:
+                raise ValueError("File too small for header")
+            if len(self._mv) < FILE_HEADER.size + self.num_blocks * BLOCK.size:
+                raise ValueError("File truncated: header claims %u blocks" % self.num_blocks)
+            if verify:
+                self.verify_crc()
+        except Exception:
+            self.close()
+            raise
 
-        blocks = OrderedDict()
-        offset = FILE_HEADER.size
-        for i in range(file_header.num_blocks):
-            block = Block(*BLOCK.unpack(filedata[offset:offset + BLOCK.size]))
-            blocks[i] = block
-            offset += BLOCK.size
-            
-        fcrc = binascii.crc32(filedata[FILE_HEADER.size:]) ^ 0xffffffff
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mv.release()
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # Block views still alive. Mapping goes away with them
+                pass
+            self._mm = None
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = FileHeader(*FILE_HEADER.unpack_from(self._mv, 0))
+        return self._header
+
+    @property
+    def num_blocks(self):
+        return self.header.num_blocks
+
+    def __len__(self):
+        return self.num_blocks
+
+    def blocks_view(self):
+        """Raw view of all blocks, no header"""
+        return self._mv[FILE_HEADER.size:FILE_HEADER.size + self.num_blocks * BLOCK.size]
 
-        if fcrc != file_header.crc32:
+    def block_view(self, i):
+        """Raw BLOCK.size view of block i"""
+        if i < 0:
+            i += self.num_blocks
+        if i < 0 or i >= self.num_blocks:
+            raise IndexError("Block %d out of range" % i)
+        offset = FILE_HEADER.size + i * BLOCK.size
+        return self._mv[offset:offset + BLOCK.size]
+
+    def block(self, i):
+        """Decode block i. data is a view into the mapping"""
+        view = self.block_view(i)
+        return Block(*BLOCK_FIELDS.unpack_from(view), view[BLOCK_FIELDS.size:])
+
+    __getitem__ = block
+
+    def __iter__(self):
+        for i in range(self.num_blocks):
+            yield self.block(i)
+
+    def crc32(self):
+        # File CRC covers everything after the header
+        return binascii.crc32(self._mv[FILE_HEADER.size:]) ^ 0xffffffff
+
+    def verify_crc(self):
+        if self.crc32() != self.header.crc32:
             raise ValueError( "File CRC32 mismatch" )
 
-        return file_header, blocks
+def read_file(filename):
+    """
+    Return (FileHeader, OrderedDict of index => Block)
+    Block data is copied out of the file: iterate a FirmwareImage to avoid that
+    """
+    with FirmwareImage(filename) as image:
+        blocks = OrderedDict()
+        for i, block in enumerate(image):
+            blocks[i] = block._replace(data=bytes(block.data))
+        return image.header, blocks
 
 
 def write_file( filename, hdr, blocks ):
@@ -119,7 +209,8 @@ def swiz_data(data):
         datadf[i:i+4] = struct.pack("<I",d)
     return datadf
 
-def decr_blk(blk):
+def decr_blk_ref(blk):
+    """Per byte reference implementation of decr_blk()"""
     
     # Get the start key index
     kidx = block_key_idx(blk.index)
@@ -129,7 +220,7 @@ def decr_blk(blk):
     hk = struct.pack("<I",swidx)
     
     # Decrypt XOR pad layer
-    dxdata = do_xorpad( blk.data, key, kidx )
+    dxdata = do_xorpad( blk.data, default_key(), kidx )
     
     # Decrypt static XOR layer
     dsdata = do_xorfix( dxdata, hk )
@@ -143,7 +234,8 @@ def decr_blk(blk):
         
     return datadf   
 
-def encr_blk( data, index, unknown, pad ):
+def encr_blk_ref( data, index, unknown, pad ):
+    """Per byte reference implementation of encr_blk()"""
     
     # Get the start key index
     kidx = block_key_idx( index )
@@ -159,15 +251,127 @@ def encr_blk( data, index, unknown, pad ):
     dsdata = do_xorfix( datadf, hk )
     
     # Encrypt XOR pad layer 
-    dxdata = do_xorpad( dsdata, key, kidx )
+    dxdata = do_xorpad( dsdata, default_key(), kidx )
     
     # Compute the checksum
     crc32 = binascii.crc32(data) ^ 0xffffffff
     
     return Block( crc32, index, unknown, pad, dxdata )
 
-with open("key.dat","rb") as kf:
-    key = kf.read(516)
-    
-   
-    
\ No newline at end of file
+class KeySchedule:
+    """
+    Key material expanded once per key
+
+    The xorpad keystream only ever starts at one of 256 key offsets (block_key_idx)
+    Those are precomputed as contiguous slices of xorpad_table
+    Per seed masks (xorpad ^ static XOR word) are kept in a bounded LRU cache
+    so a block crypts with a single XOR
+    """
+    def __init__(self, key, cache_size=4096):
+        self.key = bytes(key)
+        # Short stable key fingerprint, ex: to tag cached ciphertext
+        self.key_id = hashlib.sha256(self.key).digest()[:8]
+        reps = (0xff + BLOCK_DATA_SIZE + len(self.key) - 1) // len(self.key)
+        stream = self.key * reps
+        self.xorpad_table = b"".join(
+            stream[kidx:kidx + BLOCK_DATA_SIZE] for kidx in range(256))
+        view = memoryview(self.xorpad_table)
+        self.xorpads = [view[kidx * BLOCK_DATA_SIZE:(kidx + 1) * BLOCK_DATA_SIZE]
+                        for kidx in range(256)]
+        self.mask = functools.lru_cache(maxsize=cache_size)(self._mask)
+
+    def xorpad(self, seed):
+        return self.xorpads[block_key_idx(seed)]
+
+    def static_key(self, seed):
+        """Static XOR word repeated over the block"""
+        return get_l2_key(seed) * (BLOCK_DATA_SIZE // 4)
+
+    def _mask(self, seed):
+        return (int.from_bytes(self.xorpad(seed), "little")
+                ^ int.from_bytes(self.static_key(seed), "little"))
+
+    def decrypt(self, data, seed):
+        d = int.from_bytes(data, "little") ^ self.mask(seed)
+        return d.to_bytes(BLOCK_DATA_SIZE, "little").translate(UNSWIZ_TABLE)
+
+    def encrypt(self, data, seed):
+        d = int.from_bytes(bytes(data).translate(SWIZ_TABLE), "little") ^ self.mask(seed)
+        return d.to_bytes(BLOCK_DATA_SIZE, "little")
+
+class KeyProvider:
+    """
+    Finds and loads the key on first use
+    Search order: explicit filename, $T48_KEY, ./key.dat, key.dat next to this module
+    """
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._key = None
+        self._schedule = None
+
+    def filename(self):
+        if self._filename:
+            return self._filename
+        candidates = [os.environ.get("T48_KEY"), "key.dat",
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)), "key.dat")]
+        for fn in candidates:
+            if fn and os.path.exists(fn):
+                return fn
+        raise FileNotFoundError("key.dat not found (set $T48_KEY)")
+
+    def key(self):
+        if self._key is None:
+            fn = self.filename()
+            with open(fn, "rb") as kf:
+                key = kf.read(KEY_SIZE)
+            if len(key) != KEY_SIZE:
+                raise ValueError("%s: %u byte key, expected %u" % (fn, len(key), KEY_SIZE))
+            self._key = key
+        return self._key
+
+    def schedule(self):
+        if self._schedule is None:
+            self._schedule = KeySchedule(self.key())
+        return self._schedule
+
+_provider = KeyProvider()
+
+def set_key_provider(provider):
+    """Replace the provider behind default_key() / default_schedule()"""
+    global _provider
+    _provider = provider
+
+def default_key():
+    return _provider.key()
+
+def default_schedule():
+    return _provider.schedule()
+
+def load_key(filename=None):
+    """Return a KeySchedule for the key file (None: default search)"""
+    return KeyProvider(filename).schedule()
+
+# KeySchedule of a pool worker process, built once by init_worker()
+_worker_schedule = None
+
+def init_worker(key):
+    """ProcessPoolExecutor initializer, initargs=(ks.key,): key bytes, so the key file is read once by the parent"""
+    global _worker_schedule
+    _worker_schedule = KeySchedule(key)
+
+def worker_schedule():
+    return _worker_schedule
+
+def decr_blk(blk, ks=None):
+    if ks is None:
+        ks = default_schedule()
+    data = ks.decrypt(blk.data, blk.index)
+    if blk.crc32 != (binascii.crc32(data) ^ 0xffffffff):
+        raise ValueError("Block checksum mismatch")
+    return data
+
+def encr_blk( data, index, unknown, pad, ks=None ):
+    if ks is None:
+        ks = default_schedule()
+    crc32 = binascii.crc32(data) ^ 0xffffffff
+    return Block( crc32, index, unknown, pad, ks.encrypt(data, index) )
@@ -0,0 +1,125 @@
+"""
+Batched NumPy engine for the t48crypto block layers
+
+All blocks of an image are handled at once as a (num_blocks, 260) uint8 array
+instead of per byte in the interpreter.
+t48crypto.decr_blk_ref / encr_blk_ref remain the reference implementation
+"""
+import binascii
+import numpy as np
+from libxgecu.t48 import t48crypto as t48
+
+BLOCK_DATA_SIZE = t48.BLOCK_DATA_SIZE
+
+SWIZ = np.frombuffer(t48.SWIZ_TABLE, dtype=np.uint8)
+UNSWIZ = np.frombuffer(t48.UNSWIZ_TABLE, dtype=np.uint8)
+
+
+def seed_array(seeds):
+    return np.asarray(seeds, dtype=np.uint32)
+
+def xorpad_rows(seeds, ks):
+    """Per block xorpad keystream as a (n, 260) array"""
+    table = np.frombuffer(ks.xorpad_table, dtype=np.uint8).reshape(256, BLOCK_DATA_SIZE)
+    kidx = ((seeds >> 8) + (seeds & 0xff)) & 0xff
+    return table[kidx]
+
+def xorfix_rows(seeds):
+    """Per block static XOR word repeated across the row as a (n, 260) array"""
+    hk = ((seeds & 0x07070707) << 5) | ((seeds & 0xf8f8f8f8) >> 3)
+    hk = hk.astype("<u4").view(np.uint8).reshape(-1, 4)
+    return np.tile(hk, (1, BLOCK_DATA_SIZE // 4))
+
+def mask_rows(seeds, ks):
+    """Combined xorpad + static XOR layers"""
+    return xorpad_rows(seeds, ks) ^ xorfix_rows(seeds)
+
+def decr_array(data, seeds, ks=None):
+    """
+    Decrypt a (n, 260) uint8 array of block data
+    seeds: per row block index
+    """
+    if ks is None:
+        ks = t48.default_schedule()
+    seeds = seed_array(seeds)
+    return UNSWIZ[data ^ mask_rows(seeds, ks)]
+
+def encr_array(data, seeds, ks=None):
+    """
+    Encrypt a (n, 260) uint8 array of plaintext block data
+    seeds: per row block index
+    """
+    if ks is None:
+        ks = t48.default_schedule()
+    seeds = seed_array(seeds)
+    return SWIZ[data] ^ mask_rows(seeds, ks)
+
+def blocks_array(blocks):
+    """Pack the data fields of Blocks into a (n, 260) array"""
+    buf = b"".join(bytes(blk.data) for blk in blocks)
+    return np.frombuffer(buf, dtype=np.uint8).reshape(-1, BLOCK_DATA_SIZE)
+
+def u4_columns(rows, size):
+    """Leading size bytes of each row of a (n, m) u8 array as a (n, size / 4) little endian u32 array"""
+    # Viewing a strided slice as u4 needs numpy >= 1.23: copy the columns
+    return np.ascontiguousarray(rows[:, :size]).view("<u4")
+
+def block_arrays(buf):
+    """
+    Arrays over a raw block buffer (no file header)
+    Return (crc32s, seeds, data) where data is a zero copy (n, 260) view
+    """
+    raw = np.frombuffer(buf, dtype=np.uint8).reshape(-1, t48.BLOCK.size)
+    fields = u4_columns(raw, t48.BLOCK_FIELDS.size)
+    return fields[:, 0], fields[:, 1], raw[:, t48.BLOCK_FIELDS.size:]
+
+def image_arrays(image):
+    """block_arrays() over a FirmwareImage"""
+    return block_arrays(image.blocks_view())
+
+def bad_crcs(data, crcs):
+    """Row numbers of a (n, 260) decrypted array whose CRC doesn't match"""
+    # CRC32 itself can't be vectorized, but the compare can
+    got = np.fromiter(map(binascii.crc32, data), dtype=np.uint32, count=len(data))
+    return np.flatnonzero((got ^ 0xffffffff) != np.asarray(crcs, dtype=np.uint32)).tolist()
+
+def check_crcs(data, crcs):
+    bad = bad_crcs(data, crcs)
+    if bad:
+        raise ValueError("Block checksum mismatch (block %u)" % bad[0])
+
+def decr_blks(blocks, ks=None):
+    """
+    Batched decr_blk()
+    Return (n, 260) array of decrypted block data, one row per block
+    """
+    blocks = list(blocks)
+    data = blocks_array(blocks)
+    ret = decr_array(data, [blk.index for blk in blocks], ks=ks)
+    check_crcs(ret, [blk.crc32 for blk in blocks])
+    return ret
+
+def decr_image(image, ks=None):
+    """
+    Decrypt every block of a FirmwareImage
+    Return (n, 260) array of decrypted block data
+    """
+    crcs, seeds, data = image_arrays(image)
+    ret = decr_array(data, seeds, ks=ks)
+    check_crcs(ret, crcs)
+    return ret
+
+def encr_blks(datas, indexes, unknowns, pads, ks=None):
+    """
+    Batched encr_blk()
+    datas: iterable of 260 byte plaintext block data
+    Return list of Block
+    """
+    datas = [bytes(data) for data in datas]
+    data = np.frombuffer(b"".join(datas), dtype=np.uint8).reshape(-1, BLOCK_DATA_SIZE)
+    enc = encr_array(data, indexes, ks=ks)
+    ret = []
+    for plain, row, index, unknown, pad in zip(datas, enc, indexes, unknowns, pads):
+        crc32 = binascii.crc32(plain) ^ 0xffffffff
+        ret.append(t48.Block(crc32, index, unknown, pad, row.tobytes()))
+    return ret
@@ -1,34 +1,161 @@
-import t48crypto as t48
-import sys
+from libxgecu.t48 import t48crypto as t48
+import hashlib
 import struct
 
-def print_hdr( file, hdr ):
-    print( "HEADER Major=0x%02X Minor=0x%02X Magic=0x%04X Pad=0x%08X"%(
-        hdr.major_version,hdr.minor_version,hdr.magic,hdr.pad), file=file )
+flash_base = 0x08000000
+# Decrypted block data is a flash offset followed by the payload
+BLOCK_OFFSET = struct.Struct("<I")
+PAYLOAD_SIZE = t48.BLOCK_DATA_SIZE - BLOCK_OFFSET.size
+PAYLOAD_DIGEST_SIZE = 16
 
-def print_blk( file, blk, offset ):
-    print( "BLOCK Seed=0x%08X Unk=0x%08X Pad=0x%08X Offset=0x%08X"%(
-            blk.index, blk.unknown, blk.pad, offset), file=file )
+def payload_digest( data ):
+    """Digest of a decrypted block (flash offset + payload)"""
+    return hashlib.blake2b( data, digest_size=PAYLOAD_DIGEST_SIZE ).digest()
 
-file_in = sys.argv[1]
-file_out = sys.argv[2]
+def fmt_hdr( hdr ):
+    return "HEADER Major=0x%02X Minor=0x%02X Magic=0x%04X Pad=0x%08X\n"%(
+        hdr.major_version,hdr.minor_version,hdr.magic,hdr.pad)
 
-bin_out = file_out + ".bin"
-txt_out = file_out + ".txt"
+def fmt_blk( blk, offset ):
+    return "BLOCK Seed=0x%08X Unk=0x%08X Pad=0x%08X Offset=0x%08X\n"%(
+            blk.index, blk.unknown, blk.pad, offset)
 
-hdr, blocks = t48.read_file( file_in )
+def decrypt_blocks( blocks, ks=None ):
+    """
+    Decrypt stage
+    Yield (blk, flash_offset, payload) per block. payload is a view, no copy
+    """
+    for blk in blocks:
+        data = t48.decr_blk( blk, ks=ks )
+        offset, = BLOCK_OFFSET.unpack_from( data )
+        yield blk, offset, memoryview( data )[BLOCK_OFFSET.size:]
 
-flash_base = 0x08000000
+def payloads( decrypted ):
+    """Drop block metadata: yield (flash_offset, payload)"""
+    for _blk, offset, payl in decrypted:
+        yield offset, payl
+
+class ImageSink:
+    """
+    Place payloads into one in memory flash image, written out in a single write
+    Image covers up to the highest block, gaps are 0 as with seek() + write()
+    blocks: expected number of blocks. The first block reserves room for that many after it,
+    so a sequential image is allocated once instead of growing block by block
+    """
+    def __init__( self, base=flash_base, size=0, blocks=0 ):
+        self.base = base
+        self.image = bytearray( size )
+        # Image size to write out
+        self.end = size
+        self.blocks = blocks
+
+    def place( self, offset, payl ):
+        start = offset - self.base
+        end = start + len(payl)
+        if start < 0:
+            raise ValueError("Block offset 0x%08X below flash base 0x%08X" % (offset, self.base))
+        if end > len(self.image):
+            size = end
+            if self.blocks:
+                size = max( end, start + self.blocks * len(payl) )
+                self.blocks = 0
+            if self.image:
+                self.image.extend( bytes(size - len(self.image)) )
+            else:
+                self.image = bytearray( size )
+        if end > self.end:
+            self.end = end
+        self.image[start:end] = payl
+
+    def consume( self, pairs ):
+        for offset, payl in pairs:
+            self.place( offset, payl )
+        return self
+
+    def write_to( self, f ):
+        f.write( memoryview(self.image)[:self.end] )
+
+class CoalescingWriter:
+    """
+    Stream (flash_offset, payload) pairs to a file without holding the image
+    Contiguous payloads are merged into writes of up to max_size bytes
+    """
+    def __init__( self, f, base=flash_base, max_size=1 << 20 ):
+        self.f = f
+        self.base = base
+        self.max_size = max_size
+        self.start = None
+        self.buf = bytearray()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.flush()
+
+    def write( self, offset, payl ):
+        if offset < self.base:
+            raise ValueError("Block offset 0x%08X below flash base 0x%08X" % (offset, self.base))
+        if self.start is None or offset != self.start + len(self.buf) or len(self.buf) >= self.max_size:
+            self.flush()
+            self.start = offset
+        self.buf += payl
+
+    def consume( self, pairs ):
+        for offset, payl in pairs:
+            self.write( offset, payl )
+        self.flush()
+
+    def flush( self ):
+        if self.buf:
+            self.f.seek( self.start - self.base )
+            self.f.write( self.buf )
+        self.start = None
+        self.buf = bytearray()
+
+def decrypt_file( file_in, file_out, ks=None, stream=False ):
+    """
+    Decrypt .dat file_in into file_out.bin (flash image) + file_out.txt (block metadata)
+    stream: write the flash image as blocks are decrypted (CoalescingWriter)
+        instead of assembling it in memory (ImageSink)
+    Return number of blocks
+    """
+    bin_out = file_out + ".bin"
+    txt_out = file_out + ".txt"
+
+    with t48.FirmwareImage( file_in ) as image:
+        meta = [ fmt_hdr( image.header ) ]
+        if stream:
+            with open(bin_out, "wb") as binf, CoalescingWriter( binf ) as writer:
+                for blk, offset, payl in decrypt_blocks( image, ks=ks ):
+                    meta.append( fmt_blk( blk, offset ) )
+                    writer.write( offset, payl )
+        else:
+            sink = ImageSink( blocks=image.num_blocks )
+            for blk, offset, payl in decrypt_blocks( image, ks=ks ):
+                meta.append( fmt_blk( blk, offset ) )
+                sink.place( offset, payl )
+        num_blocks = image.num_blocks
+
+    with open(txt_out, "w") as txtf:
+        txtf.write( "".join(meta) )
+    if not stream:
+        with open(bin_out, "wb") as binf:
+            sink.write_to( binf )
+    return num_blocks
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decrypt a T48 firmware .dat file")
+    parser.add_argument("--key", help="Key file (default: $T48_KEY or key.dat)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write the flash image as it is decrypted instead of holding it in memory")
+    parser.add_argument("file_in", help="Encrypted .dat file")
+    parser.add_argument("file_out", help="Output base name (writes .bin and .txt)")
+    args = parser.parse_args()
 
-with open(txt_out,"w") as txtf:
-    with open(bin_out, "wb") as binf:
-        print_hdr( txtf, hdr )
-        for i in blocks:
-            blk = blocks[i]
-            data = t48.decr_blk( blk )
-            offset, payl = struct.unpack("<I 256s", data)
-            print_blk( txtf, blk, offset )
-            file_offset = offset - flash_base
-            binf.seek( file_offset )
-            binf.write( payl )
+    decrypt_file( args.file_in, args.file_out, ks=t48.load_key(args.key), stream=args.stream )
 
+if __name__ == "__main__":
+    main()
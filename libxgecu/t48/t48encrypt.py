@@ -1,7 +1,8 @@
-import t48crypto as t48
-import sys
+from libxgecu.t48 import t48crypto as t48
 import struct
 
+flash_base = 0x08000000
+
 def print_hdr( file, hdr ):
     print( "HEADER Major=0x%02X Minor=0x%02X Magic=0x%04X Pad=0x%08X"%(
         hdr.major_version,hdr.minor_version,hdr.magic,hdr.pad), file=file )
@@ -25,18 +26,14 @@ def print_blk( file, blk, offset ):
     print( "BLOCK Seed=0x%08X Unk=0x%08X Pad=0x%08X Offset=0x%08X"%(
             blk.index, blk.unknown, blk.pad, offset), file=file )
 
-file_in = sys.argv[1]
-
-bin_in = file_in + ".bin"
-txt_in = file_in + ".txt"
-enc_out = file_in + ".dat"
-
-flash_base = 0x08000000
-
-hdr = None
-blocks = []
-with open(txt_in, "r") as txtf:
-    with open(bin_in, "rb") as binf:
+def read_manifest( txt_in ):
+    """
+    Parse block metadata (.txt written by t48decrypt)
+    Return (FileHeader, list of BLOCK line key/values)
+    """
+    hdr = None
+    blocks = []
+    with open(txt_in, "r") as txtf:
         for l in txtf:
             a = parse_line(l)
             if a is None:
@@ -45,12 +42,71 @@ with open(txt_in, "r") as txtf:
             if what == "HEADER":
                 hdr = t48.FileHeader(kv["Minor"],kv["Major"],kv["Magic"],0,kv["Pad"],0)
             elif what == "BLOCK":
-                offset = kv["Offset"]
-                file_offset = offset - flash_base
-                binf.seek( file_offset )
-                payl = binf.read( 256 )
-                data = struct.pack( "<I 256s", offset, payl )
-                blk = t48.encr_blk( data, kv["Seed"], kv["Unk"], kv["Pad"] )
-                blocks.append(blk)
-                
-t48.write_file( enc_out, hdr, blocks )
+                blocks.append(kv)
+    if hdr is None:
+        raise ValueError("%s: missing HEADER line" % txt_in)
+    return hdr, blocks
+
+def encrypt_blocks( flash, manifest, ks=None, cache=None ):
+    """
+    Yield an encrypted Block per manifest entry, payloads taken from the flash image
+    cache: optional blockcache.BlockCache, only runs of blocks that changed are re-encrypted
+    """
+    items = plaintext_blocks( flash, manifest )
+    if cache is not None:
+        yield from cache.encr_blks( items, ks=ks )
+        return
+    for data, index, unknown, pad in items:
+        yield t48.encr_blk( data, index, unknown, pad, ks=ks )
+
+def plaintext_blocks( flash, manifest ):
+    """Yield (data, seed, unknown, pad) per manifest entry, payloads taken from the flash image"""
+    for kv in manifest:
+        offset = kv["Offset"]
+        file_offset = offset - flash_base
+        payl = flash[file_offset:file_offset + 256]
+        yield struct.pack( "<I 256s", offset, payl ), kv["Seed"], kv["Unk"], kv["Pad"]
+
+def encrypt_file( file_in, file_out=None, ks=None, cache=None ):
+    """
+    Encrypt file_in.bin (flash image) + file_in.txt (block metadata) into a .dat file
+    file_out defaults to file_in.dat
+    cache: optional blockcache.BlockCache, only runs of blocks that changed are re-encrypted
+    Return number of blocks
+    """
+    bin_in = file_in + ".bin"
+    txt_in = file_in + ".txt"
+    enc_out = file_in + ".dat" if file_out is None else file_out
+
+    hdr, manifest = read_manifest( txt_in )
+    with open(bin_in, "rb") as binf:
+        flash = binf.read()
+    blocks = list( encrypt_blocks( flash, manifest, ks=ks, cache=cache ) )
+
+    t48.write_file( enc_out, hdr, blocks )
+    return len(blocks)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Encrypt a T48 firmware image into a .dat file")
+    parser.add_argument("--key", help="Key file (default: $T48_KEY or key.dat)")
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse encrypted blocks of unchanged plaintext from an on disk cache")
+    parser.add_argument("--cache-file", help="Cache location (default: ~/.cache/libxgecu/blocks.sqlite)")
+    parser.add_argument("file_in", help="Input base name (reads .bin and .txt)")
+    parser.add_argument("file_out", nargs="?", help="Output .dat file (default: file_in.dat)")
+    args = parser.parse_args()
+
+    ks = t48.load_key(args.key)
+    if not (args.cache or args.cache_file):
+        encrypt_file( args.file_in, args.file_out, ks=ks )
+    else:
+        from libxgecu.t48.blockcache import BlockCache
+
+        with BlockCache( args.cache_file ) as cache:
+            n = encrypt_file( args.file_in, args.file_out, ks=ks, cache=cache )
+        print( "%u blocks, %u cached, %u encrypted" % (n, cache.hits, cache.misses) )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Verify .dat firmware images without writing anything
+
+Checks the file CRC, every block CRC and the flash offset sequence (overlaps, gaps)
+Large images are split into block ranges checked across worker processes,
+which all read the one copy of the file from shared memory
+"""
+
+import binascii
+import os
+import time
+from collections import namedtuple
+from libxgecu.t48 import t48crypto as t48
+from libxgecu.t48.t48decrypt import BLOCK_OFFSET, PAYLOAD_SIZE, flash_base
+
+# Below this many blocks per worker, process startup costs more than it saves
+MIN_BLOCKS_PER_WORKER = 8192
+# Blocks decrypted per batch
+SCRATCH_BLOCKS = 1024
+
+# kind: "size", "empty", "file_crc", "block_crc", "offset", "overlap" (errors) or "gap" (warning)
+# block: block number, or None for whole file problems. offset: flash offset, if known
+Problem = namedtuple('Problem', ['kind', 'block', 'offset', 'detail'])
+# ranges: contiguous flash ranges covered, [(start, end), ...]
+Report = namedtuple('Report', ['filename', 'header', 'ok', 'num_blocks', 'ranges',
+                               'errors', 'warnings', 'dt'])
+
+def check_blocks(blocks_buf, start, end, ks):
+    """
+    Decrypt blocks [start, end) of a raw block buffer (no file header)
+    Return flash offset per block, None where the block CRC is bad
+    """
+    try:
+        from libxgecu.t48 import t48crypto_np
+    except ImportError:
+        t48crypto_np = None
+
+    ret = []
+    view = memoryview(blocks_buf)
+    for batch in range(start, end, SCRATCH_BLOCKS):
+        batch_end = min(batch + SCRATCH_BLOCKS, end)
+        raw = view[batch * t48.BLOCK.size:batch_end * t48.BLOCK.size]
+        if t48crypto_np is not None:
+            crcs, seeds, encrypted = t48crypto_np.block_arrays(raw)
+            data = t48crypto_np.decr_array(encrypted, seeds, ks=ks)
+            offsets = t48crypto_np.u4_columns(data, BLOCK_OFFSET.size)[:, 0].tolist()
+            for i in t48crypto_np.bad_crcs(data, crcs):
+                offsets[i] = None
+            ret += offsets
+        else:
+            for pos in range(0, len(raw), t48.BLOCK.size):
+                crc32, seed, _unknown, _pad = t48.BLOCK_FIELDS.unpack_from(raw, pos)
+                data = ks.decrypt(raw[pos + t48.BLOCK_FIELDS.size:pos + t48.BLOCK.size], seed)
+                if crc32 != (binascii.crc32(data) ^ 0xffffffff):
+                    ret.append(None)
+                else:
+                    ret.append(BLOCK_OFFSET.unpack_from(data)[0])
+    return ret
+
+def _check_job(source, blocks_start, blocks_size, start, end):
+    """source: ("file", path) or ("shm", shared memory name)"""
+    kind, name = source
+    if kind == "file":
+        import mmap
+
+        with open(name, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = mm
+    else:
+        from multiprocessing import shared_memory
+
+        mm = shared_memory.SharedMemory(name=name)
+        buf = mm.buf
+    try:
+        view = memoryview(buf)[blocks_start:blocks_start + blocks_size]
+        try:
+            return start, check_blocks(view, start, end, t48.worker_schedule())
+        finally:
+            view.release()
+    finally:
+        mm.close()
+
+def auto_workers(num_blocks):
+    return max(1, min(os.cpu_count() or 1, num_blocks // MIN_BLOCKS_PER_WORKER))
+
+def check_blocks_parallel(buf, blocks_start, num_blocks, ks, workers, path=None):
+    """
+    check_blocks() over all blocks, split in ranges across workers processes
+    path: file buf is mapped from. Workers map it themselves, else buf is copied to shared memory
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    blocks_size = num_blocks * t48.BLOCK.size
+    shm = None
+    if path is not None:
+        source = ("file", path)
+    else:
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(create=True, size=max(blocks_size, 1))
+        shm.buf[:blocks_size] = memoryview(buf)[blocks_start:blocks_start + blocks_size]
+        source = ("shm", shm.name)
+        blocks_start = 0
+    try:
+        # A few ranges per worker evens out uneven progress
+        step = max(1, -(-num_blocks // (workers * 4)))
+        offsets = [None] * num_blocks
+        with ProcessPoolExecutor(max_workers=workers, initializer=t48.init_worker,
+                                 initargs=(ks.key,)) as executor:
+            futures = [executor.submit(_check_job, source, blocks_start, blocks_size, start,
+                                       min(start + step, num_blocks))
+                       for start in range(0, num_blocks, step)]
+            for future in futures:
+                start, part = future.result()
+                offsets[start:start + len(part)] = part
+        return offsets
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+def offset_problems(offsets):
+    """
+    Check the flash offsets of the good blocks
+    Return (errors, warnings, covered ranges)
+    """
+    errors = []
+    warnings = []
+    ranges = []
+    placed = sorted((offset, i) for i, offset in enumerate(offsets) if offset is not None)
+    prev = None
+    for offset, i in placed:
+        if offset < flash_base:
+            errors.append(Problem("offset", i, offset, "below flash base 0x%08X" % flash_base))
+        if prev is not None:
+            prev_offset, prev_i = prev
+            end = prev_offset + PAYLOAD_SIZE
+            if offset < end:
+                errors.append(Problem("overlap", i, offset, "overlaps block %u at 0x%08X" % (prev_i, prev_offset)))
+            elif offset > end and not (i > 0 and offsets[i - 1] is None):
+                # Right after a bad block the gap is most likely that block's payload
+                warnings.append(Problem("gap", i, end, "0x%X bytes not covered before block %u" % (
+                    offset - end, i)))
+        if ranges and offset <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], offset + PAYLOAD_SIZE))
+        else:
+            ranges.append((offset, offset + PAYLOAD_SIZE))
+        prev = (offset, i)
+    return errors, warnings, ranges
+
+def verify_buffer(buf, filename=None, ks=None, workers=None, path=None):
+    """
+    Verify a .dat image in memory. Return a Report
+    ks: KeySchedule (default: default_schedule())
+    workers: processes to check blocks with. Default: by image size, 1 checks in this process
+    path: file buf is mapped from, if any, so workers can map it instead of getting a copy
+    """
+    tstart = time.time()
+    if ks is None:
+        ks = t48.default_schedule()
+    errors = []
+    buf = memoryview(buf).cast("B")
+    if len(buf) < t48.FILE_HEADER.size:
+        errors.append(Problem("size", None, None, "%u bytes, too small for the header" % len(buf)))
+        return Report(filename, None, False, 0, [], errors, [], time.time() - tstart)
+
+    hdr = t48.FileHeader(*t48.FILE_HEADER.unpack_from(buf))
+    # Check the whole blocks there are, even if the file is short
+    num_blocks = min(hdr.num_blocks, (len(buf) - t48.FILE_HEADER.size) // t48.BLOCK.size)
+    if num_blocks < hdr.num_blocks:
+        errors.append(Problem("size", None, None, "truncated: header claims %u blocks, file has %u" % (
+            hdr.num_blocks, num_blocks)))
+    if hdr.num_blocks == 0:
+        errors.append(Problem("empty", None, None, "image has no blocks"))
+    crc32 = binascii.crc32(buf[t48.FILE_HEADER.size:]) ^ 0xffffffff
+    if crc32 != hdr.crc32:
+        errors.append(Problem("file_crc", None, None, "file CRC32 0x%08X, header says 0x%08X" % (
+            crc32, hdr.crc32)))
+
+    if workers is None:
+        workers = auto_workers(num_blocks)
+    if workers <= 1 or num_blocks < 2:
+        blocks = buf[t48.FILE_HEADER.size:t48.FILE_HEADER.size + num_blocks * t48.BLOCK.size]
+        offsets = check_blocks(blocks, 0, num_blocks, ks)
+    else:
+        offsets = check_blocks_parallel(buf, t48.FILE_HEADER.size, num_blocks, ks, workers,
+                                        path=path)
+    for i, offset in enumerate(offsets):
+        if offset is None:
+            errors.append(Problem("block_crc", i, None, "block CRC32 mismatch"))
+
+    offset_errors, warnings, ranges = offset_problems(offsets)
+    errors += offset_errors
+    return Report(filename, hdr, not errors, hdr.num_blocks, ranges, errors, warnings,
+                  time.time() - tstart)
+
+def verify_file(filename, ks=None, workers=None):
+    """Verify a .dat file. Return a Report"""
+    import mmap
+
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return verify_buffer(b"", filename=filename, ks=ks, workers=workers)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                return verify_buffer(view, filename=filename, ks=ks, workers=workers,
+                                     path=filename)
+            finally:
+                view.release()
+
+def fmt_problem(problem):
+    where = []
+    if problem.block is not None:
+        where.append("block %u" % problem.block)
+    if problem.offset is not None:
+        where.append("0x%08X" % problem.offset)
+    return "%s%s: %s" % (problem.kind, " (%s)" % ", ".join(where) if where else "", problem.detail)
+
+def report_dict(report):
+    """JSON friendly Report"""
+    return {
+        "file": report.filename,
+        "header": None if report.header is None else report.header._asdict(),
+        "ok": report.ok,
+        "num_blocks": report.num_blocks,
+        "ranges": [list(r) for r in report.ranges],
+        "errors": [problem._asdict() for problem in report.errors],
+        "warnings": [problem._asdict() for problem in report.warnings],
+        "dt": report.dt,
+    }
+
+def main():
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(description="Verify .dat firmware images (CRCs, block offsets)")
+    parser.add_argument("--key", help="Key file (default: $T48_KEY or key.dat)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Worker processes per image (default: by image size)")
+    parser.add_argument("--strict", action="store_true", help="Fail on warnings (gaps) too")
+    parser.add_argument("--json", action="store_true", help="Print reports as JSON")
+    parser.add_argument("files", nargs="+", help=".dat files")
+    args = parser.parse_args()
+
+    ks = t48.load_key(args.key)
+    reports = [verify_file(fn, ks=ks, workers=args.jobs) for fn in args.files]
+    failed = [not r.ok or bool(args.strict and r.warnings) for r in reports]
+    if args.json:
+        print(json.dumps([report_dict(r) for r in reports], indent=4))
+    else:
+        for r, fail in zip(reports, failed):
+            version = "" if r.header is None else " %u.%02u" % (r.header.major_version, r.header.minor_version)
+            print("%-4s %s%s %u blocks, %u errors, %u warnings (%0.3f sec)" % (
+                "FAIL" if fail else "ok", r.filename, version, r.num_blocks,
+                len(r.errors), len(r.warnings), r.dt))
+            for problem in r.errors + r.warnings:
+                print("    %s" % fmt_problem(problem))
+    sys.exit(1 if any(failed) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,92 @@
 #!/usr/bin/env python3
 
-from libxgecu.t48.xgecu import t48
 import time
-import usb1
-import click
-from more_itertools import batched
+from collections import namedtuple
+from libxgecu.t48.xgecu import t48, timeouts
+from libxgecu.t48.xgecu.util import prefetch
+from libxgecu.t48 import t48crypto
 
-def replay(t, firmware_binary):
-    dev = t.dev
-    validate_read = t48.validate_read
+def dat_records(firmware_binary):
+    """Yield the BLOCK records of a .dat image. The file header is not sent"""
+    for pos in range(t48crypto.FILE_HEADER.size, len(firmware_binary), t48crypto.BLOCK.size):
+        yield bytes(firmware_binary[pos:pos + t48crypto.BLOCK.size])
+
+def plaintext_records(flash, manifest, ks=None):
+    """
+    Yield BLOCK records encrypted just in time from a plaintext flash image
+    manifest: BLOCK entries from t48encrypt.read_manifest()
+    """
+    from libxgecu.t48 import t48encrypt
 
-    def bulkRead(endpoint, length, timeout=None):
-        return dev.bulkRead(endpoint, length, timeout=(1000 if timeout is None else timeout))
+    for blk in t48encrypt.encrypt_blocks(flash, manifest, ks=ks):
+        yield t48crypto.BLOCK.pack(*blk)
 
-    def bulkWrite(endpoint, data, timeout=None):
-        dev.bulkWrite(endpoint, data, timeout=(1000 if timeout is None else timeout))
+class PreflightError(ValueError):
+    pass
 
-    def controlRead(bRequestType, bRequest, wValue, wIndex, wLength,
-                    timeout=None):
-        return dev.controlRead(bRequestType, bRequest, wValue, wIndex, wLength,
-                    timeout=(1000 if timeout is None else timeout))
+def preflight(firmware_binary, ks=None):
+    """
+    Check a .dat image before touching the device, see t48verify
+    Raise PreflightError on a bad image, else return its FileHeader
+    """
+    from libxgecu.t48 import t48verify
 
-    def controlWrite(bRequestType, bRequest, wValue, wIndex, data,
-                     timeout=None):
-        dev.controlWrite(bRequestType, bRequest, wValue, wIndex, data,
-                     timeout=(1000 if timeout is None else timeout))
+    report = t48verify.verify_buffer(firmware_binary, ks=ks)
+    if not report.ok:
+        msg = t48verify.fmt_problem(report.errors[0])
+        if len(report.errors) > 1:
+            msg += " (+%u more)" % (len(report.errors) - 1)
+        raise PreflightError(msg)
+    return report.header
 
-    def interruptRead(endpoint, size, timeout=None):
-        return dev.interruptRead(endpoint, size,
-                    timeout=(1000 if timeout is None else timeout))
+def is_current(version, hdr):
+    """True if parse_version() version is already the FileHeader hdr firmware"""
+    return (version["ver_major"], version["ver_minor"]) == (hdr.major_version, hdr.minor_version)
 
-    def interruptWrite(endpoint, data, timeout=None):
-        dev.interruptWrite(endpoint, data, timeout=(1000 if timeout is None else timeout))
+def fmt_fw(major, minor):
+    return "%u.%02u" % (major, minor)
+
+"""
+What to do when the device doesn't ack as expected
+session_retries: recover the device and restart the whole update up to this many times
+A single chunk is never resent: the device may already have written it,
+and could take the second copy as the next block
+"""
+RetryPolicy = namedtuple('RetryPolicy', ['session_retries'])
+NO_RETRY = RetryPolicy(0)
+
+def send_chunks(t, packets):
+    """
+    Lock-step upload: every chunk is acked before the next one is sent
+    Strict (t.strict): a bad ack raises ValidateError, a timeout raises as is
+    Otherwise bad acks are printed and the upload carries on, like the original capture
+    """
+    bulkRead = t.bulkRead
+    bulkWrite = t.bulkWrite
+    ack = t48.ACK_3B
+    strict = t.strict
+    for seq, packet in enumerate(packets):
+        bulkWrite(0x01, packet)
+        buff = bulkRead(0x81, 0x0200)
+        if buff != ack:
+            t48.validate_read(ack, buff, "chunk %u" % seq, strict=strict)
+
+def replay(t, records, window=0):
+    """
+    records: iterable of BLOCK records to send, or a whole .dat image
+    window: if set, keep this many chunks in flight using async transfers instead of lock-step
+        Stops at the first bad chunk
+    """
+    if isinstance(records, (bytes, bytearray)):
+        records = dat_records(records)
+    dev = t.dev
+    strict = t.strict
+
+    def validate_read(expected, actual, msg):
+        return t48.validate_read(expected, actual, msg, strict=strict)
+    # Go through T48 so calls show up in its metrics
+    bulkRead = t.bulkRead
+    bulkWrite = t.bulkWrite
 
     # Generated by usbrply
     # Source: Linux pcap (usbmon)
@@ -85,25 +140,30 @@ def replay(t, firmware_binary):
     # Generated from packet 111/112
     bulkWrite(0x01, b"\x3C\x00\x00\x00\x00\x00\x00\x00\x23\x01\x67\x45\xAB\x89\xEF\xCD")
     # Generated from packet 113/114
-    # XXX: this needs a longer timeout. How long?
-    buff = bulkRead(0x81, 0x0200, timeout=3000)
-    validate_read(b"\x3C\x00\x30\x00\x00\x01\x07\x00", buff, "packet 113/114")
+    # Slow (flash erase?): t48.SLOW_TIMEOUTS, or learned with t.timeouts
+    buff = bulkRead(0x81, 0x0200)
+    validate_read(t48.ACK_3C, buff, "packet 113/114")
 
     print("Sending firmware...")
     # Generated from packet 115/116
     bulkWrite(0x01, b"\x3B\x01\x00\x00\x00\x00\x00\x00\x23\x01\x67\x45\xAB\x89\xEF\xCD")
 
-    for chunk in batched(firmware_binary[16:], 276):
-        chunk = bytes(chunk)
-        bulkWrite(0x01, b"\x3B\x00\x14\x01\x00\x00\x00\x00" + chunk)
-        buff = bulkRead(0x81, 0x0200)
-        validate_read(b"\x3B\x00\x30\x00\x00\x01\x07\x00", buff, "bad reply")
+    # One .dat BLOCK record per chunk
+    packets = (t48.CHUNK_HEADER + chunk for chunk in records)
+    if window:
+        from libxgecu.t48.xgecu.upload import PipelinedUploader
+
+        uploader = PipelinedUploader(dev, t.usbcontext, window=window, metrics=t.metrics)
+        uploader.run(packets, t48.ACK_3B)
+        print("Sent %u chunks in %0.1f sec" % (uploader.chunks, uploader.dt))
+    else:
+        send_chunks(t, packets)
 
     # Generated from packet 3885/3886
     bulkWrite(0x01, b"\x3B\x03\x00\x01\x00\xFF\x03\x08" + bytes(252) + b"\x68\x86\xEF\xCD")
     # Generated from packet 3887/3888
     buff = bulkRead(0x81, 0x0200)
-    validate_read(b"\x3B\x00\x30\x00\x00\x01\x07\x00", buff, "packet 3887/3888")
+    validate_read(t48.ACK_3B, buff, "packet 3887/3888")
     # Generated from packet 3889/3890
     bulkWrite(0x01, b"\x3B\x02\x00\x01\x00\xFF\x03\x08\x23\x01\x67\x45\xAB\x89\xEF\xCD")
 
@@ -117,13 +177,101 @@ def replay(t, firmware_binary):
     t.reset(mode=2)
 
 
-@click.command('update_wip')
-@click.argument('firmware_file', type=click.File('rb'))
-def main(firmware_file):
-    """A utility to flash a T48 firmware image"""
-
-    t = t48.get()
-
+def recover(t, timeout=10.0):
+    """
+    Get a programmer back to a known state after a failed update
+    Reset it, or wait for it to come back if it dropped off the bus
+    """
+    import usb1
+
+    try:
+        t.reset(mode=0, timeout=timeout)
+    except usb1.USBErrorNoDevice:
+        t.reconnect(timeout=timeout)
+
+def run_update(t, make_records, window=0, hdr=None, retry=NO_RETRY):
+    """
+    update_device() restarted up to retry.session_retries times on a device error
+    make_records: returns a fresh iterable of BLOCK records for every attempt
+    """
+    import usb1
+
+    for attempt in range(retry.session_retries + 1):
+        records = make_records()
+        try:
+            return update_device(t, records, window=window, hdr=hdr)
+        except (t48.ValidateError, usb1.USBError) as e:
+            if attempt >= retry.session_retries:
+                raise
+            print("Update failed: %s" % e)
+            print("Restarting update, retry %u / %u" % (attempt + 1, retry.session_retries))
+        finally:
+            # Stop an abandoned prefetch() producer before the next attempt starts its own
+            if hasattr(records, "close"):
+                records.close()
+        time.sleep(timeouts.backoff(attempt + 1))
+        recover(t)
+
+def update(firmware_file, manifest=None, window=0, metrics=None, inventory=None, session=None,
+           force=False, strict=False, retry=NO_RETRY, timeout_store=None, ks=None):
+    """
+    Flash a T48 firmware image from an open .dat file
+    With manifest (.txt from t48decrypt), firmware_file is instead a plaintext .bin
+    encrypted on the fly, overlapped with the USB transfer
+    inventory: inventory.Inventory to keep current with the new firmware version
+    session: t48.Session to open the programmer with, ex: a simdev.SimSession
+    force: flash even if the device already runs the image's firmware version
+    strict: stop at the first unexpected reply. Implied by retries
+    retry: RetryPolicy
+    timeout_store: timeouts.TimeoutStore to learn and use read timeouts from
+    ks: KeySchedule to check / encrypt the image with (default: default_schedule())
+    Return True if the device was flashed, False if it was already current
+    """
+
+    # Fail on bad input / missing key before touching the device
+    if ks is None:
+        ks = t48crypto.default_schedule()
+    if manifest is None:
+        firmware = firmware_file.read()
+        hdr = preflight(firmware, ks=ks)
+
+        def make_records():
+            return dat_records(firmware)
+    else:
+        from libxgecu.t48 import t48encrypt
+
+        # Block CRCs are computed as the image is encrypted
+        hdr, manifest = t48encrypt.read_manifest(manifest)
+        flash = firmware_file.read()
+
+        def make_records():
+            return prefetch(plaintext_records(flash, manifest, ks=ks), depth=4)
+
+    if session is None:
+        session = t48.Session()
+    with session:
+        t = session.open()
+        t.metrics = metrics
+        t.inventory = inventory
+        t.timeout_store = timeout_store
+        t.strict = strict or retry != NO_RETRY
+        return run_update(t, make_records, window=window, hdr=None if force else hdr, retry=retry)
+
+def update_device(t, records, window=0, hdr=None):
+    """
+    Run the whole update sequence on an already open T48
+    records: BLOCK records to flash, see replay()
+    hdr: FileHeader of the image. If given, skip devices already running its firmware version
+    Return True if the device was flashed, False if it was skipped
+    """
+
+    if hdr is not None:
+        version = t48.parse_version(t.version_raw())
+        if is_current(version, hdr):
+            print("Already running FW %s, skipping update" % fmt_fw(version["ver_major"], version["ver_minor"]))
+            return False
+        print("Updating FW %s => %s" % (fmt_fw(version["ver_major"], version["ver_minor"]),
+                                      fmt_fw(hdr.major_version, hdr.minor_version)))
 
     """
     ***********************************************************
@@ -164,7 +312,8 @@ def main(firmware_file):
     # Generated from packet 57/58
     buff = t.bulkRead(0x81, 0x0200)
     t48.validate_read(b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-            b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00", buff, "packet 57/58")
+            b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00", buff, "packet 57/58",
+            strict=t.strict)
 
     """
     # Generated from packet 59/60
@@ -183,7 +332,7 @@ def main(firmware_file):
     ***********************************************************
     """
     print("56-update")
-    replay(t, firmware_file.read())
+    replay(t, records, window=window)
 
 
     """
@@ -226,6 +375,78 @@ def main(firmware_file):
     t.version_raw()
 
     print("update ok!")
+    return True
+
+def main():
+    # click only loads when the CLI actually runs
+    import click
+
+    @click.command('update_wip')
+    @click.option('--manifest', type=click.Path(exists=True, dir_okay=False),
+                  help='Block manifest (.txt) for a plaintext .bin image. Default: <image>.txt for .bin')
+    @click.option('--key', type=click.Path(exists=True, dir_okay=False),
+                  help='Key file (default: $T48_KEY or key.dat)')
+    @click.option('--window', type=int, default=0,
+                  help='Pipeline this many chunks with async transfers (default: lock-step)')
+    @click.option('--metrics', 'metrics_fn', type=click.Path(dir_okay=False),
+                  help='Write USB transport metrics here at exit (.json, else Prometheus text)')
+    @click.option('--simulate', is_flag=True,
+                  help='Run against a simulated programmer instead of real hardware')
+    @click.option('--sim-latency', type=float, default=0.5,
+                  help='Simulated USB round trip, ms')
+    @click.option('--force', is_flag=True,
+                  help='Flash even if the programmer already runs this firmware version')
+    @click.option('--strict', is_flag=True,
+                  help='Abort on the first unexpected reply instead of just printing it')
+    @click.option('--session-retries', type=int, default=0,
+                  help='Reset and restart a failed update up to this many times (implies --strict)')
+    @click.option('--learn-timeouts', is_flag=True,
+                  help="Learn read timeouts from this programmer's past replies and reissue slow reads early "
+                  "(experimental, not yet checked on hardware)")
+    @click.argument('firmware_file', type=click.File('rb'))
+    def cli(firmware_file, manifest, key, window, metrics_fn, simulate, sim_latency, force,
+            strict, session_retries, learn_timeouts):
+        """A utility to flash a T48 firmware image (.dat, or plaintext .bin + manifest)"""
+        if manifest is None and firmware_file.name.endswith(".bin"):
+            manifest = firmware_file.name[:-4] + ".txt"
+        from libxgecu.t48.xgecu.inventory import Inventory
+
+        metrics = None
+        if metrics_fn:
+            from libxgecu.t48.xgecu.metrics import Metrics
+
+            metrics = Metrics()
+        session = None
+        inventory = Inventory()
+        timeout_store = timeouts.TimeoutStore() if learn_timeouts else None
+        if simulate:
+            from libxgecu.t48.xgecu.simdev import SimSession
+
+            session = SimSession(latency=sim_latency / 1000.0)
+            # Don't record the simulated programmer
+            inventory = None
+            timeout_store = None
+        tstart = time.time()
+        try:
+            update(firmware_file, manifest=manifest, window=window, metrics=metrics,
+                   inventory=inventory, session=session, force=force, strict=strict,
+                   retry=RetryPolicy(session_retries), timeout_store=timeout_store,
+                   ks=None if key is None else t48crypto.load_key(key))
+        except PreflightError as e:
+            raise click.ClickException("Preflight failed: %s" % e)
+        finally:
+            if inventory is not None:
+                inventory.save()
+            if timeout_store is not None:
+                timeout_store.save()
+            if metrics:
+                metrics.write(metrics_fn)
+        if simulate:
+            device = session.device
+            print("Simulated update took %0.2f sec, %u chunks flashed, %u resent" % (
+                time.time() - tstart, len(device.flashed or []), device.duplicates))
+
+    cli()
 
 if __name__ == "__main__":
     main()
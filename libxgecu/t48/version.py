@@ -3,20 +3,41 @@
 from libxgecu.t48.xgecu import t48
 from libxgecu.t48.xgecu.util import hexdump
 
+def cached_version_raw(session, inventory):
+    """First programmer's version, only opening it if its port has no fresh record"""
+    udevs = session.list_devices()
+    if not udevs:
+        raise t48.DeviceNotFound("Failed to find a device")
+    port = t48.device_port(udevs[0])
+    record = inventory.lookup(port=port)
+    if record is not None:
+        return bytes.fromhex(record["raw"]), "cache"
+    t = session.open(port=port)
+    t.inventory = inventory
+    return t.version_raw(), "USB"
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(description="Version info")
     parser.add_argument("--fn-in", help="Parse file instead of running live")
+    parser.add_argument("--cached", action="store_true", help="Use the device inventory cache when fresh")
     parser.add_argument("fn_out", nargs="?", help="Output file name")
     args = parser.parse_args()
 
     if args.fn_in:
         raw = open(args.fn_in, "rb").read()
         print("Read %u bytes from %s" % (len(raw), args.fn_in))
+    elif args.cached:
+        from libxgecu.t48.xgecu.inventory import Inventory
+
+        with t48.Session() as session, Inventory() as inventory:
+            raw, source = cached_version_raw(session, inventory)
+        print("Read %u bytes from %s" % (len(raw), source))
     else:
-        t = t48.get()
-        raw = t.version_raw()
+        # USB stack only loads here
+        with t48.Session() as session:
+            raw = session.open().version_raw()
         print("Read %u bytes from USB" % (len(raw),))
     hexdump(raw)
     if args.fn_out:
@@ -0,0 +1,337 @@
+"""
+asyncio client: many programmers driven from one event loop
+
+Bulk I/O goes through libusb asynchronous transfers
+One EventThread per USB context runs libusb event handling, and transfer callbacks
+complete asyncio futures on the loop, so no thread is parked per device:
+
+async def main():
+    with AsyncSession() as session:
+        ts = await asyncio.gather(*[session.open(port=port) for port in ports])
+        print(await asyncio.gather(*[t.version() for t in ts]))
+
+Works with simdev.SimSession (fakeusb) in place of a t48.Session
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from collections import deque
+from . import t48
+from .upload import UploadError
+
+# Re-enumeration poll period, seconds
+POLL = 0.05
+# Poll period while waiting for cancelled transfers to come back, seconds
+DRAIN_POLL = 0.001
+
+def transfer_error(status):
+    """usb1 exception for a failed transfer status, as the synchronous call would raise"""
+    import usb1
+
+    cls = {
+        t48.TRANSFER_TIMED_OUT: usb1.USBErrorTimeout,
+        t48.TRANSFER_CANCELLED: usb1.USBErrorInterrupted,
+        t48.TRANSFER_STALL: usb1.USBErrorPipe,
+        t48.TRANSFER_NO_DEVICE: usb1.USBErrorNoDevice,
+        t48.TRANSFER_OVERFLOW: usb1.USBErrorOverflow,
+    }.get(status, usb1.USBErrorIO)
+    return cls()
+
+
+class EventThread:
+    """Run libusb event handling for usbcontext on one background thread"""
+    def __init__(self, usbcontext, tv=0.1):
+        self.usbcontext = usbcontext
+        self.tv = tv
+        self.running = False
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        assert self.thread is None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="libusb events", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.usbcontext.handleEventsTimeout(self.tv)
+
+    def stop(self):
+        if self.thread is not None:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+
+
+class AsyncSession:
+    """
+    t48.Session + the EventThread serving its context
+    session: t48.Session to use, ex: a simdev.SimSession. Default: a new one. Closed with this
+    """
+    def __init__(self, session=None):
+        self.session = t48.Session() if session is None else session
+        self.events = EventThread(self.session.usbcontext)
+        self.events.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    async def open(self, **kwargs):
+        """AsyncT48 for a programmer, see t48.Session.open(). Enumerates off the loop"""
+        t = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.session.open(verbose=False, **kwargs))
+        return AsyncT48(t)
+
+    def close(self):
+        # Stop event handling before the context goes away
+        self.events.stop()
+        self.session.close()
+
+
+class AsyncT48:
+    """
+    Awaitable version / reset / upload on an open T48
+    The T48 keeps the handle, session, port, metrics and learned timeouts
+    Unexpected replies always raise ValidateError
+    """
+    def __init__(self, t):
+        self.t = t
+
+    def submit(self, endpoint, buffer_or_len, timeout):
+        """
+        Submit a bulk transfer. Return a future for (status, data)
+        data is the bytes read for IN transfers, None for OUT
+        Cancelling the future cancels the transfer
+        """
+        return self._submit(endpoint, buffer_or_len, timeout)[0]
+
+    def _submit(self, endpoint, buffer_or_len, timeout):
+        """submit(), also returning the USBTransfer: (future, transfer)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        transfer = self.t.dev.getTransfer()
+
+        def callback(transfer):
+            # Event thread
+            data = None
+            if endpoint & 0x80:
+                data = bytes(transfer.getBuffer()[:transfer.getActualLength()])
+            try:
+                loop.call_soon_threadsafe(done, transfer.getStatus(), data)
+            except RuntimeError:
+                # Loop already closed, nobody is waiting
+                pass
+
+        def done(status, data):
+            if not future.done():
+                future.set_result((status, data))
+            transfer.close()
+
+        def cancelled(future):
+            if future.cancelled() and transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except Exception:
+                    # Raced to completion
+                    pass
+
+        transfer.setBulk(endpoint, buffer_or_len, callback=callback, timeout=timeout)
+        future.add_done_callback(cancelled)
+        transfer.submit()
+        return future, transfer
+
+    async def _io(self, method, endpoint, opcode, buffer_or_len, timeout):
+        tstart = time.time()
+        status, data = await self.submit(endpoint, buffer_or_len, timeout)
+        metrics = self.t.metrics
+        if metrics is not None:
+            nbytes = len(buffer_or_len) if data is None else len(data)
+            metrics.observe(method, endpoint, opcode, nbytes if status == t48.TRANSFER_COMPLETED else 0,
+                            time.time() - tstart, timeout=status == t48.TRANSFER_TIMED_OUT,
+                            error=status != t48.TRANSFER_COMPLETED)
+        if status != t48.TRANSFER_COMPLETED:
+            raise transfer_error(status)
+        return data
+
+    async def bulkWrite(self, endpoint, data, timeout=None):
+        if data:
+            self.t.opcode = data[0]
+        await self._io("asyncBulkWrite", endpoint, self.t.opcode, data,
+                       t48.DEFAULT_TIMEOUT if timeout is None else timeout)
+
+    async def bulkRead(self, endpoint, length, timeout=None):
+        """As T48.bulkRead(): learned timeouts are retried with backoff, then raise"""
+        t = self.t
+        opcode = t.opcode
+        if timeout is not None:
+            return await self._io("asyncBulkRead", endpoint, opcode, length, timeout)
+        attempts = t.read_timeouts("bulkRead", opcode)
+        tstart = time.time()
+        for i, timeout in enumerate(attempts):
+            try:
+                ret = await self._io("asyncBulkRead", endpoint, opcode, length, timeout)
+                break
+            except Exception as e:
+                if i == len(attempts) - 1 or not t48.is_timeout(e):
+                    raise
+        if t.timeouts is not None:
+            t.timeouts.observe("bulkRead", opcode, time.time() - tstart)
+        return ret
+
+    async def command(self, data, expected, msg):
+        """Write a command and check its reply"""
+        await self.bulkWrite(0x01, data)
+        buff = await self.bulkRead(0x81, 0x0200)
+        t48.validate_read(expected, buff, msg, strict=True)
+        return buff
+
+    async def winusb(self):
+        """T48.winusb_16() + winusb_40(). Synchronous control reads: run off the loop"""
+        t = self.t
+
+        def reads():
+            t.winusb_16()
+            t.winusb_40()
+        await asyncio.get_running_loop().run_in_executor(None, reads)
+
+    async def version_raw(self):
+        """See T48.version_raw()"""
+        t = self.t
+        await self.bulkWrite(0x01, b"\x00\x00\x00\x00\x00\x00\x00\x00")
+        buff = await self.bulkRead(0x81, 0x0200)
+        assert len(buff) == 63 or len(buff) == 64
+        if t.inventory is not None:
+            t.inventory.record(buff, port=t.port)
+        if t.timeout_store is not None:
+            t.timeouts = t.timeout_store.profile(t48.parse_version(buff))
+        return buff
+
+    async def version(self):
+        return t48.parse_version(await self.version_raw())
+
+    async def reset(self, mode=0, timeout=10.0):
+        """
+        As T48.reset(), waiting for the device to come back without blocking the loop
+        Hotplug arrivals are delivered by the EventThread. Otherwise poll
+        """
+        t = self.t
+        session = t.get_session()
+        watch = session.watch(port=t.port)
+        try:
+            if mode == 0:
+                await self.bulkWrite(0x01, b"\x3F\x00\x00\x00\x00\x00\x00\x00")
+            elif mode == 2:
+                await self.bulkWrite(0x01, b"\x3F\x02\x00\x01\x00\xFF\x03\x08")
+            else:
+                assert 0, mode
+
+            # Needed on macOS. Don't ask
+            if sys.platform == "darwin":
+                await asyncio.sleep(3)
+
+            await self.reconnect(timeout=timeout, watch=watch)
+        finally:
+            watch.close()
+
+    async def reconnect(self, timeout=10.0, watch=None):
+        """As T48.reconnect()"""
+        t = self.t
+        if t.inventory is not None:
+            t.inventory.invalidate(port=t.port)
+        session = t.get_session()
+        loop = asyncio.get_running_loop()
+        deadline = time.time() + timeout
+        if watch is not None and watch.supported:
+            while not watch.arrived and time.time() < deadline:
+                await asyncio.sleep(POLL)
+        while True:
+            try:
+                # One attempt. Enumerates: off the loop
+                dev = await loop.run_in_executor(None, lambda: session.reopen(port=t.port, timeout=0))
+                break
+            except t48.DeviceNotFound:
+                if time.time() >= deadline:
+                    raise t48.DeviceNotFound("Device didn't come back after %0.1f sec" % timeout)
+            await asyncio.sleep(POLL)
+        old, t.dev = t.dev, dev
+        old.close()
+
+    async def send_chunks(self, chunks, window=8):
+        """
+        Pipelined 0x3B chunk upload: up to window (write, ack read) pairs in flight
+        Acks come back in order. On the first bad chunk the rest are cancelled,
+        drained as PipelinedUploader does, and UploadError raised
+        Return number of chunks sent
+        """
+        pending = deque()
+        sent = 0
+
+        async def retire():
+            # Left pending until checked, so a failed pair is drained with the rest
+            seq, wr, rd = pending[0]
+            status, _ = await wr[0]
+            if status != t48.TRANSFER_COMPLETED:
+                raise UploadError("chunk %u: write %s" % (seq, t48.status_i2s.get(status, status)))
+            status, ack = await rd[0]
+            if status != t48.TRANSFER_COMPLETED:
+                raise UploadError("chunk %u: ack %s" % (seq, t48.status_i2s.get(status, status)))
+            if ack != t48.ACK_3B:
+                raise UploadError("chunk %u: bad ack %s" % (seq, ack.hex()))
+            pending.popleft()
+
+        timeout = t48.DEFAULT_TIMEOUT
+        try:
+            for seq, chunk in enumerate(chunks):
+                if len(pending) >= window:
+                    await retire()
+                pending.append((seq, self._submit(0x01, chunk, timeout),
+                                self._submit(0x81, 0x0200, timeout)))
+                sent += 1
+            while pending:
+                await retire()
+        except BaseException:
+            # Don't return while libusb still owns transfers on this device
+            submitted = [pair for _seq, wr, rd in pending for pair in (wr, rd)]
+            for future, _transfer in submitted:
+                future.cancel()
+            while any(transfer.isSubmitted() for _future, transfer in submitted):
+                await asyncio.sleep(DRAIN_POLL)
+            raise
+        return sent
+
+    async def upload(self, records, window=8):
+        """
+        Flash BLOCK records (ex: update.dat_records()), as update.update_device()
+        Return the version after the update
+        """
+        await self.winusb()
+        await self.version_raw()
+        await self.command(b"\x3D\x00\x00\x00\x00\x00\x00\x00" + t48.MAGIC, bytes(32), "update request")
+        await self.reset(mode=0)
+
+        await self.winusb()
+        await self.version_raw()
+        # Slow: t48.SLOW_TIMEOUTS, or learned
+        await self.command(b"\x3C\x00\x00\x00\x00\x00\x00\x00" + t48.MAGIC, t48.ACK_3C, "update start")
+        await self.bulkWrite(0x01, b"\x3B\x01\x00\x00\x00\x00\x00\x00" + t48.MAGIC)
+        await self.send_chunks((t48.CHUNK_HEADER + record for record in records),
+                               window=window)
+        await self.command(b"\x3B\x03\x00\x01\x00\xFF\x03\x08" + bytes(252) + b"\x68\x86\xEF\xCD",
+                           t48.ACK_3B, "upload end")
+        await self.bulkWrite(0x01, b"\x3B\x02\x00\x01\x00\xFF\x03\x08" + t48.MAGIC)
+        await self.reset(mode=2)
+
+        await self.winusb()
+        return await self.version()
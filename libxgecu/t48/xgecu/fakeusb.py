@@ -0,0 +1,290 @@
+"""
+In process stand-in for a usb1 context + device handle
+
+Implements enough of the synchronous calls and the asynchronous USBTransfer API
+to run protocol code without hardware, with modeled timing so throughput can be measured:
+- latency: bus round trip cost of every transfer. Overlaps between transfers in flight
+- service_time: device side processing of each OUT transfer. Serialized like on a real device
+- jitter: up to this much extra random latency per transfer
+
+responder(endpoint, data) returns the reply to queue on the IN endpoint, or None
+control(bRequestType, bRequest, wValue, wIndex, wLength) returns the control read reply, or None to stall
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from .t48 import (TRANSFER_CANCELLED, TRANSFER_COMPLETED, TRANSFER_NO_DEVICE,
+                  TRANSFER_TIMED_OUT)
+
+
+class FakeContext:
+    """
+    Event scheduler standing in for usb1.USBContext
+    Like libusb, transfers may be submitted from one thread while another handles events
+    """
+    def __init__(self):
+        self.events = []
+        self.seq = itertools.count()
+        # Guards events and all handle / transfer state. Reentrant: events schedule events
+        self.lock = threading.RLock()
+        self.wakeup = threading.Condition(self.lock)
+
+    def schedule(self, due, fn):
+        with self.lock:
+            heapq.heappush(self.events, (due, next(self.seq), fn))
+            self.wakeup.notify()
+
+    def run_due(self):
+        ran = 0
+        with self.lock:
+            while self.events and self.events[0][0] <= time.monotonic():
+                _due, _seq, fn = heapq.heappop(self.events)
+                fn()
+                ran += 1
+        return ran
+
+    def handleEventsTimeout(self, tv=0):
+        deadline = time.monotonic() + (tv or 0)
+        with self.lock:
+            while not self.run_due():
+                now = time.monotonic()
+                if now >= deadline:
+                    return
+                wake = deadline
+                if self.events:
+                    wake = min(wake, self.events[0][0])
+                # Woken early by schedule(), ex: a submit from another thread
+                self.wakeup.wait(max(wake - now, 0))
+
+    def handleEvents(self):
+        self.handleEventsTimeout(1.0)
+
+    def close(self):
+        self.events = []
+
+
+class FakeTransfer:
+    """usb1.USBTransfer subset: bulk transfers only"""
+    def __init__(self, handle):
+        self.handle = handle
+        self.endpoint = None
+        self.buffer = None
+        self.callback = None
+        self.user_data = None
+        self.timeout = 0
+        self.status = None
+        self.actual_length = 0
+        self.submitted = False
+        # Bumped on every submit / completion so stale events are ignored
+        self.generation = 0
+
+    def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None, timeout=0):
+        if self.submitted:
+            raise ValueError('Cannot alter a submitted transfer')
+        self.endpoint = endpoint
+        # Length (IN) or data (OUT)
+        self.buffer = bytearray(buffer_or_len)
+        self.callback = callback
+        self.user_data = user_data
+        self.timeout = timeout
+
+    def submit(self):
+        with self.handle.context.lock:
+            if self.submitted:
+                raise ValueError('Cannot submit a submitted transfer')
+            self.submitted = True
+            self.status = None
+            self.actual_length = 0
+            self.generation += 1
+            self.handle.submit(self)
+
+    def cancel(self):
+        with self.handle.context.lock:
+            if not self.submitted:
+                raise ValueError('Transfer not submitted')
+            self.handle.cancel(self)
+
+    def complete(self, status, data=None):
+        if not self.submitted:
+            return
+        self.generation += 1
+        self.submitted = False
+        self.status = status
+        if data is not None:
+            n = min(len(data), len(self.buffer))
+            self.buffer[:n] = data[:n]
+            self.actual_length = n
+        if self.callback is not None:
+            self.callback(self)
+
+    def isSubmitted(self):
+        return self.submitted
+
+    def getStatus(self):
+        return self.status
+
+    def getActualLength(self):
+        return self.actual_length
+
+    def getBuffer(self):
+        return self.buffer
+
+    def getUserData(self):
+        return self.user_data
+
+    def getEndpoint(self):
+        return self.endpoint
+
+    def close(self):
+        pass
+
+
+class FakeHandle:
+    """usb1.USBDeviceHandle subset driven by a responder function"""
+    def __init__(self, context, responder, latency=0.0, service_time=0.0, jitter=0.0,
+                 control=None, seed=None):
+        self.context = context
+        self.responder = responder
+        self.control = control
+        self.latency = latency
+        self.service_time = service_time
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        # Replies ready on the IN endpoint: (ready time, data)
+        self.replies = []
+        # Async IN transfers waiting for a reply, in submission order
+        self.reads = []
+        self.busy_until = 0.0
+        self.last_arrival = 0.0
+        self.claimed = set()
+
+    def delay(self):
+        """Round trip time of one transfer"""
+        if not self.jitter:
+            return self.latency
+        return self.latency + self.rng.uniform(0, self.jitter)
+
+    def alive(self):
+        """False once the device is gone, ex: reset. Transfers then fail with no device"""
+        return True
+
+    def process(self, endpoint, data, arrived):
+        """Device side: handle an OUT transfer that reached the device at arrived"""
+        done = max(arrived, self.busy_until) + self.service_time
+        self.busy_until = done
+        reply = self.responder(endpoint, bytes(data))
+        if reply is not None:
+            self.replies.append((done, bytes(reply)))
+            if self.reads:
+                self.context.schedule(done, self.match_reads)
+
+    def match_reads(self):
+        """Hand ready replies to waiting async IN transfers"""
+        now = time.monotonic()
+        while self.reads and self.replies and self.replies[0][0] <= now:
+            transfer = self.reads.pop(0)
+            _ready, data = self.replies.pop(0)
+            generation = transfer.generation
+            self.context.schedule(now + self.delay() / 2,
+                lambda t=transfer, g=generation, d=data:
+                    t.generation == g and t.complete(TRANSFER_COMPLETED, d))
+        if self.reads and self.replies:
+            self.context.schedule(self.replies[0][0], self.match_reads)
+
+    # Async
+
+    def getTransfer(self, iso_packets=0, short_is_error=False, add_zero_packet=False):
+        return FakeTransfer(self)
+
+    def submit(self, transfer):
+        now = time.monotonic()
+        generation = transfer.generation
+        if not self.alive():
+            self.context.schedule(now,
+                lambda: transfer.generation == generation and transfer.complete(TRANSFER_NO_DEVICE))
+        elif transfer.endpoint & 0x80:
+            self.reads.append(transfer)
+            self.match_reads()
+            if transfer.timeout:
+                self.context.schedule(now + transfer.timeout / 1000.0,
+                    lambda: transfer.generation == generation and self.expire(transfer))
+        else:
+            data = bytes(transfer.buffer)
+            # Jitter can't reorder an endpoint: OUT transfers reach the device in submission order
+            arrived = max(now + self.delay() / 2, self.last_arrival)
+            self.last_arrival = arrived
+
+            def out_done():
+                if transfer.generation != generation:
+                    return
+                if not self.alive():
+                    transfer.complete(TRANSFER_NO_DEVICE)
+                    return
+                self.process(transfer.endpoint, data, arrived)
+                transfer.complete(TRANSFER_COMPLETED, data)
+            self.context.schedule(arrived, out_done)
+
+    def expire(self, transfer):
+        if transfer in self.reads:
+            self.reads.remove(transfer)
+        transfer.complete(TRANSFER_TIMED_OUT)
+
+    def cancel(self, transfer):
+        if transfer in self.reads:
+            self.reads.remove(transfer)
+        generation = transfer.generation
+        self.context.schedule(time.monotonic(),
+            lambda: transfer.generation == generation and transfer.complete(TRANSFER_CANCELLED))
+
+    # Sync
+
+    def check_alive(self):
+        import usb1
+
+        if not self.alive():
+            raise usb1.USBErrorNoDevice()
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        self.check_alive()
+        time.sleep(self.delay() / 2)
+        self.process(endpoint, data, time.monotonic())
+        return len(data)
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        import usb1
+
+        self.check_alive()
+        if not self.replies:
+            time.sleep(timeout / 1000.0)
+            raise usb1.USBErrorTimeout()
+        ready, data = self.replies.pop(0)
+        time.sleep(max(ready - time.monotonic(), 0) + self.delay() / 2)
+        return bytearray(data[:length])
+
+    def controlRead(self, bRequestType, bRequest, wValue, wIndex, wLength, timeout=0):
+        import usb1
+
+        self.check_alive()
+        time.sleep(self.delay())
+        reply = None
+        if self.control is not None:
+            reply = self.control(bRequestType, bRequest, wValue, wIndex, wLength)
+        if reply is None:
+            raise usb1.USBErrorPipe()
+        return bytearray(reply[:wLength])
+
+    def claimInterface(self, interface):
+        self.claimed.add(interface)
+
+    def releaseInterface(self, interface):
+        self.claimed.discard(interface)
+
+    def resetDevice(self):
+        pass
+
+    def close(self):
+        pass
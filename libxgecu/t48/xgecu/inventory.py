@@ -0,0 +1,145 @@
+"""
+Cache of programmer version info, so tools don't need a USB round trip to know what's attached
+
+Records are keyed by dev_code + serial and remember the port the unit was last seen on
+A T48 with .inventory set records every version_raw() it reads and drops its record on reset,
+so a firmware update leaves either nothing or the post update version behind
+"""
+
+import json
+import os
+import threading
+import time
+from . import t48
+from .pool import fmt_port
+from .util import cache_path
+
+# Seconds a record is trusted
+DEFAULT_TTL = 3600
+
+def default_path():
+    return cache_path("inventory.json")
+
+def record_key(version):
+    return "%s:%s" % (version["dev_code"], version["serial"])
+
+def record_version(record):
+    """Full parse_version() dict of a record"""
+    return t48.parse_version(bytes.fromhex(record["raw"]))
+
+
+class Inventory:
+    """
+    Thread safe, persisted as JSON at path
+    ttl: records older than this many seconds are ignored
+    """
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        self.path = path or default_path()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.records = {}
+        try:
+            with open(self.path, "r") as f:
+                self.records = json.load(f)["records"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            # Corrupt cache, start over
+            self.dirty = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.save()
+
+    def fresh(self, record, max_age=None):
+        if max_age is None:
+            max_age = self.ttl
+        return time.time() - record["time"] <= max_age
+
+    def lookup(self, serial=None, dev_code=None, port=None, max_age=None):
+        """Most recent fresh record matching every given field, or None"""
+        if port is not None:
+            port = fmt_port(port)
+        with self.lock:
+            best = None
+            for record in self.records.values():
+                if serial is not None and record["serial"] != serial:
+                    continue
+                if dev_code is not None and record["dev_code"] != dev_code:
+                    continue
+                if port is not None and record["port"] != port:
+                    continue
+                if not self.fresh(record, max_age):
+                    continue
+                if best is None or record["time"] > best["time"]:
+                    best = record
+            return best
+
+    def all(self, max_age=None):
+        """Every fresh record"""
+        with self.lock:
+            return [record for record in self.records.values() if self.fresh(record, max_age)]
+
+    def record(self, raw, port=None):
+        """Parse and store a version_raw() response. Return the record"""
+        version = t48.parse_version(raw)
+        record = {
+            "serial": version["serial"],
+            "dev_code": version["dev_code"],
+            "model": version["model"],
+            "ver_major": version["ver_major"],
+            "ver_minor": version["ver_minor"],
+            "date": version["date"],
+            "port": None if port is None else fmt_port(port),
+            "time": time.time(),
+            "raw": bytes(raw).hex(),
+        }
+        k = record_key(version)
+        with self.lock:
+            if port is not None:
+                # Whatever was on this port before isn't anymore
+                for other in [k2 for k2, r in self.records.items() if r["port"] == record["port"]]:
+                    del self.records[other]
+            self.records[k] = record
+            self.dirty = True
+        return record
+
+    def invalidate(self, serial=None, port=None):
+        """Drop records matching serial and / or port, or everything if neither is given"""
+        if port is not None:
+            port = fmt_port(port)
+        with self.lock:
+            for k in list(self.records):
+                record = self.records[k]
+                if serial is not None and record["serial"] != serial:
+                    continue
+                if port is not None and record["port"] != port:
+                    continue
+                del self.records[k]
+                self.dirty = True
+
+    def version(self, t, max_age=None):
+        """Record for open T48 t, only asking the device on a cache miss"""
+        record = None
+        if t.port is not None:
+            record = self.lookup(port=t.port, max_age=max_age)
+        if record is None:
+            record = self.record(t.version_raw(), port=t.port)
+        return record
+
+    def save(self):
+        """Write out if anything changed"""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps({"records": self.records}, indent=4, sort_keys=True)
+            self.dirty = False
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Atomic replace so concurrent tools never see a partial file
+        tmp = "%s.%u.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
@@ -0,0 +1,115 @@
+"""
+Opt-in transport metrics for T48 USB calls
+
+Counters, bytes moved, timeouts and latency histograms per
+(method, endpoint, command opcode), exportable as JSON or Prometheus text
+"""
+
+import bisect
+import json
+import threading
+
+# Latency histogram bucket upper bounds, seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Series:
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        # Per bucket (not cumulative), last is +Inf
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, nbytes, dt, timeout, error):
+        self.calls += 1
+        self.bytes += nbytes
+        self.timeouts += timeout
+        self.errors += error
+        self.latency_sum += dt
+        self.buckets[bisect.bisect_left(BUCKETS, dt)] += 1
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "bytes": self.bytes,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "latency_sum": self.latency_sum,
+            "latency_buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], self.buckets)),
+        }
+
+
+def fmt_endpoint(endpoint):
+    return endpoint if isinstance(endpoint, str) else "0x%02X" % endpoint
+
+def fmt_opcode(opcode):
+    return "" if opcode is None else "0x%02X" % opcode
+
+
+class Metrics:
+    """Thread safe registry, one Series per (method, endpoint, opcode)"""
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, method, endpoint, opcode, nbytes, dt, timeout=False, error=False):
+        k = (method, fmt_endpoint(endpoint), fmt_opcode(opcode))
+        with self.lock:
+            series = self.series.get(k)
+            if series is None:
+                series = self.series[k] = Series()
+            series.observe(nbytes, dt, timeout, error)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "buckets": list(BUCKETS),
+                "series": [
+                    dict(method=method, endpoint=endpoint, opcode=opcode, **series.to_dict())
+                    for (method, endpoint, opcode), series in sorted(self.series.items())
+                ],
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=4, sort_keys=True)
+
+    def to_prometheus(self, prefix="t48_usb"):
+        lines = []
+        with self.lock:
+            items = sorted(self.series.items())
+
+        def labels(k, extra=""):
+            method, endpoint, opcode = k
+            ret = 'method="%s",endpoint="%s",opcode="%s"' % (method, endpoint, opcode)
+            return "{" + ret + extra + "}"
+
+        for name, attr, help in (
+                ("calls_total", "calls", "USB calls"),
+                ("bytes_total", "bytes", "Bytes transferred"),
+                ("timeouts_total", "timeouts", "USB calls that timed out"),
+                ("errors_total", "errors", "USB calls that failed, including timeouts")):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s counter" % (prefix, name))
+            for k, series in items:
+                lines.append("%s_%s%s %u" % (prefix, name, labels(k), getattr(series, attr)))
+
+        name = prefix + "_latency_seconds"
+        lines.append("# HELP %s USB call latency" % name)
+        lines.append("# TYPE %s histogram" % name)
+        for k, series in items:
+            cumulative = 0
+            for le, count in zip(list(BUCKETS) + ["+Inf"], series.buckets):
+                cumulative += count
+                lines.append('%s_bucket%s %u' % (name, labels(k, ',le="%s"' % le), cumulative))
+            lines.append("%s_sum%s %f" % (name, labels(k), series.latency_sum))
+            lines.append("%s_count%s %u" % (name, labels(k), series.calls))
+        return "\n".join(lines) + "\n"
+
+    def write(self, fn):
+        """Export to fn: JSON if it ends in .json, Prometheus text otherwise"""
+        with open(fn, "w") as f:
+            f.write(self.to_json() if fn.endswith(".json") else self.to_prometheus())
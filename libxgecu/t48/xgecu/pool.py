@@ -0,0 +1,92 @@
+"""
+Drive every attached programmer at once
+
+Devices are identified by physical port (see t48.device_port), which also
+lets each worker find its own unit again after a reset re-enumerates it
+"""
+
+import time
+from collections import namedtuple
+from . import t48
+
+DeviceInfo = namedtuple('DeviceInfo', ['bus', 'address', 'port'])
+JobResult = namedtuple('JobResult', ['device', 'ok', 'value', 'error', 'dt'])
+
+
+def fmt_port(port):
+    bus, path = port
+    return "%u-%s" % (bus, ".".join(str(p) for p in path))
+
+
+class DevicePool:
+    """
+    Every programmer is enumerated, opened and reconnected through one t48.Session,
+    so workers share a single USB context
+    session: t48.Session to use, ex: a simdev.SimSession. Default: a new one on usbcontext
+    Closing the pool closes the session
+    """
+    def __init__(self, usbcontext=None, inventory=None, session=None):
+        self.session = t48.Session(usbcontext) if session is None else session
+        # Optional inventory.Inventory attached to every opened device
+        self.inventory = inventory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def enumerate(self):
+        """DeviceInfo of every attached programmer. Does not open them"""
+        return [DeviceInfo(udev.getBusNumber(), udev.getDeviceAddress(), t48.device_port(udev))
+                for udev in self.session.list_devices()]
+
+    def open(self, device=None, bus=None, address=None, serial=None):
+        """
+        Open one programmer as T48
+        device: DeviceInfo from enumerate(), else by bus/address and / or serial
+        """
+        if device is not None:
+            t = self.session.open(port=device.port)
+        else:
+            t = self.session.open(bus=bus, address=address, serial=serial)
+        t.inventory = self.inventory
+        return t
+
+    def run(self, job, devices=None):
+        """
+        Call job(t) on every device concurrently, one worker thread per device
+        Return {port: JobResult}. One failing device doesn't affect the others
+        """
+        if devices is None:
+            devices = self.enumerate()
+        if not devices:
+            return {}
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        def worker(device):
+            tstart = time.time()
+            t = None
+            try:
+                t = self.open(device)
+                value = job(t)
+                return JobResult(device, True, value, None, time.time() - tstart)
+            except Exception as e:
+                return JobResult(device, False, None, "%s: %s" % (type(e).__name__, e),
+                                 time.time() - tstart)
+            finally:
+                if t is not None:
+                    t.close()
+
+        with ThreadPoolExecutor(max_workers=len(devices), thread_name_prefix="t48") as executor:
+            results = executor.map(worker, devices)
+            return {result.device.port: result for result in results}
+
+
+def version_job(t):
+    """Parsed version info"""
+    return t48.parse_version(t.version_raw())
@@ -0,0 +1,243 @@
+"""
+Software T48 for running the protocol without a programmer attached
+
+SimDevice models the programmer: version, WinUSB descriptor, the update commands and reset
+SimSession stands in for t48.Session: T48 only talks to its dev (usb1 handle API) and
+to its session (open / watch / reopen), so T48.reset(), update.replay() etc. run unchanged:
+
+with SimSession(SimDevice(), latency=0.0005) as session:
+    t = session.open()
+    update.update_device(t, update.dat_records(firmware))
+
+Transfer timing (latency, jitter, device service time) is modeled by fakeusb
+"""
+
+import random
+import time
+from . import fakeusb, t48
+
+# Real T48 version response, FW 1.07
+VERSION_T48 = (b"\x00\x01\x30\x00\x07\x01\x07\x00\x32\x30\x32\x32\x2D\x30\x39\x2D"
+               b"\x32\x31\x30\x39\x3A\x32\x37\x00\x32\x39\x41\x30\x33\x36\x33\x32"
+               b"\x57\x44\x4E\x35\x59\x46\x4F\x4D\x4B\x32\x52\x52\x56\x4A\x30\x41"
+               b"\x32\x46\x39\x53\x39\x36\x31\x33\x1B\x06\x00\x00\x01\x00\x00")
+# Microsoft OS descriptor, read with controlRead(0xC0, 0xEE, 0x0000, 0x0004, n)
+WINUSB_DESCRIPTOR = (b"\x28\x00\x00\x00\x00\x01\x04\x00\x01\x00\x00\x00\x00\x00\x00\x00"
+                     b"\x00\x01\x57\x49\x4E\x55\x53\x42\x00\x00\x00\x00\x00\x00\x00\x00"
+                     b"\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def random_faults(drop=0.0, corrupt=0.0, disconnect=0.0, opcodes=(0x3B,), seed=None):
+    """
+    SimDevice fault hook injecting faults at random into commands with the given opcodes
+    drop: no reply, the read times out
+    corrupt: reply with a flipped bit
+    disconnect: device drops off the bus for reset_time
+    """
+    rng = random.Random(seed)
+
+    def fault(opcode, data):
+        if opcode not in opcodes:
+            return None
+        r = rng.random()
+        if r < drop:
+            return "drop"
+        r -= drop
+        if r < corrupt:
+            return "corrupt"
+        r -= corrupt
+        if r < disconnect:
+            return "disconnect"
+        return None
+    return fault
+
+
+class SimDevice:
+    """
+    Programmer state machine
+
+    version: version response (63 bytes T48, 64 T56)
+    new_version: (ver_major, ver_minor) reported once an update is committed
+    reset_time: seconds from reset until the device is back on the bus
+    fault: fault(opcode, data) returns None or "drop" / "corrupt" / "disconnect"
+    """
+    def __init__(self, version=VERSION_T48, new_version=None, reset_time=0.05, fault=None,
+                 port=(1, (1,))):
+        self.version = bytearray(version)
+        self.new_version = new_version
+        self.reset_time = reset_time
+        self.fault = fault
+        self.port = port
+        # Bumped every time the device drops off the bus. Handles from before are dead
+        self.generation = 0
+        self.back_at = 0.0
+        # 0x3D seen: next reset comes up in the updater
+        self.update_requested = False
+        self.bootloader = False
+        self.programming = False
+        self.receiving = False
+        self.committed = False
+        # BLOCK records of the last upload, as received: resent chunks appear again
+        self.records = []
+        # Chunks of the last upload identical to the one before, ex: resent after a lost ack
+        self.duplicates = 0
+        # Last committed upload
+        self.flashed = None
+        self.resets = 0
+        self.commands = 0
+        self.unknown = []
+
+    def up(self):
+        return time.monotonic() >= self.back_at
+
+    def drop_off(self):
+        self.generation += 1
+        self.back_at = time.monotonic() + self.reset_time
+
+    def reset(self, mode):
+        self.resets += 1
+        if self.update_requested:
+            self.update_requested = False
+            self.bootloader = True
+        elif self.bootloader and self.committed:
+            self.bootloader = False
+            self.flashed = self.records
+            if self.new_version is not None:
+                self.version[5], self.version[4] = self.new_version
+        self.programming = False
+        self.receiving = False
+        self.committed = False
+        self.drop_off()
+
+    def control(self, bRequestType, bRequest, wValue, wIndex, wLength):
+        if (bRequestType, bRequest, wValue, wIndex) == (0xC0, 0xEE, 0x0000, 0x0004):
+            return WINUSB_DESCRIPTOR[:wLength]
+        return None
+
+    def respond(self, endpoint, data):
+        """fakeusb responder: handle an OUT transfer, return the reply or None"""
+        if endpoint != 0x01 or not data:
+            return None
+        self.commands += 1
+        opcode = data[0]
+        action = self.fault(opcode, data) if self.fault is not None else None
+        if action == "disconnect":
+            self.drop_off()
+            return None
+        reply = self.command(opcode, data)
+        if action == "drop":
+            return None
+        if action == "corrupt" and reply:
+            reply = bytearray(reply)
+            reply[-1] ^= 0x01
+        return reply
+
+    def command(self, opcode, data):
+        magic = data[8:16] == t48.MAGIC
+        if opcode == 0x00:
+            return bytes(self.version)
+        elif opcode == 0x3D and magic:
+            self.update_requested = True
+            return bytes(32)
+        elif opcode == 0x3C and magic and self.bootloader:
+            self.programming = True
+            self.records = []
+            self.duplicates = 0
+            return t48.ACK_3C
+        elif opcode == 0x3B and self.programming:
+            sub = data[1]
+            if sub == 0x01 and magic:
+                self.receiving = True
+                return None
+            elif sub == 0x00 and self.receiving and data[:8] == t48.CHUNK_HEADER:
+                record = bytes(data[8:])
+                # Whether the real updater rewrites the same block or takes a resent chunk as the next one
+                # is unknown: record it as received so callers can see it happened
+                if self.records and self.records[-1] == record:
+                    self.duplicates += 1
+                self.records.append(record)
+                return t48.ACK_3B
+            elif sub == 0x03 and self.receiving:
+                self.receiving = False
+                return t48.ACK_3B
+            elif sub == 0x02 and magic and not self.receiving:
+                self.committed = True
+                return None
+        elif opcode == 0x3F:
+            self.reset(data[1])
+            return None
+        self.unknown.append(bytes(data))
+        return None
+
+
+class SimHandle(fakeusb.FakeHandle):
+    """Handle to one enumeration of a SimDevice. Dead once the device resets"""
+    def __init__(self, context, device, **kwargs):
+        fakeusb.FakeHandle.__init__(self, context, device.respond, control=device.control, **kwargs)
+        self.device = device
+        self.generation = device.generation
+
+    def alive(self):
+        return self.device.generation == self.generation and self.device.up()
+
+
+class SimWatch:
+    """ArrivalWatch for a SimDevice"""
+    supported = True
+
+    def __init__(self, device):
+        self.device = device
+        self.generation = device.generation
+
+    @property
+    def arrived(self):
+        # Back on the bus since the watch was made
+        return self.device.generation != self.generation and self.device.up()
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.device.up():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(max(self.device.back_at - time.monotonic(), 0.001), 0.1))
+        return True
+
+    def close(self):
+        pass
+
+
+class SimSession(t48.Session):
+    """
+    t48.Session serving a SimDevice
+    latency, jitter, service_time, seed: fakeusb transfer timing, seconds
+    usbcontext: fakeusb.FakeContext to share with other SimSessions, left open
+    """
+    def __init__(self, device=None, latency=0.0, jitter=0.0, service_time=0.0, seed=None,
+                 usbcontext=None):
+        t48.Session.__init__(self, usbcontext or fakeusb.FakeContext())
+        self.owns_context = usbcontext is None
+        self.device = SimDevice() if device is None else device
+        self.timing = dict(latency=latency, jitter=jitter, service_time=service_time, seed=seed)
+
+    def handle(self):
+        return SimHandle(self.usbcontext, self.device, **self.timing)
+
+    def list_devices(self, bus=None, address=None, port=None):
+        if not self.device.up() or port not in (None, self.device.port):
+            return []
+        return [self.device]
+
+    def open(self, bus=None, address=None, port=None, serial=None, verbose=True):
+        if not self.list_devices(port=port):
+            raise t48.DeviceNotFound("Failed to find a device")
+        if serial is not None and t48.parse_version(self.device.version)["serial"] != serial:
+            raise t48.DeviceNotFound("Failed to find a device with serial %s" % serial)
+        return self.add(self.handle(), self.device.port)
+
+    def watch(self, port=None):
+        return SimWatch(self.device)
+
+    def reopen(self, port=None, watch=None, timeout=10.0):
+        if not SimWatch(self.device).wait(timeout):
+            raise t48.DeviceNotFound("Device didn't come back after %0.1f sec" % timeout)
+        return self.handle()
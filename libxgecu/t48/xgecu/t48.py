@@ -1,8 +1,8 @@
 import binascii
+import sys
 import time
-import usb1
 import struct
-from .util import StructStreamer
+from .util import StructStreamer, StructSchema
 # from usbrply.util import hexdump
 
 model_i2s = {
@@ -10,100 +10,233 @@ model_i2s = {
     7: "t48",
     }
 
+VID = 0xA466
+PID = 0x0A53
+
+# Transfer timeout, ms, unless a timeouts.TimeoutProfile has learned a shorter one
+DEFAULT_TIMEOUT = 1000
+# Reads known to take longer, by (method, opcode)
+SLOW_TIMEOUTS = {
+    # Ack to the update start command comes after a flash erase
+    ("bulkRead", 0x3C): 3000,
+}
+
+# Update protocol
+# Trailer the update commands (0x3D, 0x3C, 0x3B 01 / 02) must end with
+MAGIC = b"\x23\x01\x67\x45\xAB\x89\xEF\xCD"
+# Reply to 0x3C (update start)
+ACK_3C = b"\x3C\x00\x30\x00\x00\x01\x07\x00"
+# Reply to every 0x3B transfer
+ACK_3B = b"\x3B\x00\x30\x00\x00\x01\x07\x00"
+# Prefix of each firmware chunk, followed by one .dat BLOCK record
+CHUNK_HEADER = b"\x3B\x00\x14\x01\x00\x00\x00\x00"
+
+# libusb_transfer_status, same values as usb1.TRANSFER_*
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_TIMED_OUT = 2
+TRANSFER_CANCELLED = 3
+TRANSFER_STALL = 4
+TRANSFER_NO_DEVICE = 5
+TRANSFER_OVERFLOW = 6
+
+status_i2s = {
+    TRANSFER_COMPLETED: "completed",
+    TRANSFER_ERROR: "error",
+    TRANSFER_TIMED_OUT: "timed out",
+    TRANSFER_CANCELLED: "cancelled",
+    TRANSFER_STALL: "stall",
+    TRANSFER_NO_DEVICE: "no device",
+    TRANSFER_OVERFLOW: "overflow",
+}
+
 class DeviceNotFound(Exception):
     pass
 
-def validate_read(expected, actual, msg):
-    if expected != actual:
-        print('Failed %s' % msg)
-        print('  Expected; %s' % binascii.hexlify(expected,))
-        print('  Actual:   %s' % binascii.hexlify(actual,))
-        #raise Exception('failed validate: %s' % msg)
-
+class ValidateError(Exception):
+    """Device didn't reply as expected"""
+    pass
 
-def parse_version(buf, decode=True, verbose=False):
-    """Return best effort decoded version info as dict"""
-    assert len(buf) == 63 or len(buf) == 64
+def validate_read(expected, actual, msg, strict=False):
     """
-    Sample T48
-    00000000  00 01 30 00 07 01 07 00  32 30 32 32 2D 30 39 2D  |..0.....2022-09-|
-    00000010  32 31 30 39 3A 32 37 00  32 39 41 30 33 36 33 32  |2109:27.29A03632|
-    00000020  57 44 4E 35 59 46 4F 4D  4B 32 52 52 56 4A 30 41  |WDN5YFOMK2RRVJ0A|
-    00000030  32 46 39 53 39 36 31 33  1B 06 00 00 01 00 00     |2F9S9613....... |
+    Return True if actual is the expected reply
+    Otherwise print the difference, and raise ValidateError if strict
     """
-    ss = StructStreamer(buf, verbose=verbose)
+    if expected == actual:
+        return True
+    print('Failed %s' % msg)
+    print('  Expected; %s' % binascii.hexlify(expected,))
+    print('  Actual:   %s' % binascii.hexlify(actual,))
+    if strict:
+        raise ValidateError('failed validate: %s' % msg)
+    return False
+
+
+"""
+Version response layout, as StructStreamer calls
+Sample T48
+00000000  00 01 30 00 07 01 07 00  32 30 32 32 2D 30 39 2D  |..0.....2022-09-|
+00000010  32 31 30 39 3A 32 37 00  32 39 41 30 33 36 33 32  |2109:27.29A03632|
+00000020  57 44 4E 35 59 46 4F 4D  4B 32 52 52 56 4A 30 41  |WDN5YFOMK2RRVJ0A|
+00000030  32 46 39 53 39 36 31 33  1B 06 00 00 01 00 00     |2F9S9613....... |
+"""
+VERSION_FIELDS = [
     # always 00 01 30 00
     # magic number?
-    ss.res(4)
+    ("res", 4),
     # ex: 37 01 => version 1.55
     # ex: 41 01 => version 1.65
-    ss.u8("ver_minor")
-    ss.u8("ver_major")
+    ("u8", "ver_minor"),
+    ("u8", "ver_major"),
     # There are several bytes that correlate with model
     # Assume this for now
     # ex: 07 00 => T48
     # ex: 08 00 => T56
-    ss.u16l("model")
-    """
-    pop 13
-    00000000  32 32 2D 30 36 2D 32 38  32 33 3A 34 30 00 32 36  |22-06-2823:40.26|
-    00000010  42 30 31 33 33 36 39 57  50 4B 42 49 35 38 39 36  |B013369WPKBI5896|
-
-    pop 13
-    00000000  32 31 2D 31 30 2D 30 38  20 30 30 3A 33 37 31 33  |21-10-08 00:3713|
-    00000010  32 30 31 30 37 39 30 39  33 4C 57 39 52 56 36 4B  |201079093LW9RV6K|
-    """
-    ss.strn0("date", 16)
+    ("u16l", "model"),
+    # pop 13
+    # 00000000  32 32 2D 30 36 2D 32 38  32 33 3A 34 30 00 32 36  |22-06-2823:40.26|
+    # 00000010  42 30 31 33 33 36 39 57  50 4B 42 49 35 38 39 36  |B013369WPKBI5896|
+    #
+    # pop 13
+    # 00000000  32 31 2D 31 30 2D 30 38  20 30 30 3A 33 37 31 33  |21-10-08 00:3713|
+    # 00000010  32 30 31 30 37 39 30 39  33 4C 57 39 52 56 36 4B  |201079093LW9RV6K|
+    ("strn0", "date", 16),
     # GUI splits this into "DEV Code" + "Serial"
-    ss.strn("dev_code", 8)
-    ss.strn("serial", 24)
-    """
-    T48
-    0A 06 00 00 01 00 00
-    1B 06 00 00 01 00 00
-
-    T56
-    F3 05 00 00 01 00 00
-    """
-    ss.res(7)
+    ("strn", "dev_code", 8),
+    ("strn", "serial", 24),
+    # T48
+    # 0A 06 00 00 01 00 00
+    # 1B 06 00 00 01 00 00
+    #
+    # T56
+    # F3 05 00 00 01 00 00
+    ("res", 7),
+]
+# T56 has an extra 0 byte at the end, shrug
+VERSION_FIELDS_T56 = VERSION_FIELDS + [("assert_bytes", b"\x00")]
+# By response size
+VERSION_SCHEMAS = {
+    63: StructSchema(VERSION_FIELDS),
+    64: StructSchema(VERSION_FIELDS_T56),
+}
 
-    # T56 has an extra 0 byte at the end, shrug
-    if ss.d["model"] == 6:
-        ss.assert_str("\x00")
-
-    ret = ss.done()
+def parse_version(buf, decode=True, verbose=False):
+    """Return best effort decoded version info as dict"""
+    assert len(buf) == 63 or len(buf) == 64
+    if verbose:
+        # Field by field, with a dump of what's left at each step
+        ss = StructStreamer(buf, verbose=verbose)
+        VERSION_SCHEMAS[63].stream(ss)
+        if ss.d["model"] == 6:
+            ss.assert_str("\x00")
+        ret = ss.done()
+    else:
+        ret = VERSION_SCHEMAS[len(buf)].unpack(buf)
+        assert (ret["model"] == 6) == (len(buf) == 64), "model %u with %u byte version" % (ret["model"], len(buf))
     if decode:
         ret["model"] = model_i2s[ret["model"]]
     return ret
 
 
+def is_timeout(e):
+    import usb1
+
+    return isinstance(e, usb1.USBErrorTimeout)
+
 class T48:
-    def __init__(self, usbcontext, dev):
+    def __init__(self, usbcontext, dev, metrics=None, port=None, session=None):
         self.usbcontext = usbcontext
         self.dev = dev
+        # Session that opened this device, if any. Provides reconnect after reset
+        self.session = session
+        # Physical location, see device_port(). Used to find this unit again after reset
+        self.port = port
+        # Optional metrics.Metrics, records every USB call below
+        self.metrics = metrics
+        # Optional inventory.Inventory, kept current by version_raw() / reset()
+        self.inventory = None
+        # Raise ValidateError on unexpected replies instead of just printing them
+        self.strict = False
+        # Opcode of the last bulk command, attributed to the reads answering it
+        self.opcode = None
+        # Optional timeouts.TimeoutProfile: learns read latencies and shortens read timeouts
+        self.timeouts = None
+        # Optional timeouts.TimeoutStore: version_raw() picks .timeouts for the running firmware
+        self.timeout_store = None
+
+    def _io(self, method, endpoint, opcode, nbytes, f, *args):
+        if self.metrics is None:
+            return f(*args)
+        tstart = time.time()
+        try:
+            ret = f(*args)
+        except Exception as e:
+            self.metrics.observe(method, endpoint, opcode, 0, time.time() - tstart,
+                                 timeout=is_timeout(e), error=True)
+            raise
+        if nbytes is None:
+            nbytes = len(ret)
+        self.metrics.observe(method, endpoint, opcode, nbytes, time.time() - tstart)
+        return ret
+
+    def read_timeouts(self, method, opcode):
+        """Timeouts (ms) to attempt a read answering opcode with, in order"""
+        static = SLOW_TIMEOUTS.get((method, opcode), DEFAULT_TIMEOUT)
+        if self.timeouts is None:
+            return [static]
+        return self.timeouts.attempts(method, opcode, static)
+
+    def _read(self, method, endpoint, opcode, f, args, timeout):
+        """
+        Read with the caller's timeout, or else the profile's
+        A read that times out under a learned timeout is reissued with the next, longer one
+        """
+        if timeout is not None:
+            return self._io(method, endpoint, opcode, None, f, *(args + (timeout,)))
+        if self.timeouts is None:
+            return self._io(method, endpoint, opcode, None, f,
+                            *(args + (self.read_timeouts(method, opcode)[0],)))
+        attempts = self.read_timeouts(method, opcode)
+        tstart = time.time()
+        for i, timeout in enumerate(attempts):
+            try:
+                ret = self._io(method, endpoint, opcode, None, f, *(args + (timeout,)))
+                break
+            except Exception as e:
+                if i == len(attempts) - 1 or not is_timeout(e):
+                    raise
+        # Including the timed out attempts, so a slow command raises its own timeout
+        self.timeouts.observe(method, opcode, time.time() - tstart)
+        return ret
 
     def bulkRead(self, endpoint, length, timeout=None):
-        return self.dev.bulkRead(endpoint, length, timeout=(1000 if timeout is None else timeout))
+        return self._read("bulkRead", endpoint, self.opcode,
+                    self.dev.bulkRead, (endpoint, length), timeout)
 
     def bulkWrite(self, endpoint, data, timeout=None):
-        self.dev.bulkWrite(endpoint, data, timeout=(1000 if timeout is None else timeout))
+        if data:
+            self.opcode = data[0]
+        self._io("bulkWrite", endpoint, self.opcode, len(data),
+                    self.dev.bulkWrite, endpoint, data, (DEFAULT_TIMEOUT if timeout is None else timeout))
     
     def controlRead(self, bRequestType, bRequest, wValue, wIndex, wLength,
                     timeout=None):
-        return self.dev.controlRead(bRequestType, bRequest, wValue, wIndex, wLength,
-                    timeout=(1000 if timeout is None else timeout))
+        return self._read("controlRead", "control", bRequest,
+                    self.dev.controlRead, (bRequestType, bRequest, wValue, wIndex, wLength), timeout)
 
     def controlWrite(self, bRequestType, bRequest, wValue, wIndex, data,
                      timeout=None):
-        self.dev.controlWrite(bRequestType, bRequest, wValue, wIndex, data,
-                     timeout=(1000 if timeout is None else timeout))
+        self._io("controlWrite", "control", bRequest, len(data),
+                    self.dev.controlWrite, bRequestType, bRequest, wValue, wIndex, data,
+                    (DEFAULT_TIMEOUT if timeout is None else timeout))
 
     def interruptRead(self, endpoint, size, timeout=None):
-        return self.dev.interruptRead(endpoint, size,
-                    timeout=(1000 if timeout is None else timeout))
+        return self._io("interruptRead", endpoint, None, None,
+                    self.dev.interruptRead, endpoint, size, (DEFAULT_TIMEOUT if timeout is None else timeout))
 
     def interruptWrite(self, endpoint, data, timeout=None):
-        self.dev.interruptWrite(endpoint, data, timeout=(1000 if timeout is None else timeout))
+        self._io("interruptWrite", endpoint, None, len(data),
+                    self.dev.interruptWrite, endpoint, data, (DEFAULT_TIMEOUT if timeout is None else timeout))
 
     def version_raw(self, check_size=True):
         """
@@ -122,13 +255,18 @@ class T48:
                 b"\x32\x46\x39\x53\x39\x36\x31\x33\x1F\x06\x00\x00\x01\x00\x00")
         # Appears T48 is 63 and T56 is 64
         assert not check_size or len(buff) == 63 or len(buff) == 64
+        if self.inventory is not None and len(buff) in (63, 64):
+            self.inventory.record(buff, port=self.port)
+        if self.timeout_store is not None and len(buff) in (63, 64):
+            self.timeouts = self.timeout_store.profile(parse_version(buff))
         return buff
 
 
     def winusb_16(self):
         # Seems to be same as below, just fewer bytes verified
         buff = self.controlRead(0xC0, 0xEE, 0x0000, 0x0004, 16)
-        validate_read(b"\x28\x00\x00\x00\x00\x01\x04\x00\x01\x00\x00\x00\x00\x00\x00\x00", buff, "packet 33/34")
+        validate_read(b"\x28\x00\x00\x00\x00\x01\x04\x00\x01\x00\x00\x00\x00\x00\x00\x00", buff, "packet 33/34",
+                      strict=self.strict)
 
     def winusb_40(self):
         """
@@ -143,6 +281,8 @@ class T48:
                 b"\x00\x01\x57\x49\x4E\x55\x53\x42\x00\x00\x00\x00\x00\x00\x00\x00"
                 b"\x00\x00\x00\x00\x00\x00\x00\x00")
         assert len(buff) == len(ref)
+        if self.strict:
+            validate_read(ref, buff, "winusb descriptor", strict=True)
         return buff
 
     def reset0_raw(self):
@@ -151,63 +291,264 @@ class T48:
     def reset2_raw(self):
         self.bulkWrite(0x01, b"\x3F\x02\x00\x01\x00\xFF\x03\x08")
 
-    def reset(self, mode=0):
+    def reset(self, mode=0, timeout=10.0, hotplug=True):
         """
-        Reset and grab the new device / context after it comes back up
+        Reset and grab the new device handle after it comes back up
+        hotplug: wait on the arrival event where libusb supports it, else poll
         """
+        session = self.get_session()
+        # Register before the reset so the arrival can't slip by
+        watch = session.watch(port=self.port) if hotplug else None
+        try:
+            if mode == 0:
+                self.reset0_raw()
+            elif mode == 2:
+                self.reset2_raw()
+            else:
+                assert 0, mode
 
-        if mode == 0:
-            self.reset0_raw()
-        elif mode == 2:
-            self.reset2_raw()
-        else:
-            assert 0, mode
+            # Needed on macOS. Don't ask
+            if sys.platform == "darwin":
+                time.sleep(3)
 
-        # Needed on macOS. Don't ask
-        time.sleep(3)
+            self.reconnect(timeout=timeout, watch=watch)
+        finally:
+            if watch is not None:
+                watch.close()
 
-        # 1.4 sec
-        tstart = time.time()
-        while True:
-            try:
-                t = get()
-                break
-            except DeviceNotFound:
-                pass
-            except usb1.USBErrorBusy:
-                pass
-            time.sleep(0.05)
-        dt = time.time() - tstart
-        # print("Found after %0.1f sec" % dt)
+    def reconnect(self, timeout=10.0, watch=None):
+        """
+        Grab a new handle to this device, ex: after it re-enumerated or dropped off the bus
+        """
+        if self.inventory is not None:
+            # May come back as something else, ex: new firmware
+            self.inventory.invalidate(port=self.port)
+        dev = self.get_session().reopen(port=self.port, watch=watch, timeout=timeout)
+        # Shift in new device. The old handle points at a device that is gone
+        old, self.dev = self.dev, dev
+        old.close()
+
+    def get_session(self):
+        if self.session is None:
+            # Borrow our context, leave it open
+            return Session(self.usbcontext)
+        return self.session
 
-        # Shift in new device
-        self.usbcontext = t.usbcontext
-        self.dev = t.dev
+    def close(self):
+        if self.session is None:
+            self.dev.close()
+            self.usbcontext.close()
+        else:
+            self.session.release(self)
 
-def open_dev(usbcontext=None):
-    vid_want = 0xA466
-    pid_want = 0x0A53
+def device_port(udev):
+    """
+    Physical location: (bus, hub port path)
+    Unlike the device address this survives the re-enumeration after a reset
+    """
+    return (udev.getBusNumber(), tuple(udev.getPortNumberList()))
+
+def list_devices(usbcontext, bus=None, address=None, port=None):
+    """Return USBDevice for every attached programmer matching the given location"""
+    ret = []
+    for udev in usbcontext.getDeviceIterator(skip_on_error=True):
+        # Cheapest check first: comes from the cached device descriptor
+        if udev.getVendorID() != VID or udev.getProductID() != PID:
+            continue
+        if bus is not None and udev.getBusNumber() != bus:
+            continue
+        if address is not None and udev.getDeviceAddress() != address:
+            continue
+        if port is not None and device_port(udev) != port:
+            continue
+        ret.append(udev)
+    return ret
+
+def open_dev(usbcontext=None, bus=None, address=None, port=None, verbose=True):
+    import usb1
 
     if usbcontext is None:
         usbcontext = usb1.USBContext()
     
-    print('Scanning for devices...')
-    for udev in usbcontext.getDeviceList(skip_on_error=True):
-        vid = udev.getVendorID()
-        pid = udev.getProductID()
-        if (vid, pid) == (vid_want, pid_want):
+    if verbose:
+        print('Scanning for devices...')
+    for udev in list_devices(usbcontext, bus=bus, address=address, port=port):
+        if verbose:
             print('Found device')
             print('Bus %03i Device %03i: ID %04x:%04x' % (
                 udev.getBusNumber(),
                 udev.getDeviceAddress(),
-                vid,
-                pid))
-            return udev.open()
+                udev.getVendorID(),
+                udev.getProductID()))
+        return udev.open()
     raise DeviceNotFound("Failed to find a device")
 
-def get():
-    usbcontext = usb1.USBContext()
-    dev = open_dev(usbcontext)
-    dev.claimInterface(0)
-    dev.resetDevice()
-    return T48(usbcontext=usbcontext, dev=dev)
+def get(bus=None, address=None, port=None, serial=None):
+    """
+    Open a programmer, by default the first one found
+    serial: pick by version serial. Queries candidates that are not already in use
+    The returned T48 owns its Session: close() releases the context too
+    """
+    session = Session(autoclose=True)
+    try:
+        return session.open(bus=bus, address=address, port=port, serial=serial)
+    except BaseException:
+        session.close()
+        raise
+
+
+class Session:
+    """
+    One long lived USBContext shared by every device opened through it
+    Use as a context manager to close devices + context deterministically:
+
+    with Session() as session:
+        t = session.open()
+        t.reset()
+
+    usbcontext: use an existing context instead. It is then left open
+    autoclose: close once the last device is released
+    """
+    def __init__(self, usbcontext=None, autoclose=False):
+        if usbcontext is None:
+            import usb1
+
+            usbcontext = usb1.USBContext()
+            self.owns_context = True
+        else:
+            self.owns_context = False
+        self.usbcontext = usbcontext
+        self.autoclose = autoclose
+        # Open T48s, closed with the session
+        self.devices = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def list_devices(self, bus=None, address=None, port=None):
+        return list_devices(self.usbcontext, bus=bus, address=address, port=port)
+
+    def open(self, bus=None, address=None, port=None, serial=None, verbose=True):
+        """
+        Open a programmer as T48, by default the first one found
+        serial: pick by version serial. Queries candidates that are not already in use
+        """
+        import usb1
+
+        if serial is None:
+            dev = open_dev(self.usbcontext, bus=bus, address=address, port=port, verbose=verbose)
+            dev.claimInterface(0)
+            dev.resetDevice()
+            return self.add(dev, device_port(dev.getDevice()))
+
+        for udev in self.list_devices(bus=bus, address=address, port=port):
+            dev = udev.open()
+            try:
+                dev.claimInterface(0)
+            except usb1.USBErrorBusy:
+                # Someone else is driving it
+                dev.close()
+                continue
+            dev.resetDevice()
+            t = T48(usbcontext=self.usbcontext, dev=dev, port=device_port(udev))
+            if parse_version(t.version_raw())["serial"] == serial:
+                return self.add(dev, t.port)
+            dev.close()
+        raise DeviceNotFound("Failed to find a device with serial %s" % serial)
+
+    def add(self, dev, port):
+        t = T48(usbcontext=self.usbcontext, dev=dev, port=port, session=self)
+        self.devices.append(t)
+        return t
+
+    def watch(self, port=None):
+        """ArrivalWatch on this context. Create before triggering re-enumeration"""
+        return ArrivalWatch(self.usbcontext, port=port)
+
+    def reopen(self, port=None, watch=None, timeout=10.0):
+        """
+        Return a claimed handle to a programmer that is re-enumerating, ex: after a reset
+        With a supported ArrivalWatch this returns as soon as the device is back
+        Otherwise poll every 50 ms
+        Quiet, and no resetDevice(): the device just came up fresh
+        """
+        import usb1
+
+        deadline = time.time() + timeout
+        if watch is not None and watch.supported:
+            watch.wait(timeout)
+        while True:
+            dev = None
+            try:
+                dev = open_dev(self.usbcontext, port=port, verbose=False)
+                dev.claimInterface(0)
+                return dev
+            except (DeviceNotFound, usb1.USBErrorBusy):
+                # Busy: arrived but the OS hasn't let go of it yet
+                if dev is not None:
+                    dev.close()
+            if time.time() >= deadline:
+                raise DeviceNotFound("Device didn't come back after %0.1f sec" % timeout)
+            time.sleep(0.05)
+
+    def release(self, t):
+        """Close t's handle. Called by T48.close()"""
+        if t in self.devices:
+            self.devices.remove(t)
+            t.dev.close()
+        if self.autoclose and not self.devices:
+            self.close()
+
+    def close(self):
+        while self.devices:
+            self.devices.pop().dev.close()
+        if self.usbcontext is not None:
+            if self.owns_context:
+                self.usbcontext.close()
+            self.usbcontext = None
+
+
+class ArrivalWatch:
+    """
+    Catch a programmer (re)appearing on the bus using libusb hotplug events
+    supported is False where libusb has no hotplug (ex: Windows), callers should poll instead
+    """
+    def __init__(self, usbcontext, port=None):
+        import usb1
+
+        self.usbcontext = usbcontext
+        self.port = port
+        self.arrived = False
+        self.handle = None
+        self.supported = bool(usbcontext.hasCapability(usb1.CAP_HAS_HOTPLUG))
+        if self.supported:
+            self.handle = usbcontext.hotplugRegisterCallback(
+                self.callback, events=usb1.HOTPLUG_EVENT_DEVICE_ARRIVED,
+                flags=0, vendor_id=VID, product_id=PID)
+
+    def callback(self, usbcontext, udev, event):
+        # Runs inside event handling: no synchronous libusb calls here
+        if self.port is not None and device_port(udev) != self.port:
+            return False
+        self.arrived = True
+        # Returning True deregisters
+        self.handle = None
+        return True
+
+    def wait(self, timeout):
+        """Return True once the device arrived, False on timeout"""
+        deadline = time.time() + timeout
+        while not self.arrived:
+            remain = deadline - time.time()
+            if remain <= 0:
+                break
+            self.usbcontext.handleEventsTimeout(min(remain, 0.1))
+        return self.arrived
+
+    def close(self):
+        if self.handle is not None:
+            self.usbcontext.hotplugDeregisterCallback(self.handle)
+            self.handle = None
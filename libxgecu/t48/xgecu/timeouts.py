@@ -0,0 +1,135 @@
+"""
+USB read timeouts learned from observed latencies
+
+Each (method, opcode) keeps a bounded window of recent latencies
+Once there are enough, its timeout is a high percentile times a safety margin
+A read that times out under a learned timeout is reissued with longer ones (backoff),
+the last always being the static timeout, so a reply rarer than the percentile
+(ex: an occasional slow flash write) still gets through as it did without a profile
+
+Profiles are kept per model + firmware version, since that's what decides command timing
+"""
+
+import json
+import os
+import threading
+from collections import deque
+from .util import cache_path
+
+# Latencies kept per command
+MAX_SAMPLES = 256
+# Samples needed before the learned timeout is trusted
+MIN_SAMPLES = 20
+PERCENTILE = 0.99
+# Learned timeout = percentile latency * MARGIN, clamped to [FLOOR_MS, the static timeout]
+MARGIN = 3.0
+FLOOR_MS = 50
+# Learned read attempts before the final static one, each BACKOFF times longer than the previous
+ATTEMPTS = 2
+BACKOFF = 2
+
+def default_path():
+    return cache_path("timeouts.json")
+
+def profile_key(version):
+    """Profile name for a parse_version() dict, ex: t48 1.07"""
+    return "%s %u.%02u" % (version["model"], version["ver_major"], version["ver_minor"])
+
+def command_key(method, opcode):
+    return "%s %s" % (method, "" if opcode is None else "0x%02X" % opcode)
+
+def backoff(attempt, base=0.1, factor=2, cap=5.0):
+    """Seconds to wait before retry attempt (1 based)"""
+    return min(base * factor ** (attempt - 1), cap)
+
+
+class TimeoutProfile:
+    """Latency samples + learned timeouts for one model / firmware version. Thread safe"""
+    def __init__(self, samples=None):
+        self.lock = threading.Lock()
+        self.samples = {}
+        for k, dts in (samples or {}).items():
+            self.samples[k] = deque(dts, maxlen=MAX_SAMPLES)
+
+    def observe(self, method, opcode, dt):
+        k = command_key(method, opcode)
+        with self.lock:
+            dts = self.samples.get(k)
+            if dts is None:
+                dts = self.samples[k] = deque(maxlen=MAX_SAMPLES)
+            dts.append(dt)
+
+    def learned_ms(self, method, opcode):
+        """Learned timeout in ms, or None if there aren't enough samples yet"""
+        with self.lock:
+            dts = self.samples.get(command_key(method, opcode))
+            if dts is None or len(dts) < MIN_SAMPLES:
+                return None
+            dts = sorted(dts)
+        dt = dts[min(int(len(dts) * PERCENTILE), len(dts) - 1)]
+        return int(dt * MARGIN * 1000) + 1
+
+    def attempts(self, method, opcode, static_ms):
+        """
+        Timeouts (ms) to try a read with, in order
+        The static timeout alone until learned, else growing learned timeouts then static_ms
+        """
+        ms = self.learned_ms(method, opcode)
+        if ms is None or ms >= static_ms:
+            return [static_ms]
+        ms = max(ms, FLOOR_MS)
+        ret = []
+        for _ in range(ATTEMPTS):
+            if ms >= static_ms:
+                break
+            ret.append(ms)
+            ms *= BACKOFF
+        # Never give up sooner than without a profile
+        ret.append(static_ms)
+        return ret
+
+    def to_dict(self):
+        with self.lock:
+            return {k: list(dts) for k, dts in self.samples.items()}
+
+
+class TimeoutStore:
+    """TimeoutProfiles by model + firmware version, persisted as JSON at path"""
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.lock = threading.Lock()
+        self.profiles = {}
+        try:
+            with open(self.path, "r") as f:
+                for k, samples in json.load(f)["profiles"].items():
+                    self.profiles[k] = TimeoutProfile(samples)
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            # Corrupt, relearn
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.save()
+
+    def profile(self, version):
+        """TimeoutProfile for a parse_version() dict"""
+        k = profile_key(version)
+        with self.lock:
+            profile = self.profiles.get(k)
+            if profile is None:
+                profile = self.profiles[k] = TimeoutProfile()
+            return profile
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"profiles": {k: p.to_dict() for k, p in self.profiles.items()}},
+                              sort_keys=True)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = "%s.%u.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
@@ -0,0 +1,178 @@
+"""
+Pipelined firmware upload over libusb asynchronous transfers
+
+Lock-step upload pays a full USB round trip per chunk
+Here up to window (write, ack read) pairs are kept in flight instead
+"""
+
+import time
+from .t48 import TRANSFER_COMPLETED, TRANSFER_TIMED_OUT, ValidateError, status_i2s
+
+
+class UploadError(ValidateError):
+    pass
+
+
+class TransferPair:
+    """A chunk write and its ack read"""
+    def __init__(self, dev):
+        self.wr = dev.getTransfer()
+        self.rd = dev.getTransfer()
+        self.seq = None
+        self.length = 0
+        self.opcode = None
+        self.tstart = None
+
+    def submit(self, seq, ep_out, ep_in, data, ack_len, timeout):
+        self.seq = seq
+        self.length = len(data)
+        self.opcode = data[0] if data else None
+        self.tstart = time.time()
+        self.wr.setBulk(ep_out, data, timeout=timeout)
+        self.rd.setBulk(ep_in, ack_len, timeout=timeout)
+        self.wr.submit()
+        try:
+            self.rd.submit()
+        except Exception:
+            self.wr.cancel()
+            raise
+
+    def done(self):
+        return not self.wr.isSubmitted() and not self.rd.isSubmitted()
+
+    def cancel(self):
+        for transfer in (self.wr, self.rd):
+            if transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except Exception:
+                    # Raced to completion
+                    pass
+
+    def ack(self):
+        return bytes(self.rd.getBuffer()[:self.rd.getActualLength()])
+
+    def error(self, validate):
+        """Return an error string, or None if the chunk went through"""
+        status = self.wr.getStatus()
+        if status != TRANSFER_COMPLETED:
+            return "write %s" % status_i2s.get(status, status)
+        if self.wr.getActualLength() != self.length:
+            return "short write %u / %u" % (self.wr.getActualLength(), self.length)
+        status = self.rd.getStatus()
+        if status != TRANSFER_COMPLETED:
+            return "ack %s" % status_i2s.get(status, status)
+        return validate(self.ack())
+
+    def observe(self, metrics, ep_out, error):
+        """Record the write + ack round trip"""
+        timeout = TRANSFER_TIMED_OUT in (self.wr.getStatus(), self.rd.getStatus())
+        metrics.observe("asyncBulkWrite", ep_out, self.opcode, self.length,
+                        time.time() - self.tstart, timeout=timeout, error=error is not None)
+
+    def close(self):
+        self.wr.close()
+        self.rd.close()
+
+
+class PipelinedUploader:
+    """
+    Keep up to window chunk (write, ack read) pairs in flight
+
+    Acks come back in submission order on the IN endpoint, so they are matched to chunks by position
+    On the first bad chunk, no more chunks are submitted, everything in flight is cancelled
+    and drained, then UploadError is raised
+
+    Only uses dev.getTransfer(), the USBTransfer bulk calls and usbcontext.handleEventsTimeout()
+    so fakeusb can stand in for hardware
+    """
+    def __init__(self, dev, usbcontext, window=8, ep_out=0x01, ep_in=0x81,
+                 ack_len=0x200, timeout=1000, event_tv=0.1, metrics=None):
+        assert window >= 1
+        self.dev = dev
+        self.usbcontext = usbcontext
+        self.window = window
+        self.ep_out = ep_out
+        self.ep_in = ep_in
+        self.ack_len = ack_len
+        self.timeout = timeout
+        self.event_tv = event_tv
+        # Optional metrics.Metrics
+        self.metrics = metrics
+        self.chunks = 0
+        self.bytes = 0
+        self.dt = 0.0
+
+    def run(self, chunks, expected_ack):
+        """
+        Send every chunk, each must be acked with exactly expected_ack
+        Return number of chunks sent
+        """
+        def validate(ack):
+            if ack != expected_ack:
+                return "bad ack %s" % ack.hex()
+            return None
+        return self.run_validate(chunks, validate)
+
+    def run_validate(self, chunks, validate):
+        """
+        validate(ack) returns an error string or None
+        Return number of chunks sent
+        """
+        chunks = iter(chunks)
+        free = [TransferPair(self.dev) for _ in range(self.window)]
+        pairs = list(free)
+        pending = []
+        error = None
+        seq = 0
+        tstart = time.time()
+
+        try:
+            while True:
+                while error is None and free:
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        break
+                    pair = free.pop()
+                    pair.submit(seq, self.ep_out, self.ep_in, chunk, self.ack_len, self.timeout)
+                    pending.append(pair)
+                    seq += 1
+                    self.bytes += len(chunk)
+
+                if not pending:
+                    break
+
+                # Retire in order
+                if pending[0].done():
+                    pair = pending.pop(0)
+                    if error is None:
+                        msg = pair.error(validate)
+                        if self.metrics is not None:
+                            pair.observe(self.metrics, self.ep_out, msg)
+                        if msg is None:
+                            self.chunks += 1
+                        else:
+                            error = UploadError("chunk %u: %s" % (pair.seq, msg))
+                            for other in pending:
+                                other.cancel()
+                    free.append(pair)
+                    continue
+
+                self.usbcontext.handleEventsTimeout(self.event_tv)
+        except BaseException:
+            # Don't leave transfers pointing at buffers we are about to drop
+            for pair in pending:
+                pair.cancel()
+            while any(not pair.done() for pair in pending):
+                self.usbcontext.handleEventsTimeout(self.event_tv)
+            raise
+        finally:
+            self.dt += time.time() - tstart
+            for pair in pairs:
+                if pair.done():
+                    pair.close()
+
+        if error is not None:
+            raise error
+        return self.chunks
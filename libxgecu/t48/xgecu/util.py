@@ -1,47 +1,215 @@
+import os
 import sys
 import struct
+import queue
+import threading
 
-def hexdump(data, label=None, indent='', address_width=8, f=sys.stdout):
-    def isprint(c):
-        return c >= ' ' and c <= '~'
+# Printable ASCII as is, everything else as .
+HEXDUMP_PRINTABLE = bytes(c if 0x20 <= c <= 0x7E else ord('.') for c in range(256))
+HEXDUMP_ROW = 16
+HEXDUMP_HALF = 8
+# Rows read at a time when streaming
+HEXDUMP_CHUNK = 4096 * HEXDUMP_ROW
+
+
+def hexdump_row(row):
+    """Hex + char columns of one row of up to 16 bytes, ex: '00 01 ... 0F  |................|'"""
+    left = row[:HEXDUMP_HALF].hex(" ").upper()
+    right = row[HEXDUMP_HALF:].hex(" ").upper()
+    # '%02X ' per byte, each half padded to 8 bytes, plus a space
+    return "%-24s %-24s |%-16s|" % (left and left + " ", right and right + " ",
+                                    bytes(row).translate(HEXDUMP_PRINTABLE).decode("ascii"))
+
+
+def hexdump_lines(chunks, indent='', address_width=8, base=0, collapse=False):
+    """
+    Yield hexdump output lines for an iterable of byte chunks of any size
+    collapse: print repeated rows as a single *, like hexdump -C
+    """
+    addr_fmt = "%s%%0%dX  " % (indent.replace("%", "%%"), address_width) if address_width else None
+    pos = base
+    prev = None
+    starred = False
+    carry = b""
+    for chunk in chunks:
+        if carry:
+            chunk = carry + bytes(chunk)
+        n = len(chunk) - len(chunk) % HEXDUMP_ROW
+        carry = bytes(chunk[n:])
+        full = bytes(chunk[:n])
+        # Format the whole chunk at once, then slice rows out: 3 hex chars + 1 char per byte
+        hexs = full.hex(" ").upper()
+        text = full.translate(HEXDUMP_PRINTABLE).decode("ascii")
+        for i in range(0, n, HEXDUMP_ROW):
+            if collapse:
+                row = full[i:i + HEXDUMP_ROW]
+                if row == prev:
+                    if not starred:
+                        yield indent + "*\n"
+                        starred = True
+                    pos += HEXDUMP_ROW
+                    continue
+                prev = row
+                starred = False
+            h = 3 * i
+            yield "%s%s  %s  |%s|\n" % (addr_fmt % pos if addr_fmt else indent,
+                                        hexs[h:h + 23], hexs[h + 24:h + 47], text[i:i + HEXDUMP_ROW])
+            pos += HEXDUMP_ROW
+    if carry:
+        yield (addr_fmt % pos if addr_fmt else indent) + hexdump_row(carry) + "\n"
+        pos += len(carry)
+    if collapse and addr_fmt:
+        # Where the data ends, since * hides it
+        yield (addr_fmt % pos).rstrip() + "\n"
+
+
+def iter_chunks(data, chunk_size=HEXDUMP_CHUNK):
+    """Zero copy bounded slices of a bytes-like, mmap included"""
+    view = memoryview(data).cast("B")
+    for i in range(0, len(view), chunk_size):
+        yield view[i:i + chunk_size]
+
+
+def hexdump(data, label=None, indent='', address_width=8, f=None, collapse=False, base=0):
+    """
+    Classic 16 bytes per row hex + ASCII dump
+    data: any bytes-like, including mmap. Formatted in bounded chunks
+    """
+    if f is None:
+        f = sys.stdout
 
     if label:
-        print(label)
+        f.write(label + "\n")
+
+    lines = []
+    for line in hexdump_lines(iter_chunks(data), indent=indent, address_width=address_width,
+                              base=base, collapse=collapse):
+        lines.append(line)
+        if len(lines) >= 4096:
+            f.write("".join(lines))
+            lines = []
+    f.write("".join(lines))
+
+
+def hexdump_file(f_in, indent='', address_width=8, f=None, collapse=True, base=0,
+                 chunk_size=HEXDUMP_CHUNK):
+    """
+    hexdump a file without reading it all in
+    f_in: file name or binary file object
+    """
+    if f is None:
+        f = sys.stdout
+    if isinstance(f_in, str):
+        with open(f_in, "rb") as fin:
+            return hexdump_file(fin, indent=indent, address_width=address_width, f=f,
+                                collapse=collapse, base=base, chunk_size=chunk_size)
+
+    def chunks():
+        while True:
+            chunk = f_in.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
 
-    bytes_per_half_row = 8
-    bytes_per_row = 16
-    data = bytearray(data)
-    data_len = len(data)
+    lines = []
+    for line in hexdump_lines(chunks(), indent=indent, address_width=address_width,
+                              base=base, collapse=collapse):
+        lines.append(line)
+        if len(lines) >= 4096:
+            f.write("".join(lines))
+            lines = []
+    f.write("".join(lines))
 
-    def hexdump_half_row(start):
-        left = max(data_len - start, 0)
 
-        real_data = min(bytes_per_half_row, left)
+def hexdump_diff(a, b, indent='', address_width=8, f=None, context=0, base=0):
+    """
+    Side by side hexdump of two buffers
+    Rows that differ are marked with !, rows only one side has with < or >
+    Runs of identical rows are shown as *, except for context rows around differences
+    """
+    if f is None:
+        f = sys.stdout
+    a = memoryview(a).cast("B")
+    b = memoryview(b).cast("B")
+    addr_fmt = "%s%%0%dX  " % (indent.replace("%", "%%"), address_width) if address_width else None
+    blank = " " * len(hexdump_row(b""))
+    size = max(len(a), len(b))
+    nrows = (size + HEXDUMP_ROW - 1) // HEXDUMP_ROW
 
-        f.write(''.join('%02X ' % c for c in data[start:start + real_data]))
-        f.write(''.join('   ' * (bytes_per_half_row - real_data)))
-        f.write(' ')
+    def row_of(buf, i):
+        return buf[i * HEXDUMP_ROW:(i + 1) * HEXDUMP_ROW]
 
-        return start + bytes_per_half_row
+    different = [row_of(a, i) != row_of(b, i) for i in range(nrows)]
+    show = list(different)
+    for i, diff in enumerate(different):
+        if diff:
+            for j in range(max(i - context, 0), min(i + context + 1, nrows)):
+                show[j] = True
 
-    pos = 0
-    while pos < data_len:
-        row_start = pos
-        f.write(indent)
-        if address_width:
-            f.write(('%%0%dX  ' % address_width) % pos)
-        pos = hexdump_half_row(pos)
-        pos = hexdump_half_row(pos)
-        f.write("|")
-        # Char view
-        left = data_len - row_start
-        real_data = min(bytes_per_row, left)
+    lines = []
+    starred = False
+    for i in range(nrows):
+        if not show[i]:
+            if not starred:
+                lines.append(indent + "*\n")
+                starred = True
+            continue
+        starred = False
+        ra = row_of(a, i)
+        rb = row_of(b, i)
+        if not len(rb):
+            mark = "<"
+        elif not len(ra):
+            mark = ">"
+        else:
+            mark = "!" if different[i] else " "
+        prefix = addr_fmt % (base + i * HEXDUMP_ROW) if addr_fmt else indent
+        lines.append("%s%s %s %s\n" % (prefix, hexdump_row(ra) if len(ra) else blank,
+                                        mark, hexdump_row(rb) if len(rb) else blank))
+    f.write("".join(lines))
+    return sum(different)
 
-        f.write(''.join([
-            c if isprint(c) else '.'
-            for c in tostr(data[row_start:row_start + real_data])
-        ]))
-        f.write((" " * (bytes_per_row - real_data)) + "|\n")
+
+def prefetch(iterable, depth=2):
+    """
+    Run iterable in a background thread, up to depth items ahead of the consumer
+    Lets producer work (ex: crypto) overlap consumer I/O that releases the GIL (ex: USB)
+    Producer exceptions are re-raised in the consumer
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    thread = threading.Thread(target=producer, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, e = q.get()
+            if item is done:
+                if e is not None:
+                    raise e
+                return
+            yield item
+    finally:
+        stop.set()
 
 
 def add_bool_arg(parser, yes_arg, default=False, **kwargs):
@@ -58,6 +226,16 @@ def add_bool_arg(parser, yes_arg, default=False, **kwargs):
                         action='store_false',
                         **kwargs)
 
+def cache_path(name):
+    """name in the per user libxgecu cache dir, ex: ~/.cache/libxgecu/name"""
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "libxgecu", name)
+
+def data_path(name):
+    """name in the per user libxgecu data dir, ex: ~/.local/share/libxgecu/name"""
+    data_dir = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(data_dir, "libxgecu", name)
+
 def tobytes(buff):
     if type(buff) is str:
         #return bytearray(buff, 'ascii')
@@ -80,27 +258,57 @@ def tostr(buff):
 def isprint(c):
     return c >= ' ' and c <= '~'
 
+U16B = struct.Struct('>H')
+U16L = struct.Struct('<H')
+U32B = struct.Struct('>I')
+U32L = struct.Struct('<I')
+
+def res_key(offset, size):
+    """Default name of reserved bytes at offset in a size byte record"""
+    if size < 10:
+        return "res%01u" % offset
+    elif size < 100:
+        return "res%02u" % offset
+    else:
+        return "res%03u" % offset
+
+def latin1(buf):
+    """Same as tostr(), for any bytes-like"""
+    return bytes(buf).decode("latin-1")
+
 class StructStreamer:
+    """
+    Decode a record field by field, walking a cursor over the buffer
+    """
     def __init__(self, buf, verbose=False):
-        self.buf = bytearray(buf)
+        self.buf = memoryview(buf).cast("B")
         self.len = len(self.buf)
+        self.pos = 0
         self.d = {}
         self.verbose = verbose
 
     def done(self):
-        assert len(self.buf) == 0
+        assert self.pos == self.len, "%u bytes left over" % (self.len - self.pos)
         return self.d
 
     def popped(self):
         """Number of bytes consumed so far"""
-        return self.len - len(self.buf)
+        return self.pos
+
+    def left(self):
+        return self.len - self.pos
+
+    def advance(self, n):
+        """Move the cursor n bytes. Return the old position"""
+        self.verbose and hexdump(self.buf[self.pos:], "pop %u" % n)
+        assert self.len - self.pos >= n, "Only %u bytes left, need %u" % (self.len - self.pos, n)
+        pos = self.pos
+        self.pos += n
+        return pos
 
     def pop_n(self, n):
-        self.verbose and hexdump(self.buf, "pop %u" % n)
-        assert len(self.buf) >= n, "Only %u bytes left, need %u" % (len(self.buf), n)
-        v = self.buf[0:n]
-        del self.buf[0:n]
-        return v
+        pos = self.advance(n)
+        return bytearray(self.buf[pos:pos + n])
 
     def assert_bytes(self, buf):
         got = self.pop_n(len(buf))
@@ -116,12 +324,7 @@ class StructStreamer:
         Add n reserved / unknown bytes
         """
         if k is None:
-            if self.len < 10:
-                k = "res%01u" % self.popped()
-            elif self.len < 100:
-                k = "res%02u" % self.popped()
-            else:
-                k = "res%03u" % self.popped()
+            k = res_key(self.popped(), self.len)
         v = self.pop_n(n)
         self.d[k] = v
         return v
@@ -130,7 +333,8 @@ class StructStreamer:
         """
         pop string of exactly n characters
         """
-        v = tostr(self.pop_n(n))
+        pos = self.advance(n)
+        v = latin1(self.buf[pos:pos + n])
         self.d[k] = v
         return v
 
@@ -138,37 +342,114 @@ class StructStreamer:
         """
         pop string of exactly n characters, but truncate at first 0, if any
         """
-        buf = self.pop_n(n)
-        i = buf.find(0)
-        if i >= 0:
-            buf = buf[0:i]
-        v = tostr(buf)
+        pos = self.advance(n)
+        v = latin1(self.buf[pos:pos + n]).split("\x00", 1)[0]
         self.d[k] = v
         return v
 
-    def u32b(self, k):
-        v = struct.unpack('>I', self.pop_n(4))[0]
+    def unpack(self, k, st):
+        v = st.unpack_from(self.buf, self.advance(st.size))[0]
         self.d[k] = v
         return v
 
+    def u32b(self, k):
+        return self.unpack(k, U32B)
+
     def u32l(self, k):
-        v = struct.unpack('<I', self.pop_n(4))[0]
-        self.d[k] = v
-        del self.buf[0:4]
-        return v
+        return self.unpack(k, U32L)
     
     def u16b(self, k):
-        v = struct.unpack('>H', self.pop_n(2))[0]
-        self.d[k] = v
-        return v
+        return self.unpack(k, U16B)
     
     def u16l(self, k):
-        v = struct.unpack('<H', self.pop_n(2))[0]
-        self.d[k] = v
-        return v
+        return self.unpack(k, U16L)
 
     def u8(self, k):
-        v = self.buf[0]
+        v = self.buf[self.advance(1)]
         self.d[k] = v
-        del self.buf[0:1]
         return v
+
+
+class StructSchema:
+    """
+    Fixed record layout compiled into a single struct.Struct
+
+    fields are StructStreamer calls as tuples, ex:
+    [("res", 4), ("u8", "ver_minor"), ("strn0", "date", 16), ("assert_bytes", b"\x00")]
+    unpack() gives the same dict as running those calls on a StructStreamer + done()
+    """
+    def __init__(self, fields):
+        self.fields = list(fields)
+        fmt = "<"
+        # (key, offset, convert)
+        layout = []
+        offset = 0
+        for field in self.fields:
+            kind, args = field[0], field[1:]
+            if kind == "u8":
+                fmt += "B"
+                layout.append((args[0], offset, None))
+                offset += 1
+            elif kind in ("u16l", "u32l"):
+                fmt += "H" if kind == "u16l" else "I"
+                layout.append((args[0], offset, None))
+                offset += 2 if kind == "u16l" else 4
+            elif kind in ("u16b", "u32b"):
+                n = 2 if kind == "u16b" else 4
+                fmt += "%us" % n
+                layout.append((args[0], offset, lambda v: int.from_bytes(v, "big")))
+                offset += n
+            elif kind == "res":
+                n = args[0]
+                fmt += "%us" % n
+                layout.append((args[1] if len(args) > 1 else None, offset, bytearray))
+                offset += n
+            elif kind == "strn":
+                fmt += "%us" % args[1]
+                layout.append((args[0], offset, latin1))
+                offset += args[1]
+            elif kind == "strn0":
+                fmt += "%us" % args[1]
+                layout.append((args[0], offset, lambda v: latin1(v).split("\x00", 1)[0]))
+                offset += args[1]
+            elif kind in ("assert_bytes", "assert_str"):
+                want = args[0].encode("latin-1") if kind == "assert_str" else bytes(args[0])
+
+                def check(v, want=want):
+                    assert v == want, "Wanted %s got %s" % (want, v)
+                fmt += "%us" % len(want)
+                layout.append((False, offset, check))
+                offset += len(want)
+            else:
+                raise ValueError("Unknown field type %s" % kind)
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        # Reserved byte names depend on record size, like StructStreamer.res()
+        self.layout = [(res_key(offset, self.size) if k is None else k, convert)
+                       for k, offset, convert in layout]
+
+    def decode(self, values):
+        ret = {}
+        for (k, convert), v in zip(self.layout, values):
+            if convert is not None:
+                v = convert(v)
+            if k is not False:
+                ret[k] = v
+        return ret
+
+    def unpack(self, buf):
+        return self.decode(self.struct.unpack(buf))
+
+    def unpack_from(self, buf, offset=0):
+        return self.decode(self.struct.unpack_from(buf, offset))
+
+    def iter_unpack(self, buf):
+        """Decode back to back records"""
+        for values in self.struct.iter_unpack(buf):
+            yield self.decode(values)
+
+    def stream(self, ss):
+        """Run the fields through StructStreamer ss instead, ex: to get verbose output"""
+        for field in self.fields:
+            getattr(ss, field[0])(*field[1:])
+        return ss
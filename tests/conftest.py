@@ -0,0 +1,43 @@
+"""
+Fixtures shared by the tests
+Images are built with a random key, not key.dat
+"""
+
+import binascii
+import random
+import pytest
+from libxgecu.t48 import t48crypto as t48
+from libxgecu.t48.t48decrypt import BLOCK_OFFSET, PAYLOAD_SIZE, flash_base
+
+@pytest.fixture
+def ks(tmp_path):
+    """Random key installed as the default key, which the reference functions use"""
+    rng = random.Random(0x48)
+    key_fn = tmp_path / "key.dat"
+    key_fn.write_bytes(bytes(rng.getrandbits(8) for _ in range(t48.KEY_SIZE)))
+    provider = t48.KeyProvider(str(key_fn))
+    old = t48._provider
+    t48.set_key_provider(provider)
+    try:
+        yield provider.schedule()
+    finally:
+        t48.set_key_provider(old)
+
+@pytest.fixture
+def make_image(ks):
+    """
+    make_image(offsets=None, version=(2, 1), seed=0) => .dat bytes encrypted with ks
+    One block per flash offset, random payloads. Default: 32 blocks from flash_base
+    """
+    def make(offsets=None, version=(2, 1), seed=0):
+        if offsets is None:
+            offsets = [flash_base + i * PAYLOAD_SIZE for i in range(32)]
+        rng = random.Random(seed)
+        blocks = []
+        for offset in offsets:
+            payload = bytes(rng.getrandbits(8) for _ in range(PAYLOAD_SIZE))
+            blocks.append(t48.encr_blk(BLOCK_OFFSET.pack(offset) + payload, rng.getrandbits(32), 0, 0, ks=ks))
+        body = b"".join(t48.BLOCK.pack(*blk) for blk in blocks)
+        hdr = t48.FileHeader(version[1], version[0], 0, binascii.crc32(body) ^ 0xffffffff, 0, len(blocks))
+        return t48.FILE_HEADER.pack(*hdr) + body
+    return make
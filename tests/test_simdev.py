@@ -0,0 +1,80 @@
+"""
+Whole updates against the simulated programmer
+"""
+
+import io
+import pytest
+from libxgecu.t48 import update
+from libxgecu.t48.xgecu import simdev, t48
+
+def run(image, device, **kwargs):
+    session = simdev.SimSession(device, latency=0.0002)
+    return update.update(io.BytesIO(image), session=session, **kwargs)
+
+def records(image):
+    return list(update.dat_records(image))
+
+@pytest.mark.parametrize("window", [0, 8])
+def test_update(make_image, window):
+    image = make_image(version=(2, 1))
+    device = simdev.SimDevice(new_version=(2, 1), reset_time=0.0)
+    assert run(image, device, window=window)
+    assert device.flashed == records(image)
+    assert device.duplicates == 0
+    assert device.unknown == []
+    # Into the updater and back out
+    assert device.resets == 2
+    assert t48.parse_version(bytes(device.version))["ver_major"] == 2
+
+def test_already_current(make_image):
+    version = t48.parse_version(simdev.VERSION_T48)
+    image = make_image(version=(version["ver_major"], version["ver_minor"]))
+    device = simdev.SimDevice(reset_time=0.0)
+    assert not run(image, device)
+    assert device.flashed is None
+    assert device.resets == 0
+    assert run(image, device, force=True)
+    assert device.flashed == records(image)
+
+def test_bad_image(make_image):
+    image = bytearray(make_image())
+    image[-1] ^= 1
+    device = simdev.SimDevice(reset_time=0.0)
+    with pytest.raises(update.PreflightError):
+        run(bytes(image), device)
+    # Rejected before touching the device
+    assert device.commands == 0
+
+def test_duplicates_recorded():
+    """The simulator counts back to back identical chunks, ex: resent after a lost ack"""
+    device = simdev.SimDevice(reset_time=0.0)
+    device.bootloader = True
+    assert device.command(0x3C, b"\x3C" + bytes(7) + t48.MAGIC) == t48.ACK_3C
+    assert device.command(0x3B, b"\x3B\x01" + bytes(6) + t48.MAGIC) is None
+    chunks = [t48.CHUNK_HEADER + bytes([i]) * 16 for i in (1, 2, 2, 3)]
+    for chunk in chunks:
+        assert device.command(0x3B, chunk) == t48.ACK_3B
+    assert device.records == [chunk[8:] for chunk in chunks]
+    assert device.duplicates == 1
+
+def test_corrupt_ack(make_image):
+    image = make_image()
+    device = simdev.SimDevice(reset_time=0.0, fault=simdev.random_faults(corrupt=1.0))
+    with pytest.raises(t48.ValidateError):
+        run(image, device, strict=True)
+    assert device.flashed is None
+
+# Seeds with at least one dropped chunk ack
+@pytest.mark.parametrize("seed", [3, 6])
+def test_session_retries(make_image, capsys, seed):
+    """
+    Lost acks with session retries: the whole update restarts, no chunk is sent twice
+    and the flashed image is exactly the records
+    """
+    image = make_image()
+    device = simdev.SimDevice(new_version=(2, 1), reset_time=0.0,
+                              fault=simdev.random_faults(drop=0.03, seed=seed))
+    assert run(image, device, retry=update.RetryPolicy(3))
+    assert device.duplicates == 0
+    assert device.flashed == records(image)
+    assert "Restarting update" in capsys.readouterr().out
@@ -0,0 +1,68 @@
+"""
+Startup regression check for the console scripts in pyproject.toml
+
+Imports each entry point module in a fresh interpreter under -X importtime
+and fails if it goes over its time budget or pulls in a heavy dependency
+that should only load on the code path needing it
+"""
+
+import os
+import re
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time budget per entry point module, ms
+DEFAULT_BUDGET_MS = 25
+# Per script overrides
+BUDGET_MS = {
+}
+# Best of this many imports. The first one also compiles .pyc
+RUNS = 5
+
+# Must not load just by importing an entry point
+HEAVY_MODULES = ["usb1", "click", "more_itertools", "hexdump", "numpy"]
+
+
+def console_scripts():
+    """Return {script: module} from [tool.poetry.scripts]"""
+    ret = {}
+    in_scripts = False
+    with open(os.path.join(ROOT, "pyproject.toml")) as f:
+        for l in f:
+            l = l.strip()
+            if l.startswith("["):
+                in_scripts = l == "[tool.poetry.scripts]"
+                continue
+            m = re.match(r"""([\w-]+)\s*=\s*['"]([\w.]+):\w+['"]""", l)
+            if in_scripts and m:
+                ret[m.group(1)] = m.group(2)
+    return ret
+
+def import_time(module):
+    """Return (cumulative us for module, set of modules imported)"""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                         cwd=ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                         universal_newlines=True, check=True).stderr
+    cumulative = None
+    imported = set()
+    for l in out.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", l)
+        if not m:
+            continue
+        imported.add(m.group(4))
+        if m.group(4) == module:
+            cumulative = int(m.group(2))
+    assert cumulative is not None, "%s not in -X importtime output" % module
+    return cumulative, imported
+
+@pytest.mark.parametrize("script,module", sorted(console_scripts().items()))
+def test_startup(script, module):
+    results = [import_time(module) for _ in range(RUNS)]
+    heavy = sorted(set(HEAVY_MODULES) & results[0][1])
+    assert not heavy, "%s loads %s" % (module, ", ".join(heavy))
+    best = min(us for us, _imported in results) / 1000.0
+    budget = BUDGET_MS.get(script, DEFAULT_BUDGET_MS)
+    assert best <= budget, "%s: %0.1f ms, budget %u ms" % (module, best, budget)
@@ -0,0 +1,61 @@
+"""
+Fast t48crypto paths (KeySchedule, t48crypto_np) against the per byte reference
+Uses a random key, not key.dat
+"""
+
+import random
+import pytest
+from libxgecu.t48 import t48crypto as t48
+
+SEEDS = [0, 1, 0xff, 0x100, 0x1ff, 0xffff, 0x10000, 0xffffffff]
+
+@pytest.fixture
+def plain():
+    """[(data, seed), ...] covering every block_key_idx"""
+    rng = random.Random(0x56)
+    seeds = SEEDS + [rng.getrandbits(32) for _ in range(256)]
+    return [(bytes(rng.getrandbits(8) for _ in range(t48.BLOCK_DATA_SIZE)), seed) for seed in seeds]
+
+def test_encr_blk(ks, plain):
+    for data, seed in plain:
+        assert t48.encr_blk(data, seed, 3, 4, ks=ks) == t48.encr_blk_ref(data, seed, 3, 4)
+
+def test_decr_blk(ks, plain):
+    for data, seed in plain:
+        blk = t48.encr_blk_ref(data, seed, 0, 0)
+        assert t48.decr_blk(blk, ks=ks) == data
+        assert t48.decr_blk_ref(blk) == data
+
+def test_bad_crc(ks, plain):
+    data, seed = plain[0]
+    blk = t48.encr_blk(data, seed, 0, 0, ks=ks)
+    blk = blk._replace(data=bytes([blk.data[0] ^ 1]) + blk.data[1:])
+    with pytest.raises(ValueError):
+        t48.decr_blk(blk, ks=ks)
+    with pytest.raises(ValueError):
+        t48.decr_blk_ref(blk)
+
+def test_np_blks(ks, plain):
+    t48crypto_np = pytest.importorskip("libxgecu.t48.t48crypto_np")
+    n = len(plain)
+    blocks = t48crypto_np.encr_blks([data for data, _seed in plain], [seed for _data, seed in plain],
+                                    [5] * n, [6] * n, ks=ks)
+    assert blocks == [t48.encr_blk_ref(data, seed, 5, 6) for data, seed in plain]
+    dec = t48crypto_np.decr_blks(blocks, ks=ks)
+    assert [row.tobytes() for row in dec] == [data for data, _seed in plain]
+
+def test_np_image(ks, plain, tmp_path):
+    t48crypto_np = pytest.importorskip("libxgecu.t48.t48crypto_np")
+    blocks = [t48.encr_blk_ref(data, seed, 0, 0) for data, seed in plain]
+    fn = str(tmp_path / "image.dat")
+    t48.write_file(fn, t48.FileHeader(1, 2, 0, 0, 0, len(blocks)), blocks)
+    with t48.FirmwareImage(fn) as image:
+        dec = t48crypto_np.decr_image(image, ks=ks)
+    assert [row.tobytes() for row in dec] == [data for data, _seed in plain]
+
+def test_np_bad_crc(ks, plain):
+    t48crypto_np = pytest.importorskip("libxgecu.t48.t48crypto_np")
+    blocks = [t48.encr_blk(data, seed, 0, 0, ks=ks) for data, seed in plain[:8]]
+    blocks[5] = blocks[5]._replace(crc32=blocks[5].crc32 ^ 1)
+    with pytest.raises(ValueError, match="block 5"):
+        t48crypto_np.decr_blks(blocks, ks=ks)
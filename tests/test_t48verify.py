@@ -0,0 +1,105 @@
+"""
+t48verify problem classification on generated images
+"""
+
+import binascii
+import sys
+import libxgecu.t48
+from libxgecu.t48 import t48crypto as t48
+from libxgecu.t48 import t48verify
+from libxgecu.t48.t48decrypt import PAYLOAD_SIZE, flash_base
+
+def offsets(n, start=flash_base):
+    return [start + i * PAYLOAD_SIZE for i in range(n)]
+
+def fix_crc(buf):
+    """Recompute the file CRC of a .dat image after editing its blocks"""
+    buf = bytearray(buf)
+    hdr = t48.FileHeader(*t48.FILE_HEADER.unpack_from(buf))
+    hdr = hdr._replace(crc32=binascii.crc32(buf[t48.FILE_HEADER.size:]) ^ 0xffffffff)
+    t48.FILE_HEADER.pack_into(buf, 0, *hdr)
+    return bytes(buf)
+
+def bad_block(buf, i):
+    """Flip the stored CRC of block i, keeping the file CRC valid"""
+    buf = bytearray(buf)
+    pos = t48.FILE_HEADER.size + i * t48.BLOCK.size
+    buf[pos] ^= 1
+    return fix_crc(buf)
+
+def kinds(problems):
+    return [(problem.kind, problem.block) for problem in problems]
+
+def test_ok(make_image, ks):
+    report = t48verify.verify_buffer(make_image(offsets(32)), ks=ks, workers=1)
+    assert report.ok
+    assert report.num_blocks == 32
+    assert report.errors == [] and report.warnings == []
+    assert report.ranges == [(flash_base, flash_base + 32 * PAYLOAD_SIZE)]
+
+def test_file_crc(make_image, ks):
+    buf = bytearray(make_image(offsets(8)))
+    buf[t48.FILE_HEADER.size + 20] ^= 1
+    report = t48verify.verify_buffer(bytes(buf), ks=ks, workers=1)
+    assert not report.ok
+    # The block with the flipped bit fails its CRC too
+    assert kinds(report.errors) == [("file_crc", None), ("block_crc", 0)]
+
+def test_block_crc(make_image, ks):
+    report = t48verify.verify_buffer(bad_block(make_image(offsets(16)), 7), ks=ks, workers=1)
+    assert kinds(report.errors) == [("block_crc", 7)]
+    # Block 7's payload is missing from the ranges, but that is not reported as a gap at block 8
+    assert report.warnings == []
+    assert report.ranges == [(flash_base, flash_base + 7 * PAYLOAD_SIZE),
+                             (flash_base + 8 * PAYLOAD_SIZE, flash_base + 16 * PAYLOAD_SIZE)]
+
+def test_gap(make_image, ks):
+    offs = offsets(4) + offsets(4, start=flash_base + 0x1000)
+    report = t48verify.verify_buffer(make_image(offs), ks=ks, workers=1)
+    assert report.ok
+    assert kinds(report.warnings) == [("gap", 4)]
+    assert report.warnings[0].offset == flash_base + 4 * PAYLOAD_SIZE
+
+def test_overlap(make_image, ks):
+    offs = offsets(8)
+    offs[6] = offs[2] + 16
+    report = t48verify.verify_buffer(make_image(offs), ks=ks, workers=1)
+    assert ("overlap", 6) in kinds(report.errors)
+
+def test_below_flash_base(make_image, ks):
+    report = t48verify.verify_buffer(make_image([flash_base - PAYLOAD_SIZE] + offsets(3)),
+                                     ks=ks, workers=1)
+    assert kinds(report.errors) == [("offset", 0)]
+
+def test_truncated(make_image, ks):
+    buf = make_image(offsets(8))
+    report = t48verify.verify_buffer(buf[:-10], ks=ks, workers=1)
+    assert kinds(report.errors) == [("size", None), ("file_crc", None)]
+    assert report.num_blocks == 8
+
+def test_empty(make_image, ks):
+    report = t48verify.verify_buffer(make_image([]), ks=ks, workers=1)
+    assert kinds(report.errors) == [("empty", None)]
+    report = t48verify.verify_buffer(b"", ks=ks)
+    assert kinds(report.errors) == [("size", None)]
+
+def test_scalar(make_image, ks, monkeypatch):
+    """Same result without numpy"""
+    buf = bad_block(make_image(offsets(16)), 3)
+    want = t48verify.check_blocks(buf[t48.FILE_HEADER.size:], 0, 16, ks)
+    monkeypatch.setitem(sys.modules, "libxgecu.t48.t48crypto_np", None)
+    monkeypatch.delattr(libxgecu.t48, "t48crypto_np", raising=False)
+    assert t48verify.check_blocks(buf[t48.FILE_HEADER.size:], 0, 16, ks) == want
+    assert want[3] is None and None not in want[:3] + want[4:]
+
+def test_parallel(make_image, ks, tmp_path):
+    buf = bad_block(make_image(offsets(40) + offsets(4, start=flash_base + 0x10000)), 11)
+    want = t48verify.verify_buffer(buf, ks=ks, workers=1)
+    fn = tmp_path / "fw.dat"
+    fn.write_bytes(buf)
+    # Workers map the file
+    got = t48verify.verify_file(str(fn), ks=ks, workers=2)
+    assert (got.errors, got.warnings, got.ranges) == (want.errors, want.warnings, want.ranges)
+    # No file: shared memory
+    got = t48verify.verify_buffer(buf, ks=ks, workers=2)
+    assert (got.errors, got.warnings, got.ranges) == (want.errors, want.warnings, want.ranges)
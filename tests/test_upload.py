@@ -0,0 +1,101 @@
+"""
+PipelinedUploader over fakeusb: ordering, error handling and draining on failure
+"""
+
+import pytest
+from libxgecu.t48.xgecu import fakeusb, t48
+from libxgecu.t48.xgecu.upload import PipelinedUploader, UploadError
+
+ACK = b"\xAA" * 4
+
+class Device:
+    """Acks every chunk, except as told. Records the chunks received"""
+    def __init__(self, bad=None, drop=None):
+        self.bad = bad
+        self.drop = drop
+        self.received = []
+
+    def respond(self, endpoint, data):
+        seq = len(self.received)
+        self.received.append(data)
+        if seq == self.drop:
+            return None
+        if seq == self.bad:
+            return b"\xBB" * 4
+        return ACK
+
+def uploader(device, window=4, alive=True, **kwargs):
+    context = fakeusb.FakeContext()
+    handle = fakeusb.FakeHandle(context, device.respond, latency=0.0002)
+    if not alive:
+        handle.alive = lambda: False
+    transfers = []
+    get_transfer = handle.getTransfer
+
+    def getTransfer(*args, **kwargs):
+        transfers.append(get_transfer(*args, **kwargs))
+        return transfers[-1]
+    handle.getTransfer = getTransfer
+    return PipelinedUploader(handle, context, window=window, ack_len=4, **kwargs), transfers
+
+def chunks(n):
+    return [bytes([i]) * 8 for i in range(n)]
+
+@pytest.mark.parametrize("window", [1, 3, 8])
+def test_in_order(window):
+    device = Device()
+    up, _transfers = uploader(device, window=window)
+    assert up.run(chunks(20), ACK) == 20
+    assert device.received == chunks(20)
+    assert up.bytes == 20 * 8
+
+def test_bad_ack():
+    device = Device(bad=5)
+    up, transfers = uploader(device, window=4)
+    with pytest.raises(UploadError, match="chunk 5: bad ack"):
+        up.run(chunks(20), ACK)
+    assert up.chunks == 5
+    # Nothing past the window is sent after the failure
+    assert len(device.received) <= 5 + 4
+    assert not any(transfer.isSubmitted() for transfer in transfers)
+
+def test_ack_timeout():
+    device = Device(drop=2)
+    up, transfers = uploader(device, window=4, timeout=50)
+    # Acks are matched by position: a lost one shows up as the last chunk timing out
+    with pytest.raises(UploadError, match="chunk 9: ack timed out"):
+        up.run(chunks(10), ACK)
+    assert up.chunks == 9
+    assert not any(transfer.isSubmitted() for transfer in transfers)
+
+def test_no_device():
+    device = Device()
+    up, transfers = uploader(device, alive=False)
+    with pytest.raises(UploadError, match="chunk 0: write %s" % t48.status_i2s[t48.TRANSFER_NO_DEVICE]):
+        up.run(chunks(4), ACK)
+    assert device.received == []
+    assert not any(transfer.isSubmitted() for transfer in transfers)
+
+def test_validate():
+    device = Device()
+    up, _transfers = uploader(device)
+    seen = []
+
+    def validate(ack):
+        seen.append(ack)
+        return "rejected" if len(seen) == 3 else None
+    with pytest.raises(UploadError, match="chunk 2: rejected"):
+        up.run_validate(chunks(10), validate)
+    assert seen == [ACK] * 3
+
+def test_producer_error():
+    """An exception from the chunk iterable drains what is in flight, then propagates"""
+    device = Device()
+    up, transfers = uploader(device)
+
+    def gen():
+        yield from chunks(3)
+        raise RuntimeError("producer")
+    with pytest.raises(RuntimeError, match="producer"):
+        up.run(gen(), ACK)
+    assert not any(transfer.isSubmitted() for transfer in transfers)
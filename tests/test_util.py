@@ -0,0 +1,149 @@
+"""
+StructStreamer / StructSchema and the chunked hexdump against the original per byte implementations
+"""
+
+import io
+import random
+import struct
+import pytest
+from libxgecu.t48.xgecu import t48, simdev
+from libxgecu.t48.xgecu.util import StructStreamer, StructSchema, hexdump, hexdump_file, tostr
+
+def hexdump_ref(data, indent='', address_width=8, f=None):
+    """The original per byte hexdump, minus the label"""
+    def isprint(c):
+        return c >= ' ' and c <= '~'
+
+    bytes_per_half_row = 8
+    bytes_per_row = 16
+    data = bytearray(data)
+    data_len = len(data)
+
+    def hexdump_half_row(start):
+        left = max(data_len - start, 0)
+
+        real_data = min(bytes_per_half_row, left)
+
+        f.write(''.join('%02X ' % c for c in data[start:start + real_data]))
+        f.write(''.join('   ' * (bytes_per_half_row - real_data)))
+        f.write(' ')
+
+        return start + bytes_per_half_row
+
+    pos = 0
+    while pos < data_len:
+        row_start = pos
+        f.write(indent)
+        if address_width:
+            f.write(('%%0%dX  ' % address_width) % pos)
+        pos = hexdump_half_row(pos)
+        pos = hexdump_half_row(pos)
+        f.write("|")
+        # Char view
+        left = data_len - row_start
+        real_data = min(bytes_per_row, left)
+
+        f.write(''.join([
+            c if isprint(c) else '.'
+            for c in tostr(data[row_start:row_start + real_data])
+        ]))
+        f.write((" " * (bytes_per_row - real_data)) + "|\n")
+
+def dump(fn, data, **kwargs):
+    f = io.StringIO()
+    fn(data, f=f, **kwargs)
+    return f.getvalue()
+
+# Partial rows, half rows and more than one HEXDUMP_CHUNK
+@pytest.mark.parametrize("size", [0, 1, 7, 8, 9, 15, 16, 17, 31, 32, 33, 256, 4096 * 16 + 5])
+def test_hexdump(size):
+    rng = random.Random(size)
+    data = bytes(rng.getrandbits(8) for _ in range(size))
+    assert dump(hexdump, data) == dump(hexdump_ref, data)
+
+@pytest.mark.parametrize("indent,address_width", [("", 0), ("  ", 4), ("%s ", 8)])
+def test_hexdump_format(indent, address_width):
+    data = bytes(range(256)) + b"abc"
+    assert dump(hexdump, data, indent=indent, address_width=address_width) == \
+        dump(hexdump_ref, data, indent=indent, address_width=address_width)
+
+def test_hexdump_file():
+    rng = random.Random(1)
+    data = bytes(rng.getrandbits(8) for _ in range(1000))
+    # Chunks not a multiple of the row size carry partial rows over
+    got = dump(hexdump_file, io.BytesIO(data), collapse=False, chunk_size=37)
+    assert got == dump(hexdump_ref, data)
+
+def test_hexdump_collapse():
+    data = b"\x00" * 64 + b"\x01" * 3
+    assert dump(hexdump, data, collapse=True) == (
+        "00000000  00 00 00 00 00 00 00 00  00 00 00 00 00 00 00 00  |................|\n"
+        "*\n"
+        "00000040  01 01 01                                          |...             |\n"
+        "00000043\n")
+
+def test_streamer_u32l():
+    # u32l used to consume 8 bytes
+    ss = StructStreamer(struct.pack("<IBH", 0x12345678, 0x9A, 0xBCDE))
+    assert ss.u32l("a") == 0x12345678
+    assert ss.u8("b") == 0x9A
+    assert ss.u16l("c") == 0xBCDE
+    assert ss.done() == {"a": 0x12345678, "b": 0x9A, "c": 0xBCDE}
+
+def test_streamer_fields():
+    ss = StructStreamer(b"\x12\x34\x56\x78\x9A\xBCab\x00cXYZ\xFF\x01\x02")
+    assert ss.u32b("a") == 0x12345678
+    assert ss.u16b("b") == 0x9ABC
+    assert ss.strn0("c", 4) == "ab"
+    assert ss.strn("d", 3) == "XYZ"
+    assert ss.popped() == 13
+    ss.assert_bytes(b"\xFF")
+    assert ss.res(2) == bytearray(b"\x01\x02")
+    # Reserved bytes are named by offset
+    assert ss.done()["res14"] == bytearray(b"\x01\x02")
+
+def test_streamer_short():
+    ss = StructStreamer(b"\x00\x01\x02")
+    with pytest.raises(AssertionError):
+        ss.u32l("a")
+    ss.u16l("a")
+    with pytest.raises(AssertionError):
+        ss.done()
+
+FIELDS = [
+    ("res", 3),
+    ("u8", "a"),
+    ("u16l", "b"),
+    ("u16b", "c"),
+    ("u32l", "d"),
+    ("u32b", "e"),
+    ("strn0", "f", 6),
+    ("strn", "g", 5),
+    ("res", 2, "named"),
+    ("res", 4),
+]
+
+def test_schema_random():
+    schema = StructSchema(FIELDS)
+    rng = random.Random(2)
+    for _ in range(200):
+        buf = bytes(rng.getrandbits(8) for _ in range(schema.size))
+        assert schema.unpack(buf) == schema.stream(StructStreamer(buf)).done()
+
+def test_schema_version():
+    buf = bytes(simdev.VERSION_T48)
+    schema = t48.VERSION_SCHEMAS[len(buf)]
+    assert schema.unpack(buf) == schema.stream(StructStreamer(buf)).done()
+    # T56 responses end in an extra 00
+    buf64 = buf[:6] + b"\x06" + buf[7:] + b"\x00"
+    schema = t48.VERSION_SCHEMAS[64]
+    assert schema.unpack(buf64) == schema.stream(StructStreamer(buf64)).done()
+
+def test_schema_assert():
+    schema = StructSchema([("u8", "a"), ("assert_bytes", b"\x00"), ("assert_str", "\xFFz")])
+    assert schema.unpack(b"\x05\x00\xFFz") == {"a": 5}
+    for buf in (b"\x05\x01\xFFz", b"\x05\x00\xFEz"):
+        with pytest.raises(AssertionError):
+            schema.unpack(buf)
+        with pytest.raises(AssertionError):
+            schema.stream(StructStreamer(buf))